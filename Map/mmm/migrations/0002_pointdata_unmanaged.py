@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+# The partitioned point table is created by the loader (scripts/partitioning.py), Django only maps it
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mmm', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='pointdata',
+            options={'managed': False},
+        ),
+    ]
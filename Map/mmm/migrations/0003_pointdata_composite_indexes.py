@@ -0,0 +1,38 @@
+from django.contrib.postgres.indexes import BrinIndex
+from django.db import migrations, models
+
+
+# PointData is unmanaged: these operations only update the migration state,
+# the indexes are built by the loader (scripts/indexes.py)
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mmm', '0002_pointdata_unmanaged'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='pointdata',
+            name='data_vehicle_9e5042_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='pointdata',
+            name='data_trip_id_c9271a_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='pointdata',
+            name='data_zone_id_3b6caa_idx',
+        ),
+        migrations.AddIndex(
+            model_name='pointdata',
+            index=models.Index(fields=['zone_id', 'vehicle_class', 'dt'], name='data_zone_class_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pointdata',
+            index=models.Index(fields=['vehicle_id', 'trip_id', 'dt'], name='data_vehicle_trip_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pointdata',
+            index=BrinIndex(fields=['dt'], name='data_dt_brin_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mmm', '0003_pointdata_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pointdata',
+            name='trip_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='pointdata',
+            name='ts_insert',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
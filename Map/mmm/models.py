@@ -1,8 +1,11 @@
 import warnings
 warnings.filterwarnings("ignore")
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import BrinIndex
 
 
+# The point table is created and partitioned by day by scripts/01_read_and_insert_data_into_database.py,
+# the model only maps it. gid identifies a point but is not a constraint of the partitioned table.
 class PointData(models.Model):
     gid = models.BigIntegerField(primary_key=True)
     x = models.FloatField()
@@ -14,16 +17,21 @@ class PointData(models.Model):
     vehicle_id = models.BigIntegerField()
     vehicle_class = models.CharField(max_length=2)
     zone_id = models.BigIntegerField()
-    trip_id = models.BigIntegerField()
+    trip_id = models.BigIntegerField(null=True)
     fid = models.BigIntegerField()
-    ts_insert = models.DateTimeField()
+    ts_insert = models.DateTimeField(null=True)
 
     class Meta:
         db_table = '"data"."data"'  # Schema "data", Table "data"
+        managed = False
+        # Built by the loader (scripts/indexes.py), not by the migrations
         indexes = [
-            models.Index(fields=["vehicle_id"]),
-            models.Index(fields=["trip_id"]),
-            models.Index(fields=["zone_id"])
+            # Zone time series of the analysis scripts (02, 05, 07, 08)
+            models.Index(fields=["zone_id", "vehicle_class", "dt"], name="data_zone_class_dt_idx"),
+            # Vehicle and trip lookups of the map views
+            models.Index(fields=["vehicle_id", "trip_id", "dt"], name="data_vehicle_trip_dt_idx"),
+            # Date range scans
+            BrinIndex(fields=["dt"], name="data_dt_brin_idx")
         ]
 
     def __str__(self):
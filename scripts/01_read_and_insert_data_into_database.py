@@ -6,93 +6,81 @@ Description:
 This script reads a CSV file in chunks and inserts the data into a PostgreSQL database.
 The script reads the database connection details and file path from a 'config.json' file.
 The script also logs the process to a file in the 'logs' directory.
+Every loaded chunk is recorded in the 'data.ingest_manifest' table in the same transaction as its rows,
+so a re-run after a failure skips the chunks that already landed and retries only the failed ones.
+The point table is partitioned by day on 'dt' and missing daily partitions are attached before each chunk is written.
+Secondary indexes can be dropped before the import and rebuilt in parallel afterwards.
+With "zone_cube" enabled, every chunk is also merged into the zone and link cubes in the same transaction.
 """
 
 # Import the necessary libraries and modules
+import io
 import os
 import sys
 import json
+import time
 import logging
 import psycopg2
 import pandas as pd
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from cleaning import COLUMN_MAPPING, clean_chunk, parse_raw_block, read_raw_blocks, read_raw_header
+from ingest_manifest import create_manifest_table, is_loaded, load_manifest, record_chunk
+from partitioning import create_partitioned_table, ensure_day_partitions
+from indexes import analysis_indexes, build_indexes, clear_pending_indexes, drop_secondary_indexes, load_pending_indexes
+from zone_cube import chunk_cube_rows, create_cube_tables, cube_precision, upsert_cube_rows
 
 # Display settings
 pd.set_option('display.max_columns', 100)
 pd.set_option('display.max_rows', 100)
 
 
-# Function to safely convert values to BIGINT
-def safe_bigint(value) -> int or None:
-    """
-    Safely convert a value to BIGINT
-    :param value:
-    :return:
-    """
-    try:
-        return int(value) if pd.notna(value) and value != "" else None
-    except ValueError:
-        return None  # Ensures very large values don't cause issues
-
-
 # Function to process and insert chunks
-def process_and_insert_chunk(chunk) -> int:
+def process_and_insert_chunk(chunk_info, block, columns, dt_format) -> tuple:
     """
-    Process and insert a chunk of data into the database
-    :param chunk:
-    :return:
+    Process and insert a chunk of data into the database and record it in the manifest
+    :param chunk_info:
+    :param block:
+    :param columns:
+    :param dt_format:
+    :return: (number_of_inserted_rows, number_of_malformed_rows, loaded)
     """
-    chunk = chunk.copy()  # Avoid SettingWithCopyWarning
-
-    # Drop rows with missing essential values
-    chunk.dropna(subset=["x", "y", "dir", "vel", "dt", "stato",  "id_veicolo", "classe_veicolo", "mm_id_zona", "mm_fid"], inplace=True)
-
-    # Convert `dt` column to datetime format
-    chunk["dt"] = pd.to_datetime(chunk["dt"], errors='coerce')
+    malformed = 0
 
-    # Convert `zone_id (mm_id_zona)` and `fid (mm_fid)` to BIGINT safely
-    chunk["mm_id_zona"] = chunk["mm_id_zona"].apply(safe_bigint)
-    chunk["mm_fid"] = chunk["mm_fid"].apply(safe_bigint)
+    # Clean and insert data into database
+    try:
+        chunk, malformed = clean_chunk(parse_raw_block(block, columns), dt_format)
+        days = chunk["dt"].dt.normalize().unique()
+        zone_rows, link_rows = chunk_cube_rows(chunk, CUBE_INTERVAL, CUBE_PRECISION) if CUBE_INTERVAL else ([], [])
 
-    # Replace NaN values with None for PostgreSQL compatibility
-    chunk = chunk.where(pd.notna(chunk), None)
+        # Replace missing values with None for PostgreSQL compatibility
+        chunk = chunk[list(COLUMN_MAPPING.values())].astype(object)
+        chunk = chunk.where(pd.notna(chunk), None)
 
-    # Insert data into database
-    try:
         conn = psycopg2.connect(**DB_PARAMS)
+        ensure_day_partitions(conn, SCHEMA, POINT_TABLE, days)
         cursor = conn.cursor()
 
-        insert_query = """
-        INSERT INTO data.data (gid, x, y, direction, velocity, dt, status, vehicle_id, vehicle_class, zone_id, fid, ts_insert)
+        insert_query = f"""
+        INSERT INTO {SCHEMA}.{POINT_TABLE} (gid, x, y, direction, velocity, dt, status, vehicle_id, vehicle_class, zone_id, fid, ts_insert)
         VALUES %s
         """
 
-        values = [
-            (
-                safe_bigint(row["gid"]),
-                float(row["x"]),
-                float(row["y"]),
-                row["dir"],
-                float(row["vel"]),
-                row["dt"],
-                row["stato"],
-                safe_bigint(row["id_veicolo"]),
-                row["classe_veicolo"],
-                safe_bigint(row["mm_id_zona"]),
-                safe_bigint(row["mm_fid"]),
-                row["ts_insert"]
-            )
-            for _, row in chunk.iterrows()
-        ]
+        values = list(chunk.itertuples(index=False, name=None))
 
         execute_values(cursor, insert_query, values)
+        upsert_cube_rows(cursor, zone_rows, link_rows)
+        record_chunk(cursor, chunk_info, len(values), malformed)
         conn.commit()
 
-        return len(values)
+        return len(values), malformed, True
 
     except Exception as e:
-        print(f"Error processing chunk: {e}")
-        return 0
+        logging.error(f"Chunk {chunk_info['chunk_number']}: Error processing chunk: {e}")
+        return 0, malformed, False
 
     finally:
         if 'cursor' in locals() and cursor:
@@ -101,6 +89,167 @@ def process_and_insert_chunk(chunk) -> int:
             conn.close()
 
 
+# Function to prepare a chunk for COPY
+def prepare_copy_buffer(block, columns, dt_format, cube_interval=None, cube_precision=None) -> tuple:
+    """
+    Parse and clean a chunk of data and serialize it as CSV text in database column order
+    :param block:
+    :param columns:
+    :param dt_format:
+    :param cube_interval: bin size of the zone and link cubes, no cube rows are computed if None
+    :param cube_precision: precision of the vehicle sketches of the cubes, the exact vehicle ids are kept if None
+    :return: (csv_text, number_of_rows, number_of_malformed_rows, days, cube_rows)
+    """
+    chunk, malformed = clean_chunk(parse_raw_block(block, columns), dt_format)
+    days = chunk["dt"].dt.normalize().unique()
+    cube_rows = chunk_cube_rows(chunk, cube_interval, cube_precision) if cube_interval else ([], [])
+
+    # Write the chunk as CSV into an in-memory buffer in database column order
+    buffer = io.StringIO()
+    chunk = chunk[list(COLUMN_MAPPING.values())]
+    chunk.to_csv(buffer, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S")
+
+    return buffer.getvalue(), len(chunk), malformed, days, cube_rows
+
+
+# Function to stream prepared CSV text into the database
+def copy_buffer(conn, csv_text, chunk_info, rows, malformed, days, cube_rows) -> None:
+    """
+    Stream prepared CSV text into the database with COPY FROM STDIN, merge the chunk into the cubes
+    and record it in the manifest in the same transaction. The daily partitions of the chunk are created first.
+    :param conn:
+    :param csv_text:
+    :param chunk_info:
+    :param rows:
+    :param malformed:
+    :param days:
+    :param cube_rows: (zone_rows, link_rows) returned by prepare_copy_buffer
+    :return:
+    """
+    ensure_day_partitions(conn, SCHEMA, POINT_TABLE, days)
+
+    copy_query = f"""
+    COPY {SCHEMA}.{POINT_TABLE} ({", ".join(COLUMN_MAPPING.keys())})
+    FROM STDIN WITH (FORMAT csv)
+    """
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(copy_query, io.StringIO(csv_text))
+            upsert_cube_rows(cursor, *cube_rows)
+            record_chunk(cursor, chunk_info, rows, malformed)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# Function to stream a chunk into the database with COPY
+def copy_chunk(chunk_info, block, columns, dt_format) -> tuple:
+    """
+    Process a chunk of data and stream it into the database with COPY FROM STDIN
+    :param chunk_info:
+    :param block:
+    :param columns:
+    :param dt_format:
+    :return: (number_of_inserted_rows, number_of_malformed_rows, loaded)
+    """
+    malformed = 0
+
+    # Prepare the chunk and stream the buffer into the database
+    try:
+        csv_text, rows, malformed, days, cube_rows = prepare_copy_buffer(block, columns, dt_format, CUBE_INTERVAL, CUBE_PRECISION)
+        conn = psycopg2.connect(**DB_PARAMS)
+        copy_buffer(conn, csv_text, chunk_info, rows, malformed, days, cube_rows)
+
+        return rows, malformed, True
+
+    except Exception as e:
+        logging.error(f"Chunk {chunk_info['chunk_number']}: Error processing chunk: {e}")
+        return 0, malformed, False
+
+    finally:
+        if 'conn' in locals() and conn:
+            conn.close()
+
+
+# Function to ingest the file with parallel cleaning and pooled connections
+def parallel_ingest(chunks, columns, workers, dt_format) -> tuple:
+    """
+    Clean chunks in a process pool and write them with a pool of long-lived connections.
+    At most two chunks per worker are in flight, so memory stays flat.
+    :param chunks: an iterator of (chunk_info, block) still to be loaded
+    :param columns:
+    :param workers:
+    :param dt_format:
+    :return: (total_inserted, total_malformed, failed_chunks)
+    """
+    connection_pool = ThreadedConnectionPool(1, workers, **DB_PARAMS)
+
+    def clean_and_write(chunk_info, block) -> tuple:
+        start_time = time.perf_counter()
+        malformed = 0
+        try:
+            csv_text, rows, malformed, days, cube_rows = cleaners.submit(prepare_copy_buffer, block, columns, dt_format, CUBE_INTERVAL, CUBE_PRECISION).result()
+            conn = connection_pool.getconn()
+            try:
+                copy_buffer(conn, csv_text, chunk_info, rows, malformed, days, cube_rows)
+            finally:
+                connection_pool.putconn(conn)
+        except Exception as e:
+            logging.error(f"Chunk {chunk_info['chunk_number']}: Error processing chunk: {e}")
+            return 0, malformed, False
+
+        elapsed = time.perf_counter() - start_time
+        rate = rows / elapsed if elapsed > 0 else 0
+        logging.info(f"Chunk {chunk_info['chunk_number']}: Inserted {rows} records ({rate:,.0f} rows/s), {malformed} malformed rows skipped")
+        return rows, malformed, True
+
+    total_inserted = 0
+    total_malformed = 0
+    failed_chunks = 0
+    in_flight = deque()
+
+    def collect(future) -> None:
+        nonlocal total_inserted, total_malformed, failed_chunks
+        rows, malformed, loaded = future.result()
+        total_inserted += rows
+        total_malformed += malformed
+        failed_chunks += not loaded
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as cleaners, ThreadPoolExecutor(max_workers=workers) as writers:
+            for chunk_info, block in chunks:
+                in_flight.append(writers.submit(clean_and_write, chunk_info, block))
+
+                # Backpressure: wait for the oldest chunk before reading more of the file
+                while len(in_flight) >= 2 * workers:
+                    collect(in_flight.popleft())
+
+            while in_flight:
+                collect(in_flight.popleft())
+    finally:
+        connection_pool.closeall()
+
+    return total_inserted, total_malformed, failed_chunks
+
+
+# Function to skip the chunks that are already in the manifest
+def pending_chunks(data_path, chunk_size, manifest):
+    """
+    Read the file in blocks and yield only the chunks that are not in the manifest yet
+    :param data_path:
+    :param chunk_size:
+    :param manifest:
+    :return: an iterator of (chunk_info, block)
+    """
+    for chunk_info, block in read_raw_blocks(data_path, chunk_size):
+        if is_loaded(manifest, chunk_info):
+            logging.info(f"Chunk {chunk_info['chunk_number']}: Already loaded, skipped")
+            continue
+        yield chunk_info, block
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -125,8 +274,17 @@ if __name__ == "__main__":
         password = config["database"]["password"]
         host = config["database"]["host"]
         port = config["database"]["port"]
+        schema = config["database"]["schema"]
+        point_table = config["database"]["point_table"]
         file_path = config["input_data"]["data_name"]
         chunk_size = config["input_data"]["chunk_size"]
+        loader = config["input_data"]["loader"]
+        workers = config["input_data"]["workers"]
+        dt_format = config["input_data"]["dt_format"]
+        defer_indexes = config["input_data"]["defer_indexes"]
+        convert_table = config["input_data"]["convert_table"]
+        zone_cube = config["input_data"]["zone_cube"]
+        cube_interval = config["input_data"]["cube_interval"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
@@ -140,22 +298,113 @@ if __name__ == "__main__":
         "port": port
     }
 
-    logging.info("Starting data import process.")
+    # Point table partitioned by day on `dt`
+    SCHEMA = schema
+    POINT_TABLE = point_table
+
+    # Bin size of the zone and link cubes, None when the cubes are not maintained
+    CUBE_INTERVAL = cube_interval if zone_cube else None
+
+    # Precision of the vehicle sketches of the cubes, None when the exact vehicle ids are kept
+    CUBE_PRECISION = cube_precision(config)
+
+    # Select the loader: "copy" streams chunks with COPY, "insert" uses batched INSERT statements
+    load_chunk = copy_chunk if loader == "copy" else process_and_insert_chunk
 
     # Process the file in chunks
     total_inserted = 0
-    total_chunks = 0
+    total_malformed = 0
+    failed_chunks = 0
 
     try:
-        # Read and insert data in chunks
         data_path = os.path.join("data", file_path)
-        for item in pd.read_csv(data_path, chunksize=chunk_size):
-            total_chunks += 1
-            records_inserted = process_and_insert_chunk(item)
-            total_inserted += records_inserted
-            logging.info(f"Chunk {total_chunks}: Inserted {records_inserted} records")
+        columns = read_raw_header(data_path)
+
+        # Load the chunks recorded by previous runs
+        conn = psycopg2.connect(**DB_PARAMS)
+        try:
+            create_partitioned_table(conn, SCHEMA, POINT_TABLE, convert_table)
+            create_manifest_table(conn)
+            if zone_cube:
+                create_cube_tables(conn)
+            manifest = load_manifest(conn, os.path.basename(data_path))
+        finally:
+            conn.close()
+        logging.info(f"{len(manifest)} chunks already loaded according to the manifest.")
+
+        # Peek at the first pending chunk, so that a fully loaded file leaves the indexes alone
+        chunks = pending_chunks(data_path, chunk_size, manifest)
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            logging.info("Every chunk is already loaded, nothing to import.")
+        else:
+            chunks = chain([first_chunk], chunks)
+
+        # Drop the secondary indexes during the bulk import, they are rebuilt afterwards.
+        # Without pending chunks only the indexes left pending by earlier runs are rebuilt.
+        index_definitions = {}
+        if defer_indexes:
+            conn = psycopg2.connect(**DB_PARAMS)
+            try:
+                if first_chunk is None:
+                    index_definitions = load_pending_indexes(conn, SCHEMA, POINT_TABLE)
+                else:
+                    index_definitions = drop_secondary_indexes(conn, SCHEMA, POINT_TABLE)
+            finally:
+                conn.close()
+            if first_chunk is None:
+                logging.info(f"{len(index_definitions)} indexes left pending by earlier runs.")
+            else:
+                logging.info(f"Dropped {len(index_definitions)} secondary indexes before the import.")
+
+        if first_chunk is None:
+            # Nothing to import
+            pass
+        elif workers > 1:
+            # Clean chunks in parallel and stream them with COPY over pooled connections
+            if loader != "copy":
+                logging.warning(f"The '{loader}' loader is ignored with {workers} workers, the parallel import always uses COPY.")
+            logging.info(f"Starting parallel data import process with {workers} workers.")
+            total_inserted, total_malformed, failed_chunks = parallel_ingest(chunks, columns, workers, dt_format)
+        else:
+            logging.info(f"Starting data import process with the '{loader}' loader.")
+
+            # Read and insert data in chunks
+            for chunk_info, block in chunks:
+                start_time = time.perf_counter()
+                records_inserted, records_malformed, loaded = load_chunk(chunk_info, block, columns, dt_format)
+                elapsed = time.perf_counter() - start_time
+                total_inserted += records_inserted
+                total_malformed += records_malformed
+                if not loaded:
+                    failed_chunks += 1
+                    continue
+                rate = records_inserted / elapsed if elapsed > 0 else 0
+                logging.info(f"Chunk {chunk_info['chunk_number']}: Inserted {records_inserted} records ({rate:,.0f} rows/s), {records_malformed} malformed rows skipped")
+
+        # Rebuild the dropped indexes together with the composite analysis indexes once every chunk is loaded.
+        # After a failed import they stay pending and are rebuilt by the next successful run.
+        if defer_indexes and failed_chunks:
+            logging.warning(f"{len(index_definitions)} indexes stay dropped until a run loads every chunk.")
+        elif defer_indexes and (first_chunk is not None or index_definitions):
+            index_definitions.update(analysis_indexes(SCHEMA, POINT_TABLE))
+            start_time = time.perf_counter()
+            try:
+                build_indexes(DB_PARAMS, index_definitions, workers)
+                conn = psycopg2.connect(**DB_PARAMS)
+                try:
+                    clear_pending_indexes(conn, SCHEMA, POINT_TABLE, index_definitions)
+                finally:
+                    conn.close()
+            except Exception as e:
+                logging.error(f"Rebuilding the indexes failed, they are rebuilt by the next run: {e}")
+                raise
+            logging.info(f"Built {len(index_definitions)} indexes in {time.perf_counter() - start_time:,.0f} s.")
 
-        logging.info(f"Completed importing data: {total_inserted} total records inserted in {total_chunks} chunks")
+        logging.info(f"Completed importing data: {total_inserted} total records inserted, {total_malformed} malformed rows skipped")
+        if failed_chunks:
+            logging.error(f"{failed_chunks} chunks failed. Run the script again to retry only the failed chunks.")
+            sys.exit(1)
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         sys.exit(1)
@@ -3,95 +3,140 @@ import os
 import json
 import logging
 import pandas as pd
-from sqlalchemy import create_engine
+from day_runner import configured_dates, get_engine, run_days
+from partitioning import day_condition
+from parquet_store import read_points
+from zone_cube import check_cube_interval, cube_precision, read_zone_cube
 
 # Display settings
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
-if __name__ == "__main__":
-
-    log_folder = "logs"
-    log_name = os.path.basename(__file__)
-    if not os.path.exists(log_folder):
-        os.makedirs(log_folder)
 
-    # Configure logging
-    logging.basicConfig(
-        filename=f"logs/{log_name}.log",
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
-
-    try:
-        with open("config.json", "r") as file:
-            config = json.load(file)
-
-        dbname = config["database"]["dbname"]
-        user = config["database"]["user"]
-        password = config["database"]["password"]
-        host = config["database"]["host"]
-        port = config["database"]["port"]
-        schema = config["database"]["schema"]
-        table_name = config["database"]["table_name"]
-        zone_filename = config["input_data"]["zone_filename"]
-        zone_column = config["input_data"]["zone_column"]
-        time_interval = config["operation"]["time_interval"]
-        vehicle_id_column = config["operation"]["vehicle_id_column"]
-        zone_id_column = config["operation"]["zone_id_column"]
-        vehicle_class_column = config["operation"]["vehicle_class_column"]
-        vehicle_type = config["operation"]["vehicle_type"]
-        velocity_column = config["operation"]["velocity_column"]
-        output_filename = config["output_data"]["output_filename"]
-        logging.info("Config file loaded successfully.")
-    except FileNotFoundError:
-        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
-
-    # Database connection details
-    DB_PARAMS = {
-        "dbname": dbname,
-        "user": user,
-        "password": password,
-        "host": host,
-        "port": port
-    }
-
-    data_path = os.path.join("data", zone_filename)
-    zones = pd.read_csv(data_path)
+# Function to build the columns of one zone
+def zone_columns(grouped, zone_id, zones, full_time_range) -> pd.DataFrame:
+    """
+    Build the V_, MS_, Length, Density_ and Flow_ columns of one zone from its binned statistics
+    :param grouped: DataFrame with dt, vehicle_numbers and mean_speed per bin, bins may be missing
+    :param zone_id:
+    :param zones:
+    :param full_time_range:
+    :return:
+    """
+    # Merge with full time bins to ensure all 288 rows exist
+    grouped = full_time_range.to_frame(name="dt").merge(grouped, on="dt", how="left").fillna(
+        {"vehicle_numbers": 0, "mean_speed": 0})
+
+    # Convert vehicle_numbers to integer
+    grouped["vehicle_numbers"] = grouped["vehicle_numbers"].astype(int)
+
+    # Rename columns dynamically
+    grouped = grouped.rename(columns={
+        "vehicle_numbers": f"V_{zone_id}",
+        "mean_speed": f"MS_{zone_id}"
+    })
+
+    length_list = float(zones[zones['Zone ID'] == zone_id]['Length(Sum)'].values[0])
+    grouped['Length'] = length_list
+    grouped[f"V_{zone_id}"] = grouped[f"V_{zone_id}"] * 20
+    grouped[f'Density_{zone_id}'] = grouped[f"V_{zone_id}"] / grouped['Length']
+    grouped[f'Flow_{zone_id}'] = grouped[f"MS_{zone_id}"] * grouped[f'Density_{zone_id}']
+
+    return grouped.drop(columns=["dt"])
+
+
+# Function to compute the binned statistics of all zones of a day in the database
+def query_zone_bins(engine, config, selected_date, zone_ids) -> pd.DataFrame:
+    """
+    Compute the distinct vehicle count and the speed sum and count per zone and bin with one
+    grouped query, so only one row per zone and bin is transferred instead of every point
+    :param engine:
+    :param config:
+    :param selected_date:
+    :param zone_ids:
+    :return: DataFrame with zone_id, dt, vehicle_numbers and mean_speed
+    """
+    operation = config["operation"]
+    bin_seconds = int(pd.Timedelta(operation["time_interval"]).total_seconds())
+    query = f"""
+        SELECT {operation["zone_id_column"]} AS zone_id,
+               date_bin(INTERVAL '{bin_seconds} seconds', dt, TIMESTAMP '{selected_date} 00:00:00') AS dt,
+               COUNT(DISTINCT {operation["vehicle_id_column"]}) AS vehicle_numbers,
+               SUM({operation["velocity_column"]}) AS speed_sum,
+               COUNT({operation["velocity_column"]}) AS speed_count
+        FROM {config["database"]["schema"]}.{config["database"]["point_table"]}
+        WHERE {day_condition(selected_date)} AND {operation["vehicle_class_column"]} = '{operation["vehicle_type"]}'
+          AND {operation["zone_id_column"]} IN ({", ".join(str(zone_id) for zone_id in zone_ids)})
+        GROUP BY 1, 2;
+    """
+    bins = pd.read_sql(query, engine)
+    bins["dt"] = pd.to_datetime(bins["dt"])
+
+    # The mean speed is computed from the exact integer sum, as pandas does
+    bins["mean_speed"] = bins["speed_sum"].astype(float) / bins["speed_count"]
+
+    return bins[["zone_id", "dt", "vehicle_numbers", "mean_speed"]]
+
+
+# Function to process one day
+def process_day(selected_date, config, zones) -> int:
+    """
+    Compute the zone time series of one day and save them to '<date>_<output_filename>.csv'
+    :param selected_date:
+    :param config:
+    :param zones:
+    :return: the number of rows written
+    """
+    engine = get_engine()
+    schema = config["database"]["schema"]
+    point_table = config["database"]["point_table"]
+    zone_column = config["input_data"]["zone_column"]
+    dataset_path = os.path.join("data", config["input_data"]["parquet_dataset"])
+    time_interval = config["operation"]["time_interval"]
+    aggregation = config["operation"]["aggregation"]
+    source = config["operation"]["source"]
+    vehicle_id_column = config["operation"]["vehicle_id_column"]
+    zone_id_column = config["operation"]["zone_id_column"]
+    vehicle_class_column = config["operation"]["vehicle_class_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    velocity_column = config["operation"]["velocity_column"]
+    output_filename = config["output_data"]["output_filename"]
     zone_ids = zones[zone_column].tolist()
 
-    # Create SQLAlchemy engine
-    engine = create_engine(
-        f"postgresql://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}")
-
-    for i in range(1, 31):
-        # Set the full 5-minute bins for a 24-hour period
-        table_name = config["database"]["table_name"]
-        selected_date = "-".join(table_name.split("_")[1:])
-        if i < 10:
-            selected_date = f"{selected_date}-0{i}"
-            table_name = f"{table_name}_0{i}"
+    # Set the full 5-minute bins for a 24-hour period
+    full_time_range = pd.date_range(start=f"{selected_date} 00:00:00", end=f"{selected_date} 23:55:00", freq=time_interval)
+    final_df = pd.DataFrame({"dt": full_time_range})
+
+    # Create a dictionary to store DataFrames for each zone before merging
+    zone_dfs = []
+
+    # Binned statistics of all zones, read from the zone cube or computed by the database
+    precomputed = source == "cube" or (aggregation == "sql" and source == "database")
+    if source == "cube":
+        # Read the bins maintained by the loader, no point is scanned
+        check_cube_interval(config)
+        bins = read_zone_cube(engine, selected_date, vehicle_type, zone_ids, cube_precision(config))
+        bins["mean_speed"] = bins["speed_sum"].astype(float) / bins["point_count"]
+    elif precomputed:
+        # Compute vehicle count and speed sums per zone and bin in a single grouped query
+        bins = query_zone_bins(engine, config, selected_date, zone_ids)
+
+    # Process each zone separately
+    for zone_id in zone_ids:
+        if precomputed:
+            grouped = bins.loc[bins["zone_id"] == zone_id, ["dt", "vehicle_numbers", "mean_speed"]]
         else:
-            selected_date = f"{selected_date}-{i}"
-            table_name = f"{table_name}_{i}"
-
-        full_time_range = pd.date_range(start=f"{selected_date} 00:00:00", end=f"{selected_date} 23:55:00", freq=time_interval)
-        final_df = pd.DataFrame({"dt": full_time_range})
-
-        # Create a dictionary to store DataFrames for each zone before merging
-        zone_dfs = []
-
-        # Process each zone separately
-        for zone_id in zone_ids:
             query = f"""
                 SELECT dt, {vehicle_id_column}, {velocity_column}
-                FROM {schema}."{table_name}"
-                WHERE {zone_id_column} = {zone_id} AND {vehicle_class_column} = '{vehicle_type}';
+                FROM {schema}.{point_table}
+                WHERE {day_condition(selected_date)} AND {zone_id_column} = {zone_id} AND {vehicle_class_column} = '{vehicle_type}';
             """
 
             # Load data for this zone
-            df = pd.read_sql(query, engine)
+            if source == "parquet":
+                df = read_points(dataset_path, columns=["dt", vehicle_id_column, velocity_column], dates=selected_date, zone_ids=[zone_id], vehicle_class=vehicle_type)
+            else:
+                df = pd.read_sql(query, engine)
 
             # Convert 'dt' column to datetime
             df["dt"] = pd.to_datetime(df["dt"])
@@ -105,35 +150,51 @@ if __name__ == "__main__":
                 mean_speed=(velocity_column, "mean")
             ).reset_index()
 
-            # Merge with full time bins to ensure all 288 rows exist
-            grouped = full_time_range.to_frame(name="dt").merge(grouped, on="dt", how="left").fillna(
-                {"vehicle_numbers": 0, "mean_speed": 0})
+        # Store the processed DataFrame for later concatenation
+        zone_dfs.append(zone_columns(grouped, zone_id, zones, full_time_range))
+
+    # Merge all zone data into final_df efficiently
+    final_df = pd.concat([final_df] + zone_dfs, axis=1)
+
+    # Save the final DataFrame
+    selected_date_output_filename = f"{selected_date}_{output_filename}.csv"
+    output_file_path = os.path.join("data", selected_date_output_filename)
+    final_df.to_csv(output_file_path, index=False)
+
+    return len(final_df)
+
+
+if __name__ == "__main__":
 
-            # Convert vehicle_numbers to integer
-            grouped["vehicle_numbers"] = grouped["vehicle_numbers"].astype(int)
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
 
-            # Rename columns dynamically
-            grouped = grouped.rename(columns={
-                "vehicle_numbers": f"V_{zone_id}",
-                "mean_speed": f"MS_{zone_id}"
-            })
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
 
-            length_list = float(zones[zones['Zone ID'] == zone_id]['Length(Sum)'].values[0])
-            grouped['Length'] = length_list
-            grouped[f"V_{zone_id}"] = grouped[f"V_{zone_id}"] * 20
-            grouped[f'Density_{zone_id}'] = grouped[f"V_{zone_id}"] / grouped['Length']
-            grouped[f'Flow_{zone_id}'] = grouped[f"MS_{zone_id}"] * grouped[f'Density_{zone_id}']
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
 
-            grouped = grouped.drop(columns=["dt"])
-            # Store the processed DataFrame for later concatenation
-            zone_dfs.append(grouped)
+        zone_filename = config["input_data"]["zone_filename"]
+        output_filename = config["output_data"]["output_filename"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
 
-        # Merge all zone data into final_df efficiently
-        final_df = pd.concat([final_df] + zone_dfs, axis=1)
+    data_path = os.path.join("data", zone_filename)
+    zones = pd.read_csv(data_path)
 
-        # Save the final DataFrame
-        selected_date_output_filename = f"{selected_date}_{output_filename}.csv"
-        output_file_path = os.path.join("data", selected_date_output_filename)
-        final_df.to_csv(output_file_path, index=False)
+    # Process the configured days, in parallel when several workers are configured
+    dates = configured_dates(config)
+    row_counts = run_days(process_day, config, dates, zones=zones)
 
-        logging.info(f"CSV file '{output_filename}' has been created with {len(final_df)} rows, including mean speed values.")
+    for selected_date, rows in zip(dates, row_counts):
+        logging.info(f"CSV file '{selected_date}_{output_filename}.csv' has been created with {rows} rows, including mean speed values.")
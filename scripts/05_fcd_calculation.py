@@ -2,9 +2,15 @@
 import os
 import json
 import logging
-import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+import hll
+from day_runner import configured_dates, get_engine, run_days
+from partitioning import day_condition
+from parquet_store import read_points
+from zone_cube import cube_precision, read_link_cube_stats
+from speed_cube import ensure_link_index, write_speed_cube
+from fcd_store import write_fcd_day
+from fcd_engine import check_rollup_interval, fcd_all_zones, interval_hours, link_stats_from_points, rollup_link_stats
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -12,6 +18,175 @@ warnings.filterwarnings("ignore")
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
+
+# Function to compute the link statistics of all zones of a day in the database
+def query_link_stats(engine, config, selected_date, zone_ids, stats_interval, precision=None) -> pd.DataFrame:
+    """
+    Compute the speed sum, the point count and the distinct vehicles per zone, bin and link with one
+    grouped query, so only one row per link and bin is transferred instead of every point. The vehicles
+    are the sorted vehicle ids, or with a precision their HyperLogLog sketch, built in the database from
+    the entry of every distinct vehicle of the day so that only the sketches are transferred.
+    :param engine:
+    :param config:
+    :param selected_date:
+    :param zone_ids:
+    :param stats_interval:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are read if None
+    :return: DataFrame with zone_id, interval, fid, speed_sum, point_count and vehicles
+    """
+    operation = config["operation"]
+    bin_seconds = int(pd.Timedelta(stats_interval).total_seconds())
+    vehicle_bins = f"""
+        SELECT {operation["zone_id_column"]} AS zone_id,
+               date_bin(INTERVAL '{bin_seconds} seconds', dt, TIMESTAMP '{selected_date} 00:00:00') AS bin,
+               {operation["fid_column"]} AS fid,
+               {operation["vehicle_id_column"]} AS vehicle_id,
+               SUM({operation["velocity_column"]}) AS speed_sum,
+               COUNT({operation["velocity_column"]}) AS point_count
+        FROM {config["database"]["schema"]}.{config["database"]["point_table"]}
+        WHERE {day_condition(selected_date)} AND {operation["vehicle_class_column"]} = '{operation["vehicle_type"]}'
+          AND {operation["zone_id_column"]} IN ({", ".join(str(zone_id) for zone_id in zone_ids)})
+        GROUP BY 1, 2, 3, 4
+    """
+
+    if precision is None:
+        query = f"""
+            SELECT zone_id, bin AS interval, fid, SUM(speed_sum) AS speed_sum, SUM(point_count) AS point_count,
+                   ARRAY_AGG(vehicle_id ORDER BY vehicle_id) AS vehicles
+            FROM ({vehicle_bins}) vehicle_bins
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, 3;
+        """
+    else:
+        # Keep the largest entry of every register of every link and bin, then gather the sketches
+        query = f"""
+            WITH vehicle_bins AS ({vehicle_bins}),
+            entries AS ({hll.sql_packed_entries("SELECT DISTINCT vehicle_id AS id FROM vehicle_bins", precision)}),
+            registers AS (
+                SELECT zone_id, bin, fid, SUM(speed_sum) AS speed_sum, SUM(point_count) AS point_count, MAX(entry) AS entry
+                FROM vehicle_bins JOIN entries ON entries.id = vehicle_bins.vehicle_id
+                GROUP BY zone_id, bin, fid, entry >> {hll.RANK_BITS}
+            )
+            SELECT zone_id, bin AS interval, fid, SUM(speed_sum) AS speed_sum, SUM(point_count) AS point_count,
+                   ARRAY_AGG(entry ORDER BY entry) AS vehicles
+            FROM registers
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, 3;
+        """
+
+    stats = pd.read_sql(query, engine)
+    stats["interval"] = pd.to_datetime(stats["interval"])
+    return stats
+
+
+# Function to name the link statistics file of a day
+def link_stats_path(selected_date, stats_interval, precision) -> str:
+    """
+    Path of the stored link statistics of a day, named after their interval and distinct count mode
+    :param selected_date:
+    :param stats_interval:
+    :param precision:
+    :return:
+    """
+    mode = "exact" if precision is None else f"hll{precision}"
+    return os.path.join("data", "link_stats", f"link_stats_{selected_date}_{stats_interval}_{mode}.parquet")
+
+
+# Function to process one day
+def process_day(selected_date, config, zones, links) -> int:
+    """
+    Compute the link statistics of one day once, then the FCD speed, flow and density of every zone for
+    "time_interval" and every interval of "fcd_intervals", saved in one batch per interval to the FCD store
+    or, with "fcd_output": "csv", to 'data/fcd/fcd_<zone>_<date>.csv' and 'data/fcd_<interval>/fcd_<zone>_<date>.csv'.
+    The link-level bins are kept in the speed cube if enabled.
+    :param selected_date:
+    :param config:
+    :param zones:
+    :param links:
+    :return: the number of zones
+    """
+    engine = get_engine()
+    schema = config["database"]["schema"]
+    point_table = config["database"]["point_table"]
+    zone_column = config["input_data"]["zone_column"]
+    dataset_path = os.path.join("data", config["input_data"]["parquet_dataset"])
+    time_interval = config["operation"]["time_interval"]
+    stats_interval = config["operation"]["stats_interval"]
+    fcd_intervals = config["operation"]["fcd_intervals"]
+    speed_cube = config["operation"]["speed_cube"]
+    fcd_output = config["output_data"]["fcd_output"]
+    source = config["operation"]["source"]
+    aggregation = config["operation"]["aggregation"]
+    vehicle_id_column = config["operation"]["vehicle_id_column"]
+    zone_id_column = config["operation"]["zone_id_column"]
+    fid_column = config["operation"]["fid_column"]
+    vehicle_class_column = config["operation"]["vehicle_class_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    velocity_column = config["operation"]["velocity_column"]
+    precision = cube_precision(config)
+    zone_ids = zones[zone_column].tolist()
+    stats_path = link_stats_path(selected_date, stats_interval, precision)
+
+    # Speed sum, point count and distinct vehicles of every link and interval of all zones
+    if source == "link_stats":
+        # Reuse the statistics stored by a previous run, no point is scanned
+        stats = pd.read_parquet(stats_path)
+        stats = stats[stats["zone_id"].isin(zone_ids)]
+    elif source == "cube":
+        # Read the link bins maintained by the loader, no point is scanned
+        stats_interval = config["input_data"]["cube_interval"]
+        stats = read_link_cube_stats(engine, selected_date, vehicle_type, zone_ids, precision)
+    else:
+        if aggregation == "sql" and source == "database":
+            stats = query_link_stats(engine, config, selected_date, zone_ids, stats_interval, precision)
+        else:
+            query = f"""
+                        SELECT dt, {zone_id_column}, {vehicle_id_column}, {velocity_column}, {fid_column}
+                        FROM {schema}.{point_table}
+                        WHERE {day_condition(selected_date)} AND {zone_id_column} IN ({", ".join(str(zone_id) for zone_id in zone_ids)}) AND {vehicle_class_column} = '{vehicle_type}';
+                    """
+
+            # Load the points of all zones
+            if source == "parquet":
+                df = read_points(dataset_path, columns=["dt", zone_id_column, vehicle_id_column, velocity_column, fid_column], dates=selected_date, zone_ids=zone_ids, vehicle_class=vehicle_type)
+            else:
+                df = pd.read_sql(query, engine)
+
+            df = df.rename(columns={zone_id_column: "zone_id", fid_column: "fid"})
+            stats = link_stats_from_points(df, stats_interval, vehicle_id_column, velocity_column, precision)
+
+        # Store the statistics so that other intervals can be computed later with "source": "link_stats"
+        os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+        stats.to_parquet(stats_path, index=False)
+
+    # Several days may create the folders at the same time
+    outputs = [(time_interval, "data/fcd")] + [(interval, f"data/fcd_{interval}") for interval in fcd_intervals]
+    for interval, folder in outputs:
+        check_rollup_interval(interval, stats_interval)
+
+        # Compute the FCD of all zones and intervals in one pass
+        link_bins = rollup_link_stats(stats, interval, precision)
+        results = fcd_all_zones(link_bins, links, interval_hours(interval))
+
+        if fcd_output == "store":
+            # Save all zones of the day in one file of the FCD store
+            write_fcd_day(results, selected_date, interval)
+        else:
+            zone_results = dict(tuple(results.groupby("zone_id", sort=False)))
+            os.makedirs(folder, exist_ok=True)
+
+            # Save one file per zone, zones without points get an empty file
+            for zone_id in zone_ids:
+                final_df = zone_results.get(zone_id, results.iloc[0:0])
+                final_df.to_csv(os.path.join(folder, "fcd_" + str(zone_id) + "_" + selected_date + ".csv"), index=False)
+
+        # Keep the speed and vehicles of every link, merged over the zones it crosses
+        if speed_cube:
+            write_speed_cube(rollup_link_stats(stats, interval, precision, keys=["interval", "fid"]), selected_date, interval)
+
+    return len(zone_ids)
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -31,126 +206,22 @@ if __name__ == "__main__":
         with open("config.json", "r") as file:
             config = json.load(file)
 
-        dbname = config["database"]["dbname"]
-        user = config["database"]["user"]
-        password = config["database"]["password"]
-        host = config["database"]["host"]
-        port = config["database"]["port"]
-        schema = config["database"]["schema"]
-        table_name = config["database"]["table_name"]
         zone_filename = config["input_data"]["zone_filename"]
-        zone_column = config["input_data"]["zone_column"]
-        time_interval = config["operation"]["time_interval"]
-        vehicle_id_column = config["operation"]["vehicle_id_column"]
-        zone_id_column = config["operation"]["zone_id_column"]
-        fid_column = config["operation"]["fid_column"]
-        vehicle_class_column = config["operation"]["vehicle_class_column"]
-        vehicle_type = config["operation"]["vehicle_type"]
-        velocity_column = config["operation"]["velocity_column"]
-        output_filename = config["output_data"]["output_filename"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
 
-    # Database connection details
-    DB_PARAMS = {
-        "dbname": dbname,
-        "user": user,
-        "password": password,
-        "host": host,
-        "port": port
-    }
-
     data_path = os.path.join("data", zone_filename)
     links = pd.read_csv(os.path.join("data", "links.csv"))
     zones = pd.read_csv(data_path)
-    zone_ids = zones[zone_column].tolist()
-
-    # Create SQLAlchemy engine
-    engine = create_engine(
-        f"postgresql://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}")
-
-    for i in range(1, 31):
-        # Set the full 5-minute bins for a 24-hour period
-        table_name = config["database"]["table_name"]
-        selected_date = "-".join(table_name.split("_")[1:])
-        if i < 10:
-            selected_date = f"{selected_date}-0{i}"
-            table_name = f"{table_name}_0{i}"
-        else:
-            selected_date = f"{selected_date}-{i}"
-            table_name = f"{table_name}_{i}"
-
-        # Process each zone separately
-        for zone_id in zone_ids:
-            query = f"""
-                        SELECT dt, {vehicle_id_column}, {velocity_column}, {fid_column}
-                        FROM {schema}."{table_name}"
-                        WHERE {zone_id_column} = {zone_id} AND {vehicle_class_column} = '{vehicle_type}'
-                        order by dt;
-                    """
-
-            # Load data for this zone
-            df = pd.read_sql(query, engine)
-
-            # Convert 'dt' column to datetime
-            df["dt"] = pd.to_datetime(df["dt"])
-
-            # Ensure vehicle_id is treated as a string
-            df[vehicle_id_column] = df[vehicle_id_column].astype(str)
-
-            df = df.merge(links[['ID', 'Length']], left_on='fid', right_on='ID', how='left')
-
-            df['interval'] = df['dt'].dt.floor(time_interval)
-
-            avg_speed_df = df.groupby(['interval', fid_column])[velocity_column].mean().reset_index()
-
-            # Rename the velocity column to 'avg_speed' for clarity
-            avg_speed_df.rename(columns={velocity_column: 'avg_speed'}, inplace=True)
-
-            # Display the result
-            avg_speed_df = avg_speed_df.merge(links[['ID', 'Length']], left_on=fid_column, right_on='ID', how='left')
-
-            avg_speed_df.drop(columns=['ID'], inplace=True)
-
-            weighted_avg_df = (
-                avg_speed_df[['interval', 'avg_speed', 'Length']]
-                .groupby('interval')
-                .apply(lambda group: (group['avg_speed'] * group['Length']).sum() / group['Length'].sum())
-                .reset_index(name='fcd_speed')
-            )
-
-            unique_vehicle_counts = df.groupby(['interval', 'fid'])['vehicle_id'].nunique().reset_index(
-                name='unique_vehicle_count')
-
-            unique_vehicle_counts = unique_vehicle_counts.merge(avg_speed_df, on=['interval', 'fid'], how='left')
-            unique_vehicle_counts['Length'] = unique_vehicle_counts['Length'] / 1000
-
-            unique_vehicle_counts['max'] = np.maximum(
-                unique_vehicle_counts['unique_vehicle_count'] * unique_vehicle_counts['Length'],
-                unique_vehicle_counts['avg_speed'] * (1/12)
-            )
-
-            # Using groupby to sum 'max' and 'Length' for each interval
-            grouped = unique_vehicle_counts.groupby('interval').agg({'max': 'sum', 'Length': 'sum'}).reset_index()
-
-            # Compute the ratio: sum of 'max' divided by sum of 'Length' for each interval
-            grouped['fcd_flow'] = grouped['max'] / (grouped['Length'] * (1/12))
-
-            final_df = grouped.merge(weighted_avg_df, on='interval', how='left')
-
-            final_df['zone_id'] = zone_id
-
-            final_df = final_df[['zone_id', 'interval', 'fcd_speed', 'fcd_flow']]
-            final_df['fcd_density'] = final_df['fcd_flow'] / final_df['fcd_speed']
-
-            # Replace inf values with 143
-            final_df['fcd_density'].replace([np.inf, -np.inf], 143, inplace=True)
-
-            if not os.path.exists("data/fcd"):
-                os.makedirs("data/fcd")
-
-            final_df.to_csv("data/fcd/fcd_" + str(zone_id) + "_" + selected_date + ".csv", index=False)
 
+    # The fid index of the speed cube is shared by all days
+    if config["operation"]["speed_cube"]:
+        ensure_link_index(links)
 
+    # Process the configured days, in parallel when several workers are configured
+    dates = configured_dates(config)
+    zone_counts = run_days(process_day, config, dates, zones=zones, links=links)
 
+    for selected_date, zone_count in zip(dates, zone_counts):
+        logging.info(f"FCD of {zone_count} zones has been saved for {selected_date}.")
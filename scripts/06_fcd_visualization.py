@@ -1,13 +1,199 @@
+"""
+Description:
+This script plots the flow-density, flow-speed and speed-density diagrams of every zone from its FCD.
+The FCD of all zones is loaded once, then the zones are rendered in parallel over "workers" processes
+with the non-interactive Agg backend, and every figure is closed after it is saved.
+With "plot_mode": "binned" the points of the configured days are counted in 2D grids, saved to
+'data/fcd_grids' so that periods can be merged, and the diagrams are drawn from the grids.
+"""
+
+# Import the necessary libraries and modules
 import os
 import json
 import logging
+import matplotlib
+matplotlib.use("Agg")
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from matplotlib.colors import LogNorm
+from concurrent.futures import ProcessPoolExecutor
+from day_runner import configured_dates
+from fcd_store import read_fcd, read_fcd_csv
+from fcd_grids import GRID_DIAGRAMS, bin_zone, fit_grid, grid_edges, grid_path, merge_grids, save_grids, zone_grid_paths
 import warnings
 warnings.filterwarnings("ignore")
 
+# Folders of the plots
+PLOT_FOLDERS = ["plots/fcd/flow_density", "plots/fcd/flow_speed", "plots/fcd/density_speed"]
+
+
+# Function to plot the diagrams of a zone
+def plot_zone(zone, fcd_data) -> int:
+    """
+    Plot and save the flow-density, flow-speed and speed-density diagrams of a zone, closing every figure
+    :param zone:
+    :param fcd_data: DataFrame with the fcd_speed, fcd_flow and fcd_density of the zone
+    :return: the number of plotted points
+    """
+    # Scatter plot of flow vs. density
+    fig, ax = plt.subplots(figsize=(14, 9))
+    sns.scatterplot(data=fcd_data, x='fcd_density', y='fcd_flow', alpha=0.6, ax=ax)
+
+    # Fit a polynomial (e.g., degree 2 or 3)
+    degree = 2  # or try 3 for more curvature
+    x = fcd_data['fcd_density']
+    y = fcd_data['fcd_flow']
+    coeffs = np.polyfit(x, y, degree)
+    poly_eq = np.poly1d(coeffs)
+
+    # Generate x values and compute predicted y values
+    x_vals = np.linspace(x.min(), x.max(), 500)
+    y_vals = poly_eq(x_vals)
+
+    # Plot the polynomial trend line
+    ax.plot(x_vals, y_vals, color='orange', linewidth=2, label='Polynomial Trend (Degree 2)')
+
+    # Title and labels
+    ax.set_title('Flow-Density Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Density (veh/km)')
+    ax.set_ylabel('Flow (veh/hour)')
+    ax.grid(True)
+    ax.legend()
+
+    # Save and release the plot
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/flow_density/Zone_{zone}.png")
+    plt.close(fig)
+
+    # Scatter plot of speed vs. flow
+    fig, ax = plt.subplots(figsize=(14, 9))
+    sns.scatterplot(data=fcd_data, x='fcd_flow', y='fcd_speed', alpha=0.6, ax=ax)
+
+    # Title and labels
+    ax.set_title('Flow-Speed Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Flow (veh/hour)')
+    ax.set_ylabel('Speed (km/h)')
+    ax.grid(True)
+    ax.legend()
+
+    # Save and release the plot
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/flow_speed/Zone_{zone}.png")
+    plt.close(fig)
+
+    # Scatter plot of speed vs. density
+    fig, ax = plt.subplots(figsize=(14, 9))
+    sns.scatterplot(data=fcd_data, x='fcd_density', y='fcd_speed', alpha=0.6, ax=ax)
+
+    # Fit a linear regression model
+    x = fcd_data['fcd_density']
+    y = fcd_data['fcd_speed']
+
+    coeffs = np.polyfit(x, y, 1)
+    poly_eq = np.poly1d(coeffs)
+
+    # Generate x values and compute predicted y values
+    x_vals = np.linspace(x.min(), x.max(), 500)
+    y_vals = poly_eq(x_vals)
+
+    # Plot the linear trend line
+    ax.plot(x_vals, y_vals, color='red', linewidth=2, label='Linear Trend')
+
+    # Title and labels
+    ax.set_title('Density-Speed Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Density (veh/km)')
+    ax.set_ylabel('Speed (km/h)')
+    ax.grid(True)
+    ax.legend()
+
+    # Save and release the plot
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/density_speed/Zone_{zone}.png")
+    plt.close(fig)
+
+    return len(fcd_data)
+
+
+# Function to draw a grid of counts
+def draw_grid(fig, ax, counts, diagram, degree=None, color=None, label=None) -> None:
+    """
+    Draw the cells of a diagram grid colored by their counts, with an optional polynomial trend fitted on the cells
+    :param fig:
+    :param ax:
+    :param counts:
+    :param diagram: name of the diagram in GRID_DIAGRAMS
+    :param degree: degree of the trend, no trend if None
+    :param color:
+    :param label:
+    :return:
+    """
+    x_column, y_column = GRID_DIAGRAMS[diagram]
+    bins = counts.shape[0]
+    mesh = ax.pcolormesh(grid_edges(x_column, bins), grid_edges(y_column, bins), np.ma.masked_equal(counts.T, 0), cmap='viridis', norm=LogNorm())
+    fig.colorbar(mesh, ax=ax, label='Observations')
+
+    # Zoom on the occupied cells
+    x_edges = grid_edges(x_column, bins)
+    y_edges = grid_edges(y_column, bins)
+    x_cells = np.flatnonzero(counts.sum(axis=1))
+    y_cells = np.flatnonzero(counts.sum(axis=0))
+    ax.set_xlim(x_edges[x_cells[0]], x_edges[x_cells[-1] + 1])
+    ax.set_ylim(y_edges[y_cells[0]], y_edges[y_cells[-1] + 1])
+
+    if degree is not None:
+        # Plot the trend over the occupied cells
+        x_vals = np.linspace(x_edges[x_cells[0]], x_edges[x_cells[-1] + 1], 500)
+        ax.plot(x_vals, fit_grid(counts, x_column, y_column, degree)(x_vals), color=color, linewidth=2, label=label)
+
+
+# Function to plot the binned diagrams of a zone
+def plot_zone_grid(zone, grids) -> int:
+    """
+    Plot and save the flow-density, flow-speed and speed-density diagrams of a zone from its grids, closing every figure
+    :param zone:
+    :param grids: dict of diagram name to counts, from bin_zone or merge_grids
+    :return: the number of binned points
+    """
+    # Binned flow vs. density with a polynomial trend
+    fig, ax = plt.subplots(figsize=(14, 9))
+    draw_grid(fig, ax, grids['flow_density'], 'flow_density', 2, 'orange', 'Polynomial Trend (Degree 2)')
+    ax.set_title('Flow-Density Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Density (veh/km)')
+    ax.set_ylabel('Flow (veh/hour)')
+    ax.grid(True)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/flow_density/Zone_{zone}.png")
+    plt.close(fig)
+
+    # Binned speed vs. flow
+    fig, ax = plt.subplots(figsize=(14, 9))
+    draw_grid(fig, ax, grids['flow_speed'], 'flow_speed')
+    ax.set_title('Flow-Speed Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Flow (veh/hour)')
+    ax.set_ylabel('Speed (km/h)')
+    ax.grid(True)
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/flow_speed/Zone_{zone}.png")
+    plt.close(fig)
+
+    # Binned speed vs. density with a linear trend
+    fig, ax = plt.subplots(figsize=(14, 9))
+    draw_grid(fig, ax, grids['density_speed'], 'density_speed', 1, 'red', 'Linear Trend')
+    ax.set_title('Density-Speed Diagram for Zone ' + str(zone))
+    ax.set_xlabel('Density (veh/km)')
+    ax.set_ylabel('Speed (km/h)')
+    ax.grid(True)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(f"plots/fcd/density_speed/Zone_{zone}.png")
+    plt.close(fig)
+
+    return int(grids['flow_density'].sum())
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -37,6 +223,7 @@ if __name__ == "__main__":
         zone_filename = config["input_data"]["zone_filename"]
         zone_column = config["input_data"]["zone_column"]
         time_interval = config["operation"]["time_interval"]
+        workers = config["operation"]["workers"]
         vehicle_id_column = config["operation"]["vehicle_id_column"]
         zone_id_column = config["operation"]["zone_id_column"]
         fid_column = config["operation"]["fid_column"]
@@ -44,6 +231,10 @@ if __name__ == "__main__":
         vehicle_type = config["operation"]["vehicle_type"]
         velocity_column = config["operation"]["velocity_column"]
         output_filename = config["output_data"]["output_filename"]
+        fcd_output = config["output_data"]["fcd_output"]
+        plot_mode = config["output_data"]["plot_mode"]
+        grid_bins = config["output_data"]["grid_bins"]
+        merge_saved_grids = config["output_data"]["merge_grids"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
@@ -52,102 +243,53 @@ if __name__ == "__main__":
     links = pd.read_csv(os.path.join("data", "links.csv"))
     zones = pd.read_csv(data_path)
     zone_ids = zones[zone_column].tolist()
+    plot_columns = ['zone_id', 'fcd_speed', 'fcd_flow', 'fcd_density']
+
+    # The grids are built for the configured days, the scatter plots use all the days
+    dates = configured_dates(config) if plot_mode == "binned" else None
+
+    if fcd_output == "store":
+        # Load the plotted columns of all zones and days in one scan
+        fcd_all = read_fcd(time_interval, zone_ids=zone_ids, dates=dates, columns=plot_columns)
+    else:
+        # List the zone files once and read only the plotted columns
+        fcd_all = read_fcd_csv("data/fcd", zone_ids=zone_ids, dates=dates, columns=plot_columns)
 
+    fcd_all = fcd_all[(fcd_all['fcd_density'] <= 150) & (fcd_all['fcd_flow'] <= 3600)]
+    zone_data = dict(tuple(fcd_all.groupby('zone_id', sort=False)))
+
+    # Zones without FCD are skipped
+    plotted = []
     for zone in zone_ids:
-        fcd_list = []
-        for root, dirs, files in os.walk("data/fcd"):
-            for file in files:
-                if file.startswith(f"fcd_{zone}_"):
-                    fcd = pd.read_csv(os.path.join(root, file))
-                    fcd = fcd[fcd['fcd_density'] <= 150]
-                    fcd = fcd[fcd['fcd_flow'] <= 3600]
-                    fcd_list.append(fcd)
-
-        fcd_data = pd.concat(fcd_list)
-
-        # Scatter plot of flow vs. density
-        plt.figure(figsize=(14, 9))
-        sns.scatterplot(data=fcd_data, x='fcd_density', y='fcd_flow', alpha=0.6)
-
-        # Fit a polynomial (e.g., degree 2 or 3)
-        degree = 2  # or try 3 for more curvature
-        x = fcd_data['fcd_density']
-        y = fcd_data['fcd_flow']
-        coeffs = np.polyfit(x, y, degree)
-        poly_eq = np.poly1d(coeffs)
-
-        # Generate x values and compute predicted y values
-        x_vals = np.linspace(x.min(), x.max(), 500)
-        y_vals = poly_eq(x_vals)
-
-        # Plot the polynomial trend line
-        plt.plot(x_vals, y_vals, color='orange', linewidth=2, label='Polynomial Trend (Degree 2)')
-
-        # Title and labels
-        plt.title('Flow-Density Diagram for Zone ' + str(zone))
-        plt.xlabel('Density (veh/km)')
-        plt.ylabel('Flow (veh/hour)')
-        plt.grid(True)
-        plt.legend()
-
-        # Save the plot
-        if not os.path.exists("plots/fcd/flow_density"):
-            os.makedirs("plots/fcd/flow_density")
-
-        plt.tight_layout()
-        plt.savefig(f"plots/fcd/flow_density/Zone_{zone}.png")
-        # plt.show()
-
-        # Scatter plot of speed vs. flow
-        plt.figure(figsize=(14, 9))
-        sns.scatterplot(data=fcd_data, x='fcd_flow', y='fcd_speed', alpha=0.6)
-
-        # Title and labels
-        plt.title('Flow-Speed Diagram for Zone ' + str(zone))
-        plt.xlabel('Flow (veh/hour)')
-        plt.ylabel('Speed (km/h)')
-        plt.grid(True)
-        plt.legend()
-
-        # Save the plot
-        if not os.path.exists("plots/fcd/flow_speed"):
-            os.makedirs("plots/fcd/flow_speed")
-
-        plt.tight_layout()
-        plt.savefig(f"plots/fcd/flow_speed/Zone_{zone}.png")
-        # plt.show()
-
-        logging.info("Flow-Density and Flow-Speed plots generated successfully.")
-
-        # Scatter plot of speed vs. density
-        plt.figure(figsize=(14, 9))
-
-        sns.scatterplot(data=fcd_data, x='fcd_density', y='fcd_speed', alpha=0.6)
-
-        # Fit a linear regression model
-        x = fcd_data['fcd_density']
-        y = fcd_data['fcd_speed']
-
-        coeffs = np.polyfit(x, y, 1)
-        poly_eq = np.poly1d(coeffs)
-
-        # Generate x values and compute predicted y values
-        x_vals = np.linspace(x.min(), x.max(), 500)
-        y_vals = poly_eq(x_vals)
-
-        # Plot the linear trend line
-        plt.plot(x_vals, y_vals, color='red', linewidth=2, label='Linear Trend')
-
-        # Title and labels
-        plt.title('Density-Speed Diagram for Zone ' + str(zone))
-        plt.xlabel('Density (veh/km)')
-        plt.ylabel('Speed (km/h)')
-        plt.grid(True)
-        plt.legend()
-
-        # Save the plot
-        if not os.path.exists("plots/fcd/density_speed"):
-            os.makedirs("plots/fcd/density_speed")
-
-        plt.tight_layout()
-        plt.savefig(f"plots/fcd/density_speed/Zone_{zone}.png")
\ No newline at end of file
+        if zone in zone_data:
+            plotted.append(zone)
+        else:
+            logging.warning(f"No FCD data found for zone {zone}.")
+
+    for folder in PLOT_FOLDERS:
+        os.makedirs(folder, exist_ok=True)
+
+    if plot_mode == "binned":
+        # Count the points of every zone in the grids and save them for the period
+        start_date, end_date = dates[0], dates[-1]
+        zone_inputs = []
+        for zone in plotted:
+            grids = bin_zone(zone_data[zone], grid_bins)
+            save_grids(grids, grid_path(zone, start_date, end_date))
+
+            # Add the grids of the other saved periods
+            zone_inputs.append(merge_grids(zone_grid_paths(zone)) if merge_saved_grids else grids)
+        render = plot_zone_grid
+    else:
+        zone_inputs = [zone_data[zone] for zone in plotted]
+        render = plot_zone
+
+    # Render the zones in parallel, every zone gets its data loaded above
+    if workers <= 1:
+        point_counts = [render(zone, zone_input) for zone, zone_input in zip(plotted, zone_inputs)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            point_counts = list(executor.map(render, plotted, zone_inputs))
+
+    for zone, point_count in zip(plotted, point_counts):
+        logging.info(f"Flow-Density, Flow-Speed and Density-Speed plots of zone {zone} generated from {point_count} points.")
@@ -3,7 +3,9 @@ import os
 import json
 import logging
 import pandas as pd
-from sqlalchemy import create_engine
+from day_runner import configured_dates, get_engine, run_days
+from parquet_store import iter_points
+from dense_links import WINDOW_KEYS, check_window, count_points, merge_counts, query_link_counts, top_links, window_counts
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -12,6 +14,43 @@ warnings.filterwarnings("ignore")
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
+
+# Function to process one day
+def process_day(selected_date, config, zones) -> pd.DataFrame:
+    """
+    Count the points of every link of every zone for one day, per "dense_window"
+    :param selected_date:
+    :param config:
+    :param zones:
+    :return: DataFrame with window, zone_id, fid and count
+    """
+    engine = get_engine()
+    zone_column = config["input_data"]["zone_column"]
+    dataset_path = os.path.join("data", config["input_data"]["parquet_dataset"])
+    source = config["operation"]["source"]
+    dense_window = config["operation"]["dense_window"]
+    link_sketch_size = config["operation"]["link_sketch_size"]
+    zone_id_column = config["operation"]["zone_id_column"]
+    fid_column = config["operation"]["fid_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    zone_ids = zones[zone_column].tolist()
+
+    if source == "parquet":
+        # Stream the points of the files and fold every batch into the counts, kept as a heavy-hitters summary
+        counts = None
+        batches = iter_points(dataset_path, columns=["dt", zone_id_column, fid_column], dates=selected_date, zone_ids=zone_ids, vehicle_class=vehicle_type)
+        for df in batches:
+            df = df.rename(columns={zone_id_column: "zone_id", fid_column: "fid"})
+            batch_counts = window_counts(count_points(df, dense_window), dense_window)
+            counts = merge_counts([batch_counts] if counts is None else [counts, batch_counts], link_sketch_size)
+        if counts is None:
+            counts = pd.DataFrame(columns=WINDOW_KEYS + ["fid", "count"]).astype({"zone_id": "int64", "fid": "int64", "count": "int64"})
+        return counts
+
+    # Grouped counts computed by the database, one row per link and hour or day
+    return window_counts(query_link_counts(engine, config, selected_date, zone_ids, dense_window), dense_window)
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -31,84 +70,26 @@ if __name__ == "__main__":
         with open("config.json", "r") as file:
             config = json.load(file)
 
-        dbname = config["database"]["dbname"]
-        user = config["database"]["user"]
-        password = config["database"]["password"]
-        host = config["database"]["host"]
-        port = config["database"]["port"]
-        schema = config["database"]["schema"]
-        table_name = config["database"]["table_name"]
         zone_filename = config["input_data"]["zone_filename"]
-        zone_column = config["input_data"]["zone_column"]
-        time_interval = config["operation"]["time_interval"]
-        vehicle_id_column = config["operation"]["vehicle_id_column"]
-        zone_id_column = config["operation"]["zone_id_column"]
-        fid_column = config["operation"]["fid_column"]
-        vehicle_class_column = config["operation"]["vehicle_class_column"]
-        vehicle_type = config["operation"]["vehicle_type"]
-        velocity_column = config["operation"]["velocity_column"]
-        output_filename = config["output_data"]["output_filename"]
+        source = config["operation"]["source"]
+        dense_window = config["operation"]["dense_window"]
+        top_k = config["operation"]["top_k"]
+        link_sketch_size = config["operation"]["link_sketch_size"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
 
-    # Database connection details
-    DB_PARAMS = {
-        "dbname": dbname,
-        "user": user,
-        "password": password,
-        "host": host,
-        "port": port
-    }
-
+    check_window(dense_window)
     data_path = os.path.join("data", zone_filename)
-    links = pd.read_csv(os.path.join("data", "links.csv"))
     zones = pd.read_csv(data_path)
-    zone_ids = zones[zone_column].tolist()
 
-    # Create SQLAlchemy engine
-    engine = create_engine(
-        f"postgresql://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}")
-
-    final_data = {}
-    flat_rows = []  # To store flattened rows
-
-    for i in range(1, 31):
-        table_name = config["database"]["table_name"]
-        selected_date = "-".join(table_name.split("_")[1:])
-        if i < 10:
-            selected_date = f"{selected_date}-0{i}"
-            table_name = f"{table_name}_0{i}"
-        else:
-            selected_date = f"{selected_date}-{i}"
-            table_name = f"{table_name}_{i}"
-
-        zones_data = {}
-
-        for zone_id in zone_ids:
-            query = f"""
-                            SELECT dt, {zone_id_column}, {fid_column}
-                            FROM {schema}."{table_name}"
-                            WHERE {zone_id_column} = {zone_id} AND {vehicle_class_column} = '{vehicle_type}'
-                            ORDER BY dt;
-                        """
-            df = pd.read_sql(query, engine)
-            df["dt"] = pd.to_datetime(df["dt"])
-            top_fids = df['fid'].value_counts().head().to_dict()
-            zones_data[zone_id] = top_fids
-
-            # Collect flattened rows
-            for fid, count in top_fids.items():
-                flat_rows.append({
-                    "date": selected_date,
-                    "zone_id": zone_id,
-                    "fid": fid,
-                    "count": count
-                })
-
-        final_data[selected_date] = zones_data
-
-    # Convert the flat list of records to a DataFrame and save as CSV
-    df_flat = pd.DataFrame(flat_rows)
-    df_flat.to_csv("data/dense_links.csv", index=False)
-    logging.info("CSV file saved successfully as 'data/dense_zones_links.csv'.")
+    # Count the configured days, in parallel when several workers are configured
+    day_counts = run_days(process_day, config, configured_dates(config), zones=zones)
+
+    # Merge the days into their windows and keep the top links of every window and zone
+    counts = merge_counts(day_counts, link_sketch_size if source == "parquet" else None)
+    dense_links = top_links(counts, top_k)
+
+    output_file_path = os.path.join("data", f"dense_links_{dense_window}.csv")
+    dense_links.to_csv(output_file_path, index=False)
+    logging.info(f"CSV file saved successfully as '{output_file_path}' with the top {top_k} links of {len(dense_links.groupby(['window', 'zone_id']))} windows and zones.")
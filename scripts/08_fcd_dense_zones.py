@@ -3,7 +3,9 @@ import os
 import json
 import logging
 import pandas as pd
-from sqlalchemy import create_engine
+from day_runner import configured_dates, get_engine, run_days
+from parquet_store import read_points
+from zone_ranking import count_windows, query_window_counts, rank_zones, ranking_windows
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -12,6 +14,42 @@ warnings.filterwarnings("ignore")
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
+
+# Function to process one day
+def process_day(selected_date, config, zones) -> pd.DataFrame:
+    """
+    Rank the zones of one day by distinct vehicles and by points over every ranking window
+    :param selected_date:
+    :param config:
+    :param zones:
+    :return: DataFrame with window_size, window, measure, rank, zone_id and count
+    """
+    engine = get_engine()
+    zone_column = config["input_data"]["zone_column"]
+    dataset_path = os.path.join("data", config["input_data"]["parquet_dataset"])
+    source = config["operation"]["source"]
+    top_k = config["operation"]["top_k"]
+    zone_id_column = config["operation"]["zone_id_column"]
+    vehicle_id_column = config["operation"]["vehicle_id_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    zone_ids = zones[zone_column].tolist()
+
+    if source == "parquet":
+        # Only the time, zone and vehicle of the points are read, once for all the windows
+        df = read_points(dataset_path, columns=["dt", zone_id_column, vehicle_id_column], dates=selected_date, zone_ids=zone_ids, vehicle_class=vehicle_type)
+        df = df.rename(columns={zone_id_column: "zone_id", vehicle_id_column: "vehicle_id"})
+
+    rankings = []
+    for window in ranking_windows(config):
+        if source == "parquet":
+            counts = count_windows(df, selected_date, window)
+        else:
+            counts = query_window_counts(engine, config, selected_date, zone_ids, window)
+        rankings.append(rank_zones(counts, window[0], top_k))
+
+    return pd.concat(rankings, ignore_index=True)
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -31,77 +69,21 @@ if __name__ == "__main__":
         with open("config.json", "r") as file:
             config = json.load(file)
 
-        dbname = config["database"]["dbname"]
-        user = config["database"]["user"]
-        password = config["database"]["password"]
-        host = config["database"]["host"]
-        port = config["database"]["port"]
-        schema = config["database"]["schema"]
-        table_name = config["database"]["table_name"]
         zone_filename = config["input_data"]["zone_filename"]
-        zone_column = config["input_data"]["zone_column"]
-        time_interval = config["operation"]["time_interval"]
-        vehicle_id_column = config["operation"]["vehicle_id_column"]
-        zone_id_column = config["operation"]["zone_id_column"]
-        fid_column = config["operation"]["fid_column"]
-        vehicle_class_column = config["operation"]["vehicle_class_column"]
-        vehicle_type = config["operation"]["vehicle_type"]
-        velocity_column = config["operation"]["velocity_column"]
-        output_filename = config["output_data"]["output_filename"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
 
-    # Database connection details
-    DB_PARAMS = {
-        "dbname": dbname,
-        "user": user,
-        "password": password,
-        "host": host,
-        "port": port
-    }
-
     data_path = os.path.join("data", zone_filename)
-    links = pd.read_csv(os.path.join("data", "links.csv"))
     zones = pd.read_csv(data_path)
-    zone_ids = zones[zone_column].tolist()
 
-    # Create SQLAlchemy engine
-    engine = create_engine(
-        f"postgresql://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}")
+    # Process the configured days, in parallel when several workers are configured
+    rankings = pd.concat(run_days(process_day, config, configured_dates(config), zones=zones), ignore_index=True)
+    rankings.to_csv("data/dense_zones.csv", index=False)
 
-    final_data = {}
-    flat_rows = []  # To store flattened rows
+    # Zones ranked first most often over the peak periods
+    peaks = rankings[rankings["window_size"].isin(config["operation"]["peak_periods"]) & (rankings["rank"] == 1)]
+    for (window_size, measure), leaders in peaks.groupby(["window_size", "measure"]):
+        logging.info(f"Zone {leaders['zone_id'].mode().iloc[0]} leads {window_size} by {measure} on most days.")
 
-    for i in range(1, 31):
-        table_name = config["database"]["table_name"]
-        selected_date = "-".join(table_name.split("_")[1:])
-        if i < 10:
-            selected_date = f"{selected_date}-0{i}"
-            table_name = f"{table_name}_0{i}"
-        else:
-            selected_date = f"{selected_date}-{i}"
-            table_name = f"{table_name}_{i}"
-
-        query = f"""
-                        SELECT dt, {zone_id_column}, {fid_column}
-                        FROM {schema}."{table_name}"
-                        WHERE {vehicle_class_column} = '{vehicle_type}' AND {zone_id_column} in {tuple(zone_ids)}
-                        ORDER BY dt;
-                    """
-        df = pd.read_sql(query, engine)
-        df["dt"] = pd.to_datetime(df["dt"])
-        top_zids = df['zone_id'].value_counts().head().to_dict()
-
-        # Collect flattened rows
-        for zid, count in top_zids.items():
-            flat_rows.append({
-                "date": selected_date,
-                "zone_id": zid,
-                "count": count
-            })
-
-    # Convert the flat list of records to a DataFrame and save as CSV
-    df_flat = pd.DataFrame(flat_rows)
-    df_flat.to_csv("data/dense_zones.csv", index=False)
-    logging.info("CSV file saved successfully as 'data/dense_zones_links.csv'.")
+    logging.info(f"CSV file saved successfully as 'data/dense_zones.csv' with {len(rankings)} rows.")
@@ -3,7 +3,12 @@ import os
 import json
 import logging
 import pandas as pd
-from sqlalchemy import create_engine
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from day_runner import configured_dates, database_url, get_engine, init_worker, iter_days
+from partitioning import day_condition
+from parquet_store import read_points
+from trip_segmentation import close_trips, merge_shards, new_trip_state, segment_trips, stitch_day, trip_ends, vehicle_offsets, vehicle_trip_counts
+from od_output import OD_COLUMNS, OD_FILENAME, POINT_COLUMNS, POINTS_FILENAME, append_rows, number_trips, number_vehicle_trips, output_path
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -11,6 +16,172 @@ warnings.filterwarnings("ignore")
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
+# Segmented shards of the worker process waiting to be written, and the days it is loading ahead
+_segmented = {}
+_prefetched = {}
+_loader = None
+
+
+# Function to load the points of one day
+def load_day(selected_date, config, zones, vehicle_shard=None) -> pd.DataFrame:
+    """
+    Load the points of one day
+    :param selected_date:
+    :param config:
+    :param zones:
+    :param vehicle_shard: (shard, shards) to load only the vehicles whose id modulo shards is shard, in absolute value
+    :return:
+    """
+    engine = get_engine()
+    schema = config["database"]["schema"]
+    point_table = config["database"]["point_table"]
+    zone_column = config["input_data"]["zone_column"]
+    dataset_path = os.path.join("data", config["input_data"]["parquet_dataset"])
+    source = config["operation"]["source"]
+    zone_id_column = config["operation"]["zone_id_column"]
+    vehicle_id_column = config["operation"]["vehicle_id_column"]
+    vehicle_class_column = config["operation"]["vehicle_class_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    zone_ids = zones[zone_column].tolist()
+    shard_condition = "" if vehicle_shard is None else f"AND abs({vehicle_id_column} % {vehicle_shard[1]}) = {vehicle_shard[0]}"
+
+    query = f"""
+                    SELECT *
+                    FROM {schema}.{point_table}
+                    WHERE {day_condition(selected_date)} AND {vehicle_class_column} = '{vehicle_type}' AND {zone_id_column} in {tuple(zone_ids)} {shard_condition}
+                    ORDER BY dt;
+                """
+    if source == "parquet":
+        df = read_points(dataset_path, dates=selected_date, zone_ids=zone_ids, vehicle_class=vehicle_type, vehicle_shard=vehicle_shard)
+        df = df.drop(columns=["date"]).sort_values("dt", kind="stable", ignore_index=True)
+    else:
+        df = pd.read_sql(query, engine)
+    df["dt"] = pd.to_datetime(df["dt"])
+
+    return df
+
+
+# Function to process one day
+def process_day(selected_date, config, zones) -> tuple:
+    """
+    Split the points of one day into trips and extract the origin and destination of every trip
+    :param selected_date:
+    :param config:
+    :param zones:
+    :return: (points with their trip number, one row per trip with origin and destination)
+    """
+    df = load_day(selected_date, config, zones)
+
+    # Split the points into trips and keep the first and last point of every trip
+    df = segment_trips(df, config["operation"]["trip_gap"])
+    temp_df = trip_ends(df)
+
+    return df, temp_df
+
+
+# Function to segment one vehicle shard of one day in a worker process
+def segment_shard_day(selected_date, next_date, config, zones, trip_gap, vehicle_shard) -> tuple:
+    """
+    Load and segment the points of the vehicles of one shard for one day, and keep them in the worker until
+    number_shard_day. The next day of the shard is loaded in the background meanwhile.
+    :param selected_date:
+    :param next_date: the day to load ahead, None for the last day
+    :param config:
+    :param zones:
+    :param trip_gap:
+    :param vehicle_shard: (shard, shards)
+    :return: (sorted vehicle ids, number of trips of every vehicle) of the shard
+    """
+    global _loader
+    if _loader is None:
+        _loader = ThreadPoolExecutor(max_workers=1)
+
+    loading = _prefetched.pop(selected_date, None)
+    df = loading.result() if loading is not None else load_day(selected_date, config, zones, vehicle_shard)
+    if next_date is not None:
+        _prefetched[next_date] = _loader.submit(load_day, next_date, config, zones, vehicle_shard)
+
+    points = segment_trips(df, trip_gap)
+    _segmented[selected_date] = (points, trip_ends(points))
+    return vehicle_trip_counts(_segmented[selected_date][1])
+
+
+# Function to number one vehicle shard of one day in a worker process
+def number_shard_day(selected_date, offsets) -> tuple:
+    """
+    Number the trips segmented by segment_shard_day, the trips of every vehicle after its offset
+    :param selected_date:
+    :param offsets: trip id offset of every vehicle of the shard, in the order of vehicle_trip_counts
+    :return: (points, trips) of the shard with their trip ids, restricted to the output columns
+    """
+    points, od = _segmented.pop(selected_date)
+    number_vehicle_trips(points, od, offsets)
+    return points[POINT_COLUMNS], od[OD_COLUMNS]
+
+
+# Function to segment the configured days over vehicle shards
+def shard_days(config, zones, trip_gap, trip_workers):
+    """
+    Segment every day over "trip_workers" processes, each loading and segmenting the points of its own vehicles.
+    The workers first return the number of trips of every vehicle, from which the trip id offsets of the vehicles
+    are computed as by a serial run, then their numbered trips, merged in vehicle order. The next day is
+    segmented while a day is merged and written.
+    :param config:
+    :param zones:
+    :param trip_gap:
+    :param trip_workers:
+    :return: a generator of (points, trips) per day with their trip ids, in the order of a serial run
+    """
+    dates = configured_dates(config)
+    shards = [(shard, trip_workers) for shard in range(trip_workers)]
+
+    # One single-process pool per shard, so that the process segmenting a shard also numbers it
+    executors = [ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(database_url(config),)) for _ in shards]
+    try:
+        trip_offset = 0
+        segmenting = [executor.submit(segment_shard_day, dates[0], dates[1] if len(dates) > 1 else None, config, zones, trip_gap, shard)
+                      for executor, shard in zip(executors, shards)] if dates else []
+
+        for day_number, selected_date in enumerate(dates):
+            shard_counts = [future.result() for future in segmenting]
+            offsets = vehicle_offsets(shard_counts, trip_offset)
+            numbering = [executor.submit(number_shard_day, selected_date, shard_offsets) for executor, shard_offsets in zip(executors, offsets)]
+
+            # The next day is segmented while this one is merged and written
+            if day_number + 1 < len(dates):
+                next_date = dates[day_number + 2] if day_number + 2 < len(dates) else None
+                segmenting = [executor.submit(segment_shard_day, dates[day_number + 1], next_date, config, zones, trip_gap, shard)
+                              for executor, shard in zip(executors, shards)]
+
+            points, od = merge_shards([future.result() for future in numbering])
+            trip_offset += len(od)
+            logging.info(f"{selected_date}: {len(od)} trips over {trip_workers} vehicle shards.")
+            yield points, od
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+# Function to stitch the trips of the configured days
+def stitch_days(config, zones, trip_gap):
+    """
+    Walk the configured days in order, carrying the open trip of every vehicle to the next day
+    :param config:
+    :param zones:
+    :param trip_gap:
+    :return: a generator of (points, trips) per day, the trips still open after the last day closed with it
+    """
+    state = new_trip_state()
+    dates = configured_dates(config)
+    for day_number, selected_date in enumerate(dates):
+        df, temp_df = stitch_day(state, load_day(selected_date, config, zones), selected_date, trip_gap)
+        logging.info(f"{selected_date}: {len(temp_df)} trips closed, {len(state['open'])} vehicles with an open trip.")
+
+        if day_number == len(dates) - 1:
+            temp_df = pd.concat([temp_df, close_trips(state)], ignore_index=True)
+        yield df, temp_df
+
+
 if __name__ == "__main__":
 
     log_folder = "logs"
@@ -30,142 +201,46 @@ if __name__ == "__main__":
         with open("config.json", "r") as file:
             config = json.load(file)
 
-        dbname = config["database"]["dbname"]
-        user = config["database"]["user"]
-        password = config["database"]["password"]
-        host = config["database"]["host"]
-        port = config["database"]["port"]
-        schema = config["database"]["schema"]
-        table_name = config["database"]["table_name"]
         zone_filename = config["input_data"]["zone_filename"]
-        zone_column = config["input_data"]["zone_column"]
-        time_interval = config["operation"]["time_interval"]
-        vehicle_id_column = config["operation"]["vehicle_id_column"]
-        zone_id_column = config["operation"]["zone_id_column"]
-        fid_column = config["operation"]["fid_column"]
-        vehicle_class_column = config["operation"]["vehicle_class_column"]
-        vehicle_type = config["operation"]["vehicle_type"]
-        velocity_column = config["operation"]["velocity_column"]
-        output_filename = config["output_data"]["output_filename"]
+        trip_gap = config["operation"]["trip_gap"]
+        stitch_trips = config["operation"]["stitch_trips"]
+        trip_workers = config["operation"]["trip_workers"]
+        od_compression = config["output_data"]["od_compression"]
         logging.info("Config file loaded successfully.")
     except FileNotFoundError:
         logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
 
-    # Database connection details
-    DB_PARAMS = {
-        "dbname": dbname,
-        "user": user,
-        "password": password,
-        "host": host,
-        "port": port
-    }
-
     data_path = os.path.join("data", zone_filename)
-    links = pd.read_csv(os.path.join("data", "links.csv"))
     zones = pd.read_csv(data_path)
-    zone_ids = zones[zone_column].tolist()
-
-    # Create SQLAlchemy engine
-    engine = create_engine(
-        f"postgresql://{DB_PARAMS['user']}:{DB_PARAMS['password']}@{DB_PARAMS['host']}:{DB_PARAMS['port']}/{DB_PARAMS['dbname']}")
 
-    df_list = []
-    all_df = []
-
-    for i in range(1, 31):
-        table_name = config["database"]["table_name"]
-        selected_date = "-".join(table_name.split("_")[1:])
-        if i < 10:
-            selected_date = f"{selected_date}-0{i}"
-            table_name = f"{table_name}_0{i}"
+    od_path = output_path(OD_FILENAME, od_compression)
+    points_path = output_path(POINTS_FILENAME, od_compression)
+
+    # Trips and points are written one day at a time, in parallel when several workers are configured
+    sharded = trip_workers > 1 and not stitch_trips
+    if stitch_trips:
+        days = stitch_days(config, zones, trip_gap)
+    elif sharded:
+        days = shard_days(config, zones, trip_gap, trip_workers)
+    else:
+        days = iter_days(process_day, config, configured_dates(config), zones=zones)
+
+    trip_offset = 0
+    point_count = 0
+    for day_number, (df, temp_df) in enumerate(days):
+        if stitch_trips:
+            # Stitched trips are numbered for the whole period already
+            temp_df["trip_id"] = temp_df["trips"]
+            df["trip_id"] = df["trips"]
+            trip_offset += len(temp_df)
+        elif sharded:
+            # Sharded trips are numbered by their workers already
+            trip_offset += len(temp_df)
         else:
-            selected_date = f"{selected_date}-{i}"
-            table_name = f"{table_name}_{i}"
-
-        query = f"""
-                        SELECT *
-                        FROM {schema}."{table_name}"
-                        WHERE {vehicle_class_column} = '{vehicle_type}' AND {zone_id_column} in {tuple(zone_ids)}
-                        ORDER BY dt;
-                    """
-        df = pd.read_sql(query, engine)
-        df["dt"] = pd.to_datetime(df["dt"])
-
-        # Sort by vehicle and time
-        df = df.sort_values(by=['vehicle_id', 'dt'])
-
-        # Compute time difference in seconds
-        df['prev_time'] = df.groupby('vehicle_id')['dt'].shift()
-        df['time_diff'] = (df['dt'] - df['prev_time']).dt.total_seconds()
-
-        # Flag new trips when time difference > 600 seconds (10 minutes)
-        df['is_new_trip'] = (df['time_diff'] > 600) | (df['time_diff'].isna())
-
-        # Assign trip IDs using cumulative sum
-        df['trip_id'] = df.groupby('vehicle_id')['is_new_trip'].cumsum()
-
-        # Step 1: Detect changes in either vehicle_id or trip_id
-        changes = (df['vehicle_id'] != df['vehicle_id'].shift()) | (df['trip_id'] != df['trip_id'].shift())
-
-        # Step 2: Create trip numbers using a cumulative sum
-        df['trips'] = changes.cumsum()
-
-        df = df.groupby('trips').filter(lambda group: len(group) > 1)
-
-        all_df.append(df)
-
-        # Step 1: Get the first and last index per trip
-        first_last_idx = df.groupby('trips').agg(
-            first_idx=('x', lambda x: x.index[0]),
-            last_idx=('x', lambda x: x.index[-1])
-        )
-
-        # Step 2: Select those rows
-        first_rows = df.loc[first_last_idx['first_idx']].copy()
-        last_rows = df.loc[first_last_idx['last_idx']].copy()
-
-        # Step 3: Merge origin and destination info into one DataFrame
-        first_rows['x1'] = first_rows['x']
-        first_rows['y1'] = first_rows['y']
-        first_rows['x2'] = last_rows['x'].values
-        first_rows['y2'] = last_rows['y'].values
-        first_rows['origin_zone'] = first_rows['zone_id']
-        first_rows['destination_zone'] = last_rows['zone_id'].values
-
-        # Reset index for cleanliness09_fcd_origin_destination.py
-        temp_df = first_rows.copy().reset_index(drop=True)
-
-        df_list.append(temp_df)
-
-    final_df = pd.concat(df_list, ignore_index=True)
-
-    final_all_df = pd.concat(all_df, ignore_index=True)
-
-    final_all_df.drop(columns=['time_diff', 'is_new_trip', 'prev_time', 'trip_id'], inplace=True)
-
-    trip_changes = (final_all_df['trips'] != final_all_df['trips'].shift())
-
-    # Step 2: Create trip numbers using a cumulative sum
-    final_all_df['trip_id'] = trip_changes.cumsum()
-
-    final_all_df = final_all_df[[
-        'gid', 'x', 'y', 'direction', 'velocity', 'dt', 'status', 'vehicle_id', 'vehicle_class', 'zone_id', 'trip_id', 'fid',
-        'ts_insert'
-    ]]
-
-    final_df = final_df[[
-        'gid', 'direction', 'velocity', 'dt', 'status', 'vehicle_id', 'vehicle_class', 'zone_id', 'fid',
-        'trips', 'x1', 'y1', 'x2', 'y2',
-        'origin_zone', 'destination_zone'
-    ]]
-
-    # Step 1: Detect changes in either vehicle_id or trip_id
-    changes = (final_df['trips'] != final_df['trips'].shift())
-
-    # Step 2: Create trip numbers using a cumulative sum
-    final_df['trip_id'] = changes.cumsum()
+            trip_offset = number_trips(df, temp_df, trip_offset)
 
-    final_df.drop(columns=['trips'], inplace=True)
-    final_df.to_csv(f"data/origin_destination.csv", index=False)
+        append_rows(temp_df.sort_values("trip_id", kind="stable")[OD_COLUMNS], od_path, first=day_number == 0)
+        append_rows(df[POINT_COLUMNS], points_path, first=day_number == 0)
+        point_count += len(df)
 
-    final_all_df.to_csv(f"data/final_all_df.csv", index=False)
+    logging.info(f"{trip_offset} trips saved to '{od_path}' and their {point_count} points to '{points_path}'.")
@@ -4,6 +4,7 @@ import json
 import logging
 import pandas as pd
 import matplotlib.pyplot as plt
+from od_output import OD_FILENAME, output_path
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -26,9 +27,17 @@ if __name__ == "__main__":
         datefmt="%Y-%m-%d %H:%M:%S"
     )
 
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        od_compression = config["output_data"]["od_compression"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
     # Read the origin-destination matrix data
-    df = pd.read_csv(f"data/origin_destination.csv")
-    all_df = pd.read_csv(f"data/final_all_df.csv")
+    df = pd.read_csv(output_path(OD_FILENAME, od_compression), usecols=['origin_zone', 'destination_zone'])
 
     # Create OD matrix
     od_matrix = df.groupby(['origin_zone', 'destination_zone']).size().unstack(fill_value=0)
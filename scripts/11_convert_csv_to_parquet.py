@@ -0,0 +1,53 @@
+"""
+Description:
+This script converts the raw CSV file once into a Parquet dataset partitioned by day and zone.
+The analysis scripts read the dataset instead of the database when "source" is set to "parquet" in 'config.json'.
+"""
+
+# Import the necessary libraries and modules
+import os
+import sys
+import json
+import time
+import logging
+from parquet_store import convert_csv_to_parquet
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        file_path = config["input_data"]["data_name"]
+        chunk_size = config["input_data"]["chunk_size"]
+        dt_format = config["input_data"]["dt_format"]
+        parquet_dataset = config["input_data"]["parquet_dataset"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    data_path = os.path.join("data", file_path)
+    dataset_path = os.path.join("data", parquet_dataset)
+
+    try:
+        logging.info(f"Converting '{data_path}' into the Parquet dataset '{dataset_path}'.")
+        start_time = time.perf_counter()
+        total_rows, total_malformed = convert_csv_to_parquet(data_path, dataset_path, chunk_size, dt_format)
+        elapsed = time.perf_counter() - start_time
+        logging.info(f"Completed conversion: {total_rows} records written in {elapsed:,.0f} s, {total_malformed} malformed rows skipped")
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        sys.exit(1)
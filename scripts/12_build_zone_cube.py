@@ -0,0 +1,60 @@
+"""
+Description:
+This script rebuilds the zone and link cubes of the configured days from the point table.
+The loader keeps the cubes up to date while importing, so this is only needed for points loaded
+before "zone_cube" was enabled or after changing "cube_interval", "distinct_count" or "hll_error" in 'config.json'.
+"""
+
+# Import the necessary libraries and modules
+import os
+import sys
+import json
+import time
+import logging
+import psycopg2
+from day_runner import configured_dates
+from zone_cube import create_cube_tables, cube_precision, rebuild_cube_day
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        db_params = {key: config["database"][key] for key in ["dbname", "user", "password", "host", "port"]}
+        schema = config["database"]["schema"]
+        point_table = config["database"]["point_table"]
+        cube_interval = config["input_data"]["cube_interval"]
+        precision = cube_precision(config)
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    try:
+        conn = psycopg2.connect(**db_params)
+        try:
+            create_cube_tables(conn)
+
+            # Each day is replaced in its own transaction
+            for selected_date in configured_dates(config):
+                start_time = time.perf_counter()
+                rebuild_cube_day(conn, schema, point_table, selected_date, cube_interval, precision)
+                logging.info(f"Cubes of {selected_date} rebuilt in {time.perf_counter() - start_time:,.1f} s.")
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        sys.exit(1)
@@ -0,0 +1,84 @@
+"""
+Description:
+This script computes the unique vehicle series of every zone and of the whole network at the
+"rollup_interval" of 'config.json' (e.g. hourly) for the configured days.
+The series are computed from the zone cube by merging the vehicle id sets, or the HyperLogLog
+sketches with "distinct_count": "hll", of the cube bins, so no point is read.
+"""
+
+# Import the necessary libraries and modules
+import os
+import json
+import logging
+import pandas as pd
+from day_runner import configured_dates, get_engine, run_days
+from zone_cube import cube_precision, read_vehicle_rollup
+
+
+# Function to process one day
+def process_day(selected_date, config, zones) -> int:
+    """
+    Compute the unique vehicle series of one day and save them to '<date>_unique_vehicles_<rollup_interval>.csv'
+    :param selected_date:
+    :param config:
+    :param zones:
+    :return: the number of rows written
+    """
+    engine = get_engine()
+    zone_column = config["input_data"]["zone_column"]
+    vehicle_type = config["operation"]["vehicle_type"]
+    rollup_interval = config["operation"]["rollup_interval"]
+    precision = cube_precision(config)
+    zone_ids = zones[zone_column].tolist()
+
+    full_time_range = pd.date_range(start=f"{selected_date} 00:00:00", periods=pd.Timedelta(days=1) // pd.Timedelta(rollup_interval), freq=rollup_interval)
+
+    # One series per zone and one over all the zones, merged in the database
+    by_zone = read_vehicle_rollup(engine, selected_date, vehicle_type, zone_ids, rollup_interval, precision)
+    network = read_vehicle_rollup(engine, selected_date, vehicle_type, zone_ids, rollup_interval, precision, by_zone=False)
+
+    final_df = by_zone.pivot(index="dt", columns="zone_id", values="vehicle_numbers")
+    final_df = final_df.reindex(index=full_time_range, columns=zone_ids).rename(columns=lambda zone_id: f"V_{zone_id}")
+    final_df["V_all"] = network.set_index("dt")["vehicle_numbers"].reindex(full_time_range)
+    final_df = final_df.fillna(0).astype(int).rename_axis("dt").reset_index()
+
+    output_file_path = os.path.join("data", f"{selected_date}_unique_vehicles_{rollup_interval}.csv")
+    final_df.to_csv(output_file_path, index=False)
+
+    return len(final_df)
+
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        zone_filename = config["input_data"]["zone_filename"]
+        rollup_interval = config["operation"]["rollup_interval"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    data_path = os.path.join("data", zone_filename)
+    zones = pd.read_csv(data_path)
+
+    # Process the configured days, in parallel when several workers are configured
+    dates = configured_dates(config)
+    row_counts = run_days(process_day, config, dates, zones=zones)
+
+    for selected_date, rows in zip(dates, row_counts):
+        logging.info(f"CSV file '{selected_date}_unique_vehicles_{rollup_interval}.csv' has been created with {rows} rows.")
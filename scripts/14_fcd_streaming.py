@@ -0,0 +1,138 @@
+"""
+Description:
+This script computes the FCD speed, flow and density of every zone online, from a stream of raw
+point records instead of the database.
+The records are read in time order from the raw CSV file ("source": "file") or from a socket
+("source": "socket"), e.g. fed by '15_fcd_replay.py', in batches of "batch_size" lines. Only the
+link statistics of the open intervals are kept in memory. An interval of "time_interval" is closed
+when the watermark, the latest point time minus "allowed_lateness", passes its end, and its FCD is
+appended to 'data/fcd_stream/fcd_stream_<date>.csv'. Points arriving after their interval was
+closed are dropped and counted.
+"""
+
+# Import the necessary libraries and modules
+import os
+import json
+import socket
+import logging
+import pandas as pd
+from zone_cube import cube_precision
+from fcd_stream import add_points, close_intervals, new_stream_state, parse_stream_batch, read_stream_batches
+import warnings
+warnings.filterwarnings("ignore")
+
+# Folder of the streamed FCD
+STREAM_FOLDER = os.path.join("data", "fcd_stream")
+
+
+# Function to open the stream of raw records
+def open_stream(streaming, data_path):
+    """
+    Open the raw records as a binary stream, from the raw CSV file or from a socket
+    :param streaming: the 'streaming' section of the config
+    :param data_path:
+    :return:
+    """
+    if streaming["source"] == "socket":
+        connection = socket.create_connection((streaming["host"], streaming["port"]))
+        return connection.makefile("rb")
+
+    return open(data_path, "rb")
+
+
+# Function to save the FCD of closed intervals
+def save_results(results, written_files) -> None:
+    """
+    Append the FCD of closed intervals to the file of their day. A file is overwritten the first time it is written in a run.
+    :param results:
+    :param written_files: set of the files already written in this run
+    :return:
+    """
+    os.makedirs(STREAM_FOLDER, exist_ok=True)
+
+    for day, day_results in results.groupby(results["interval"].dt.strftime("%Y-%m-%d"), sort=True):
+        file_path = os.path.join(STREAM_FOLDER, f"fcd_stream_{day}.csv")
+        new_file = file_path not in written_files
+        day_results.to_csv(file_path, mode="w" if new_file else "a", header=new_file, index=False, date_format="%Y-%m-%d %H:%M:%S")
+        written_files.add(file_path)
+
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        data_name = config["input_data"]["data_name"]
+        dt_format = config["input_data"]["dt_format"]
+        zone_filename = config["input_data"]["zone_filename"]
+        zone_column = config["input_data"]["zone_column"]
+        time_interval = config["operation"]["time_interval"]
+        vehicle_id_column = config["operation"]["vehicle_id_column"]
+        zone_id_column = config["operation"]["zone_id_column"]
+        fid_column = config["operation"]["fid_column"]
+        vehicle_class_column = config["operation"]["vehicle_class_column"]
+        vehicle_type = config["operation"]["vehicle_type"]
+        velocity_column = config["operation"]["velocity_column"]
+        streaming = config["streaming"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    data_path = os.path.join("data", data_name)
+    links = pd.read_csv(os.path.join("data", "links.csv"))
+    zones = pd.read_csv(os.path.join("data", zone_filename))
+    zone_ids = zones[zone_column].tolist()
+
+    # Exact vehicle ids, or HyperLogLog sketches with "distinct_count": "hll"
+    precision = cube_precision(config)
+    allowed_lateness = streaming["allowed_lateness"]
+    state = new_stream_state()
+    written_files = set()
+    total_points = 0
+    total_malformed = 0
+    total_rows = 0
+
+    stream = open_stream(streaming, data_path)
+    logging.info(f"Streaming from {streaming['source']} with {time_interval} intervals and {allowed_lateness} allowed lateness.")
+
+    with stream:
+        for columns, block in read_stream_batches(stream, streaming["batch_size"]):
+            df, malformed = parse_stream_batch(block, columns, dt_format)
+            total_malformed += malformed
+
+            # Keep the points of the vehicle type and zones
+            df = df[(df[vehicle_class_column] == vehicle_type) & df[zone_id_column].isin(zone_ids)]
+            df = df.rename(columns={zone_id_column: "zone_id", fid_column: "fid"}).astype({"zone_id": "int64", "fid": "int64", vehicle_id_column: "int64"})
+            total_points += len(df)
+
+            late_points = add_points(state, df, time_interval, vehicle_id_column, velocity_column, precision)
+            if late_points:
+                logging.warning(f"{late_points} late points dropped, the watermark had passed their interval.")
+
+            results = close_intervals(state, links, time_interval, allowed_lateness, precision)
+            if not results.empty:
+                save_results(results, written_files)
+                total_rows += len(results)
+                logging.info(f"Closed the intervals up to {state['closed_until']}, {state['open']['interval'].nunique()} intervals open.")
+
+    # Close the remaining intervals at the end of the stream
+    results = close_intervals(state, links, time_interval, allowed_lateness, precision, final=True)
+    if not results.empty:
+        save_results(results, written_files)
+        total_rows += len(results)
+
+    logging.info(f"Streaming finished: {total_points} points, {total_malformed} malformed rows, {state['late_points']} late points, {total_rows} FCD rows written.")
@@ -0,0 +1,117 @@
+"""
+Description:
+This script replays the raw CSV file over a local socket, so the streaming FCD calculation of
+'14_fcd_streaming.py' ("source": "socket") can be tested without outside services.
+It waits for one client on "host" and "port" of the 'streaming' section of 'config.json', sends the
+header line and then every record when its `dt` is due at "replay_speed" times real time
+(e.g. 60 replays one hour of data in one minute, 0 sends as fast as possible). The file should be
+sorted by `dt`; records earlier than the latest one sent are sent immediately.
+"""
+
+# Import the necessary libraries and modules
+import os
+import json
+import time
+import socket
+import logging
+from datetime import datetime
+
+# Number of lines sent at most in one write
+SEND_LINES = 1000
+
+
+# Function to read the event time of a raw line
+def line_time(line, dt_index, dt_format):
+    """
+    Parse the `dt` value of a raw line
+    :param line:
+    :param dt_index: position of the `dt` column
+    :param dt_format:
+    :return: a datetime, or None if the value is malformed
+    """
+    try:
+        return datetime.strptime(line.decode("utf-8").split(",")[dt_index].strip(), dt_format)
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return None
+
+
+# Function to replay the raw file to a client
+def replay_file(connection, data_path, dt_format, replay_speed) -> int:
+    """
+    Send the header and the records of the raw file, paced by their event time
+    :param connection:
+    :param data_path:
+    :param dt_format:
+    :param replay_speed: speed-up over real time, 0 to send as fast as possible
+    :return: the number of records sent
+    """
+    sent = 0
+    pending = []
+    first_time = None
+    start_clock = time.monotonic()
+
+    with open(data_path, "rb") as file:
+        header = file.readline()
+        dt_index = header.decode("utf-8-sig").strip().split(",").index("dt")
+        connection.sendall(header)
+
+        for line in file:
+            event_time = line_time(line, dt_index, dt_format) if replay_speed else None
+
+            # Wait until the record is due, after sending the records already due
+            if event_time is not None:
+                first_time = first_time or event_time
+                due = start_clock + (event_time - first_time).total_seconds() / replay_speed
+                if due > time.monotonic():
+                    connection.sendall(b"".join(pending))
+                    pending = []
+                    time.sleep(max(due - time.monotonic(), 0))
+
+            pending.append(line)
+            sent += 1
+            if len(pending) >= SEND_LINES:
+                connection.sendall(b"".join(pending))
+                pending = []
+
+    connection.sendall(b"".join(pending))
+    return sent
+
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        data_name = config["input_data"]["data_name"]
+        dt_format = config["input_data"]["dt_format"]
+        streaming = config["streaming"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    data_path = os.path.join("data", data_name)
+
+    with socket.create_server((streaming["host"], streaming["port"])) as server:
+        logging.info(f"Waiting for a client on {streaming['host']}:{streaming['port']}.")
+        connection, address = server.accept()
+
+        with connection:
+            logging.info(f"Replaying '{data_name}' to {address} at {streaming['replay_speed']}x real time.")
+            start_time = time.time()
+            sent = replay_file(connection, data_path, dt_format, streaming["replay_speed"])
+
+    logging.info(f"Replay finished: {sent} records sent in {time.time() - start_time:.2f} seconds.")
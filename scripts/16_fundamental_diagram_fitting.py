@@ -0,0 +1,75 @@
+"""
+Description:
+This script fits the Greenshields, Greenberg, Underwood and triangular fundamental diagram models
+to the FCD of every zone over the configured days, all zones in one batch (see 'fd_models.py').
+The points are filtered as in '06_fcd_visualization.py' (density up to 150 veh/km, flow up to 3600 veh/h).
+The parameters, capacity, critical density and goodness of fit of every zone and model are saved to
+'data/fd_parameters_<start_date>_<end_date>.csv', so hundreds of zones can be compared without
+rendering their plots.
+"""
+
+# Import the necessary libraries and modules
+import os
+import json
+import logging
+import pandas as pd
+from day_runner import configured_dates
+from fcd_store import read_fcd, read_fcd_csv
+from fd_models import fit_all_models
+import warnings
+warnings.filterwarnings("ignore")
+
+if __name__ == "__main__":
+
+    log_folder = "logs"
+    log_name = os.path.basename(__file__)
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+
+    # Configure logging
+    logging.basicConfig(
+        filename=f"logs/{log_name}.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    try:
+        with open("config.json", "r") as file:
+            config = json.load(file)
+
+        zone_filename = config["input_data"]["zone_filename"]
+        zone_column = config["input_data"]["zone_column"]
+        time_interval = config["operation"]["time_interval"]
+        capacity_quantile = config["operation"]["capacity_quantile"]
+        fcd_output = config["output_data"]["fcd_output"]
+        logging.info("Config file loaded successfully.")
+    except FileNotFoundError:
+        logging.error("Config file not found. Please ensure a 'config.json' file exists in the root directory.")
+
+    zones = pd.read_csv(os.path.join("data", zone_filename))
+    zone_ids = zones[zone_column].tolist()
+    dates = configured_dates(config)
+    fit_columns = ['zone_id', 'fcd_speed', 'fcd_flow', 'fcd_density']
+
+    # Load the FCD of all zones of the configured days at once
+    if fcd_output == "store":
+        fcd_all = read_fcd(time_interval, zone_ids=zone_ids, dates=dates, columns=fit_columns)
+    else:
+        fcd_all = read_fcd_csv("data/fcd", zone_ids=zone_ids, dates=dates, columns=fit_columns)
+
+    fcd_all = fcd_all[(fcd_all['fcd_density'] <= 150) & (fcd_all['fcd_flow'] <= 3600)]
+    logging.info(f"{len(fcd_all)} FCD points of {fcd_all['zone_id'].nunique()} zones loaded.")
+
+    # Fit every model for every zone
+    parameters = fit_all_models(fcd_all, capacity_quantile)
+
+    output_file_path = os.path.join("data", f"fd_parameters_{dates[0]}_{dates[-1]}.csv")
+    parameters.to_csv(output_file_path, index=False)
+
+    # Best model of every zone by R2
+    best = parameters.dropna(subset=["r2"]).sort_values("r2", ascending=False).drop_duplicates("zone_id")
+    for model, count in best["model"].value_counts().items():
+        logging.info(f"{model} fits {count} zones best.")
+
+    logging.info(f"CSV file '{output_file_path}' has been created with {len(parameters)} rows.")
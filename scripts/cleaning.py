@@ -0,0 +1,206 @@
+"""
+Description:
+Vectorized cleaning stage for the raw FCD point files.
+The raw CSV is read with an explicit column and dtype schema, and every chunk is coerced
+column by column into the types of the `data.data` table. Rows with missing or malformed
+essential values are counted and dropped.
+"""
+
+# Import the necessary libraries and modules
+import io
+import os
+import hashlib
+import pandas as pd
+from itertools import islice
+
+# Database columns of `data.data` and the raw CSV columns they are loaded from
+COLUMN_MAPPING = {
+    "gid": "gid",
+    "x": "x",
+    "y": "y",
+    "direction": "dir",
+    "velocity": "vel",
+    "dt": "dt",
+    "status": "stato",
+    "vehicle_id": "id_veicolo",
+    "vehicle_class": "classe_veicolo",
+    "zone_id": "mm_id_zona",
+    "fid": "mm_fid",
+    "ts_insert": "ts_insert"
+}
+
+# Raw columns to read and the dtypes to read them with
+RAW_USECOLS = list(COLUMN_MAPPING.values())
+RAW_DTYPES = {
+    "gid": "str",
+    "x": "str",
+    "y": "str",
+    "dir": "str",
+    "vel": "str",
+    "dt": "str",
+    "stato": "str",
+    "id_veicolo": "str",
+    "classe_veicolo": "category",
+    "mm_id_zona": "str",
+    "mm_fid": "str",
+    "ts_insert": "str"
+}
+
+# Raw columns that must be present and valid for a row to be loaded
+ESSENTIAL_COLUMNS = ["x", "y", "dir", "vel", "dt", "stato", "id_veicolo", "classe_veicolo", "mm_id_zona", "mm_fid"]
+
+# Raw columns stored as BIGINT
+BIGINT_COLUMNS = ["gid", "id_veicolo", "mm_id_zona", "mm_fid"]
+
+# Largest value of an INTEGER column
+INTEGER_MAX = 2 ** 31 - 1
+
+# Raw numeric columns, read as strings and converted so that a malformed value only drops its row
+FLOAT_COLUMNS = {"x": "float64", "y": "float64", "dir": "float32", "vel": "float32"}
+
+# Default format of the raw `dt` column
+DT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# Function to read the raw file in typed chunks
+def read_raw_chunks(data_path, chunk_size, **kwargs):
+    """
+    Read the raw CSV file in chunks with the explicit column and dtype schema
+    :param data_path:
+    :param chunk_size:
+    :param kwargs: extra arguments passed to pd.read_csv
+    :return: an iterator of DataFrames
+    """
+    return pd.read_csv(data_path, chunksize=chunk_size, usecols=RAW_USECOLS, dtype=RAW_DTYPES, **kwargs)
+
+
+# Function to read the raw file in line-aligned byte blocks
+def read_raw_blocks(data_path, chunk_size):
+    """
+    Read the raw CSV file in blocks of `chunk_size` lines without parsing them.
+    Every block is described by its byte offsets, line count and MD5 checksum, so a
+    chunk can be identified again on a later run.
+    :param data_path:
+    :param chunk_size:
+    :return: an iterator of (chunk_info, block) where chunk_info is a dict
+    """
+    file_name = os.path.basename(data_path)
+
+    with open(data_path, "rb") as file:
+        offset = len(file.readline())
+        chunk_number = 0
+
+        while True:
+            block = b"".join(islice(file, chunk_size))
+            if not block:
+                break
+
+            chunk_number += 1
+            chunk_info = {
+                "file_name": file_name,
+                "chunk_number": chunk_number,
+                "start_offset": offset,
+                "end_offset": offset + len(block),
+                "row_count": block.count(b"\n") + (not block.endswith(b"\n")),
+                "checksum": hashlib.md5(block).hexdigest()
+            }
+            offset = chunk_info["end_offset"]
+
+            yield chunk_info, block
+
+
+# Function to read the column names of the raw file
+def read_raw_header(data_path) -> list:
+    """
+    Read the column names from the header line of the raw CSV file
+    :param data_path:
+    :return:
+    """
+    with open(data_path, "r", encoding="utf-8-sig") as file:
+        return file.readline().strip().split(",")
+
+
+# Function to parse a raw block
+def parse_raw_block(block, columns) -> pd.DataFrame:
+    """
+    Parse a block returned by read_raw_blocks with the explicit column and dtype schema
+    :param block:
+    :param columns: column names from read_raw_header
+    :return:
+    """
+    return pd.read_csv(io.BytesIO(block), header=None, names=columns, usecols=RAW_USECOLS, dtype=RAW_DTYPES)
+
+
+# Function to convert a column of strings to BIGINT
+def to_bigint(series) -> pd.Series:
+    """
+    Convert a column of strings to nullable BIGINT values, malformed values become <NA>
+    :param series:
+    :return:
+    """
+    try:
+        # Fast path: every value is a valid integer
+        return series.astype("int64").astype("Int64")
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    # Only integers of at most 18 digits are guaranteed to fit in a BIGINT
+    valid = series.str.strip().str.fullmatch(r"-?\d{1,18}", na=False)
+    result = pd.Series(pd.NA, index=series.index, dtype="Int64")
+    result[valid] = series[valid].str.strip().astype("int64")
+    return result
+
+
+# Function to convert a column of strings to floats
+def to_float(series, dtype) -> pd.Series:
+    """
+    Convert a column of strings to floats, malformed values become NaN
+    :param series:
+    :param dtype:
+    :return:
+    """
+    try:
+        # Fast path: every value is a valid number
+        return series.astype(dtype)
+    except (TypeError, ValueError):
+        # Blank the malformed values only, the valid ones are converted exactly as on the fast path
+        malformed = pd.to_numeric(series, errors="coerce").isna() & series.notna()
+        return series.mask(malformed).astype(dtype)
+
+
+# Function to clean a raw chunk
+def clean_chunk(chunk, dt_format=DT_FORMAT) -> tuple:
+    """
+    Coerce a raw chunk into the types of the database table and drop malformed rows.
+    The chunk is modified in place to keep peak memory close to the chunk size.
+    :param chunk:
+    :param dt_format:
+    :return: (cleaned_chunk, number_of_malformed_rows)
+    """
+    # Convert the identifier columns to BIGINT, the numeric columns to floats and the status to an integer
+    for column in BIGINT_COLUMNS:
+        chunk[column] = to_bigint(chunk[column])
+    for column, dtype in FLOAT_COLUMNS.items():
+        chunk[column] = to_float(chunk[column], dtype)
+
+    # The status is stored as INTEGER, a value out of its range is malformed
+    status = to_bigint(chunk["stato"])
+    chunk["stato"] = status.where(status.abs() <= INTEGER_MAX)
+
+    # Convert `dt` column to datetime format
+    chunk["dt"] = pd.to_datetime(chunk["dt"], format=dt_format, errors="coerce")
+
+    # Count and drop rows with missing or malformed essential values
+    valid = chunk[ESSENTIAL_COLUMNS].notna().all(axis=1)
+    malformed = int((~valid).sum())
+    if malformed:
+        chunk.drop(index=chunk.index[~valid], inplace=True)
+
+    # Direction and velocity are stored as integers
+    chunk["dir"] = chunk["dir"].round().astype("int32")
+    chunk["vel"] = chunk["vel"].round().astype("int32")
+
+    # The few status codes are kept as a category
+    chunk["stato"] = chunk["stato"].astype("int32").astype("category")
+
+    return chunk, malformed
@@ -0,0 +1,115 @@
+"""
+Description:
+Shared date-range runner for the analysis scripts.
+The days to process are taken from "start_date" and "end_date" in the 'operation' section of
+'config.json', so months of any length are handled. Days are fanned out over a process pool,
+every worker keeps its own SQLAlchemy engine, and the results are returned in date order, either all
+at once or one day at a time with at most "workers" days in flight.
+"""
+
+# Import the necessary libraries and modules
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from sqlalchemy import create_engine
+
+# SQLAlchemy engine of the current process
+_engine = None
+
+
+# Function to build the database URL
+def database_url(config) -> str:
+    """
+    Build the SQLAlchemy URL of the database from the config
+    :param config:
+    :return:
+    """
+    database = config["database"]
+    return f"postgresql://{database['user']}:{database['password']}@{database['host']}:{database['port']}/{database['dbname']}"
+
+
+# Function to initialize a worker process
+def init_worker(db_url) -> None:
+    """
+    Create the engine of a worker process
+    :param db_url:
+    :return:
+    """
+    global _engine
+    _engine = create_engine(db_url)
+
+
+# Function to get the engine of the current process
+def get_engine():
+    """
+    Get the SQLAlchemy engine of the current process
+    :return:
+    """
+    return _engine
+
+
+# Function to list the configured days
+def configured_dates(config) -> list:
+    """
+    List the days between "start_date" and "end_date" (both included)
+    :param config:
+    :return: a list of dates as YYYY-MM-DD strings
+    """
+    dates = pd.date_range(start=config["operation"]["start_date"], end=config["operation"]["end_date"], freq="D")
+    return [f"{date:%Y-%m-%d}" for date in dates]
+
+
+# Function to run a function for every day
+def run_days(process_day, config, dates=None, **kwargs) -> list:
+    """
+    Run process_day(selected_date, config=config, **kwargs) for every day, in parallel when "workers" in the
+    'operation' section is greater than 1. process_day must be a module-level function and can
+    get the database engine of its process with get_engine().
+    :param process_day:
+    :param config:
+    :param dates: the days to process, the configured days if None
+    :param kwargs: extra arguments passed to process_day
+    :return: the results of process_day in date order
+    """
+    dates = configured_dates(config) if dates is None else dates
+    workers = config["operation"]["workers"]
+    task = partial(process_day, config=config, **kwargs)
+
+    if workers <= 1:
+        init_worker(database_url(config))
+        return [task(selected_date) for selected_date in dates]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(database_url(config),)) as executor:
+        return list(executor.map(task, dates))
+
+
+# Function to run a function for every day, yielding the results as they are needed
+def iter_days(process_day, config, dates=None, **kwargs):
+    """
+    Like run_days, but yield the results in date order one day at a time. No more than "workers" days are
+    submitted ahead of the day being consumed, so only a few days of results are held in memory.
+    :param process_day:
+    :param config:
+    :param dates: the days to process, the configured days if None
+    :param kwargs: extra arguments passed to process_day
+    :return: a generator of the results of process_day in date order
+    """
+    dates = configured_dates(config) if dates is None else dates
+    workers = config["operation"]["workers"]
+    task = partial(process_day, config=config, **kwargs)
+
+    if workers <= 1:
+        init_worker(database_url(config))
+        for selected_date in dates:
+            yield task(selected_date)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(database_url(config),)) as executor:
+        pending = deque()
+        for selected_date in dates:
+            pending.append(executor.submit(task, selected_date))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,162 @@
+"""
+Description:
+Top-k dense links of every zone over configurable windows.
+The points of a day are counted per zone and link in the database (GROUP BY on the point table or
+SUM over the link cube), or from the Parquet points, truncated to the hour or to the day. The
+counts are then labelled with their window (hour, hour_of_day, day, week or month), merged over
+the days and ranked, so every point is read once whatever the window. When reading files, the
+counts of every window and zone can be kept in a Misra-Gries heavy-hitters summary of
+"link_sketch_size" links: summaries are merged by adding the counts and subtracting the count of the
+first link beyond the size, which bounds the memory and underestimates a count by at most
+points / (size + 1).
+"""
+
+# Import the necessary libraries and modules
+import pandas as pd
+from partitioning import day_condition
+from zone_cube import LINK_CUBE_TABLE
+
+# Supported windows and the unit the counts are truncated to in order to label them
+DENSE_WINDOWS = {"hour": "hour", "hour_of_day": "hour", "day": "day", "week": "day", "month": "day"}
+WINDOW_KEYS = ["window", "zone_id"]
+
+
+# Function to check the window
+def check_window(window) -> str:
+    """
+    Check that the window is supported and return the unit of its counts
+    :param window:
+    :return:
+    """
+    if window not in DENSE_WINDOWS:
+        raise ValueError(f"Unsupported window '{window}', use one of {list(DENSE_WINDOWS)}.")
+    return DENSE_WINDOWS[window]
+
+
+# Function to count the points of every link in the database
+def query_link_counts(engine, config, selected_date, zone_ids, window) -> pd.DataFrame:
+    """
+    Count the points of every zone and link of one day per hour or per day with one grouped query,
+    on the point table or on the link cube with "source": "cube"
+    :param engine:
+    :param config:
+    :param selected_date:
+    :param zone_ids:
+    :param window:
+    :return: DataFrame with time, zone_id, fid and count
+    """
+    operation = config["operation"]
+    unit = check_window(window)
+    zone_list = ", ".join(str(zone_id) for zone_id in zone_ids)
+
+    if operation["source"] == "cube":
+        query = f"""
+            SELECT date_trunc('{unit}', bin_start) AS time, zone_id, fid, SUM(point_count) AS count
+            FROM {LINK_CUBE_TABLE}
+            WHERE {day_condition(selected_date, "bin_start")} AND vehicle_class = '{operation["vehicle_type"]}' AND zone_id IN ({zone_list})
+            GROUP BY 1, 2, 3;
+        """
+    else:
+        query = f"""
+            SELECT date_trunc('{unit}', dt) AS time, {operation["zone_id_column"]} AS zone_id, {operation["fid_column"]} AS fid, COUNT(*) AS count
+            FROM {config["database"]["schema"]}.{config["database"]["point_table"]}
+            WHERE {day_condition(selected_date)} AND {operation["vehicle_class_column"]} = '{operation["vehicle_type"]}' AND {operation["zone_id_column"]} IN ({zone_list})
+            GROUP BY 1, 2, 3;
+        """
+
+    counts = pd.read_sql(query, engine)
+    counts["time"] = pd.to_datetime(counts["time"])
+    counts["count"] = counts["count"].astype("int64")
+    return counts
+
+
+# Function to count the points of every link from points
+def count_points(df, window) -> pd.DataFrame:
+    """
+    Count the points of every zone and link per hour or per day
+    :param df: points with dt, zone_id and fid
+    :param window:
+    :return: DataFrame with time, zone_id, fid and count
+    """
+    unit = check_window(window)
+    times = pd.to_datetime(df["dt"]).dt.floor("h" if unit == "hour" else "D")
+    return df.assign(time=times).groupby(["time", "zone_id", "fid"], sort=False).size().rename("count").reset_index()
+
+
+# Function to label times with their window
+def window_labels(times, window) -> pd.Series:
+    """
+    Label of the window of every time, e.g. '2019-09-02' for the week starting on Monday 2 September
+    :param times:
+    :param window:
+    :return:
+    """
+    times = pd.Series(pd.to_datetime(times))
+    if window == "hour":
+        return times.dt.strftime("%Y-%m-%d %H:00")
+    if window == "hour_of_day":
+        return times.dt.hour.astype(str)
+    if window == "week":
+        return (times.dt.normalize() - pd.to_timedelta(times.dt.weekday, unit="D")).dt.strftime("%Y-%m-%d")
+    if window == "month":
+        return times.dt.strftime("%Y-%m")
+    return times.dt.strftime("%Y-%m-%d")
+
+
+# Function to count the points of every link per window
+def window_counts(counts, window) -> pd.DataFrame:
+    """
+    Sum the counts of every zone and link over their window
+    :param counts: DataFrame with time, zone_id, fid and count
+    :param window:
+    :return: DataFrame with window, zone_id, fid and count
+    """
+    counts = counts.assign(window=window_labels(counts["time"], window).to_numpy())
+    return counts.groupby(WINDOW_KEYS + ["fid"], sort=True)["count"].sum().reset_index()
+
+
+# Function to reduce counts to a heavy-hitters summary
+def reduce_counts(counts, sketch_size) -> pd.DataFrame:
+    """
+    Keep at most `sketch_size` links per window and zone: the count of the first link beyond
+    the size is subtracted from every count and the links left without count are dropped
+    :param counts: DataFrame with window, zone_id, fid and count
+    :param sketch_size:
+    :return:
+    """
+    counts = counts.sort_values(WINDOW_KEYS + ["count", "fid"], ascending=[True, True, False, True], ignore_index=True)
+    position = counts.groupby(WINDOW_KEYS, sort=False).cumcount()
+
+    # Count of the (sketch_size + 1)-th link of every window and zone, 0 if there is none
+    beyond = counts.loc[position == sketch_size, WINDOW_KEYS + ["count"]].rename(columns={"count": "offset"})
+    counts = counts.merge(beyond, on=WINDOW_KEYS, how="left")
+    counts["count"] = counts["count"] - counts["offset"].fillna(0).astype("int64")
+
+    keep = (position < sketch_size).to_numpy() & (counts["count"] > 0).to_numpy()
+    return counts.loc[keep, WINDOW_KEYS + ["fid", "count"]].reset_index(drop=True)
+
+
+# Function to merge the counts of several days
+def merge_counts(parts, sketch_size=None) -> pd.DataFrame:
+    """
+    Add up the counts of several days, reduced to a heavy-hitters summary if a size is given
+    :param parts: DataFrames with window, zone_id, fid and count
+    :param sketch_size:
+    :return:
+    """
+    counts = pd.concat(parts, ignore_index=True)
+    counts = counts.groupby(WINDOW_KEYS + ["fid"], sort=True)["count"].sum().reset_index()
+    return counts if not sketch_size else reduce_counts(counts, sketch_size)
+
+
+# Function to rank the links
+def top_links(counts, k) -> pd.DataFrame:
+    """
+    The k links with the most points of every window and zone, ties broken by link id
+    :param counts: DataFrame with window, zone_id, fid and count
+    :param k:
+    :return: DataFrame with window, zone_id, rank, fid and count
+    """
+    counts = counts.sort_values(WINDOW_KEYS + ["count", "fid"], ascending=[True, True, False, True], ignore_index=True)
+    counts["rank"] = counts.groupby(WINDOW_KEYS, sort=False).cumcount() + 1
+    return counts[counts["rank"] <= k][WINDOW_KEYS + ["rank", "fid", "count"]].reset_index(drop=True)
@@ -0,0 +1,149 @@
+"""
+Description:
+2D binned fundamental diagrams.
+The flow-density, flow-speed and speed-density points of a zone are counted in fixed grids of
+"grid_bins" x "grid_bins" cells over the ranges of GRID_RANGES, so plotting a diagram costs the
+same for a day or for a year of points. The grids of a zone and period are saved to
+`data/fcd_grids/grid_<zone>_<start_date>_<end_date>.npz`. Since the cell edges only depend on the
+number of bins, the grids of several periods are merged by adding their counts.
+"""
+
+# Import the necessary libraries and modules
+import os
+import numpy as np
+
+# Folder of the saved grids
+GRID_FOLDER = os.path.join("data", "fcd_grids")
+
+# Diagrams as (x column, y column) and the ranges of the binned columns, values outside are counted in the border cells
+GRID_DIAGRAMS = {
+    "flow_density": ("fcd_density", "fcd_flow"),
+    "flow_speed": ("fcd_flow", "fcd_speed"),
+    "density_speed": ("fcd_density", "fcd_speed")
+}
+GRID_RANGES = {
+    "fcd_density": (0.0, 150.0),
+    "fcd_flow": (0.0, 3600.0),
+    "fcd_speed": (0.0, 150.0)
+}
+
+
+# Function to get the cell edges of a column
+def grid_edges(column, bins) -> np.ndarray:
+    """
+    Edges of the cells of a column
+    :param column:
+    :param bins:
+    :return:
+    """
+    low, high = GRID_RANGES[column]
+    return np.linspace(low, high, bins + 1)
+
+
+# Function to get the cell centers of a column
+def grid_centers(column, bins) -> np.ndarray:
+    """
+    Centers of the cells of a column
+    :param column:
+    :param bins:
+    :return:
+    """
+    edges = grid_edges(column, bins)
+    return (edges[:-1] + edges[1:]) / 2
+
+
+# Function to count the points of a zone in the grids
+def bin_zone(fcd_data, bins) -> dict:
+    """
+    Count the FCD points of a zone in the grid of every diagram
+    :param fcd_data: DataFrame with fcd_speed, fcd_flow and fcd_density
+    :param bins:
+    :return: dict of diagram name to an int64 array of counts shaped (x bins, y bins)
+    """
+    grids = {}
+    for diagram, (x_column, y_column) in GRID_DIAGRAMS.items():
+        points = fcd_data[[x_column, y_column]].dropna().to_numpy(dtype=float)
+
+        # Cell of every point, clipped to the border cells
+        x_cells = np.clip(np.searchsorted(grid_edges(x_column, bins), points[:, 0], side="right") - 1, 0, bins - 1)
+        y_cells = np.clip(np.searchsorted(grid_edges(y_column, bins), points[:, 1], side="right") - 1, 0, bins - 1)
+        grids[diagram] = np.bincount(x_cells * bins + y_cells, minlength=bins * bins).reshape(bins, bins)
+
+    return grids
+
+
+# Function to name the grid file of a zone and period
+def grid_path(zone, start_date, end_date, grid_folder=GRID_FOLDER) -> str:
+    """
+    Path of the grids of a zone over a period
+    :param zone:
+    :param start_date:
+    :param end_date:
+    :param grid_folder:
+    :return:
+    """
+    return os.path.join(grid_folder, f"grid_{zone}_{start_date}_{end_date}.npz")
+
+
+# Function to save the grids of a zone
+def save_grids(grids, path) -> None:
+    """
+    Save the grids of a zone
+    :param grids: dict returned by bin_zone
+    :param path:
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, **grids)
+
+
+# Function to merge saved grids
+def merge_grids(paths) -> dict:
+    """
+    Add up the saved grids of several periods, which must have the same number of bins
+    :param paths:
+    :return: dict of diagram name to an int64 array of counts
+    """
+    merged = {}
+    for path in paths:
+        with np.load(path) as grids:
+            for diagram in GRID_DIAGRAMS:
+                counts = grids[diagram]
+                if diagram in merged and merged[diagram].shape != counts.shape:
+                    raise ValueError(f"The grids of '{path}' do not have the same bins as the other grids.")
+                merged[diagram] = merged[diagram] + counts if diagram in merged else counts.astype(np.int64)
+
+    return merged
+
+
+# Function to list the saved grids of a zone
+def zone_grid_paths(zone, grid_folder=GRID_FOLDER) -> list:
+    """
+    Saved grid files of a zone, over all the periods
+    :param zone:
+    :param grid_folder:
+    :return:
+    """
+    if not os.path.exists(grid_folder):
+        return []
+    return sorted(os.path.join(grid_folder, file) for file in os.listdir(grid_folder) if file.startswith(f"grid_{zone}_") and file.endswith(".npz"))
+
+
+# Function to fit a trend on a grid
+def fit_grid(counts, x_column, y_column, degree) -> np.poly1d:
+    """
+    Fit a polynomial trend through the cell centers, weighted by their counts,
+    which approximates the fit through all the points
+    :param counts:
+    :param x_column:
+    :param y_column:
+    :param degree:
+    :return:
+    """
+    bins = counts.shape[0]
+    x_cells, y_cells = np.nonzero(counts)
+    x = grid_centers(x_column, bins)[x_cells]
+    y = grid_centers(y_column, bins)[y_cells]
+
+    # polyfit squares the weights, so the square root of the counts weights every point once
+    return np.poly1d(np.polyfit(x, y, degree, w=np.sqrt(counts[x_cells, y_cells])))
@@ -0,0 +1,140 @@
+"""
+Description:
+Consolidated FCD output store.
+The FCD of all zones of a day is written in one batch to a single Parquet file of the dataset
+`data/fcd_store`, partitioned by interval and date (`resolution=5min/date=2019-09-01/part-0.parquet`)
+with the zone as a column. Every file holds one row group per zone, and the row group, row count
+and time range of every zone are recorded in the index `data/fcd_store/_index`, so the stored zones
+and days can be listed without scanning the data. `read_fcd` loads all zones or a few zones of any
+days with one filtered scan that only reads the requested columns.
+"""
+
+# Import the necessary libraries and modules
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Folder of the store and of its index
+FCD_STORE_FOLDER = os.path.join("data", "fcd_store")
+INDEX_FOLDER_NAME = "_index"
+
+# Schema of the FCD files, partitioning of the store and columns of the index
+FCD_SCHEMA = pa.schema([
+    ("zone_id", pa.int64()),
+    ("interval", pa.timestamp("ns")),
+    ("fcd_speed", pa.float64()),
+    ("fcd_flow", pa.float64()),
+    ("fcd_density", pa.float64())
+])
+PARTITIONING = ds.partitioning(pa.schema([("resolution", pa.string()), ("date", pa.string())]), flavor="hive")
+INDEX_COLUMNS = ["resolution", "date", "zone_id", "row_group", "rows", "first_interval", "last_interval"]
+
+
+# Function to name the partition of a day
+def fcd_partition(selected_date, interval) -> str:
+    """
+    Relative folder of the FCD of one day and interval
+    :param selected_date:
+    :param interval:
+    :return:
+    """
+    return os.path.join(f"resolution={interval}", f"date={selected_date}")
+
+
+# Function to write the FCD of a day
+def write_fcd_day(results, selected_date, interval, store_folder=FCD_STORE_FOLDER) -> str:
+    """
+    Write the FCD of all zones of a day into one file, one row group per zone, and record the row groups in the index
+    :param results: DataFrame with zone_id, interval, fcd_speed, fcd_flow and fcd_density
+    :param selected_date:
+    :param interval:
+    :param store_folder:
+    :return: the path of the file
+    """
+    results = results.sort_values(["zone_id", "interval"], kind="stable", ignore_index=True)
+    partition = fcd_partition(selected_date, interval)
+    path = os.path.join(store_folder, partition, "part-0.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    index_rows = []
+    with pq.ParquetWriter(path, FCD_SCHEMA) as writer:
+        for row_group, (zone_id, zone_df) in enumerate(results.groupby("zone_id", sort=True)):
+            writer.write_table(pa.Table.from_pandas(zone_df, schema=FCD_SCHEMA, preserve_index=False))
+            index_rows.append([interval, selected_date, zone_id, row_group, len(zone_df),
+                               zone_df["interval"].iloc[0], zone_df["interval"].iloc[-1]])
+
+    # One index file per day, so that the days written in parallel never share a file
+    index_path = os.path.join(store_folder, INDEX_FOLDER_NAME, partition, "index.parquet")
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    pd.DataFrame(index_rows, columns=INDEX_COLUMNS).to_parquet(index_path, index=False)
+
+    return path
+
+
+# Function to read the index of the store
+def read_fcd_index(interval, store_folder=FCD_STORE_FOLDER) -> pd.DataFrame:
+    """
+    Read the index of the store: the row group, row count and time range of every zone and day of an interval
+    :param interval:
+    :param store_folder:
+    :return: DataFrame with the INDEX_COLUMNS sorted by date and zone
+    """
+    index_folder = os.path.join(store_folder, INDEX_FOLDER_NAME, f"resolution={interval}")
+    if not os.path.exists(index_folder):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+
+    index = ds.dataset(index_folder, format="parquet").to_table().to_pandas()
+    return index.sort_values(["date", "zone_id"], ignore_index=True)[INDEX_COLUMNS]
+
+
+# Function to read FCD from the store
+def read_fcd(interval, zone_ids=None, dates=None, columns=None, store_folder=FCD_STORE_FOLDER) -> pd.DataFrame:
+    """
+    Read the FCD of an interval with one filtered scan. Other days are skipped by their partition
+    and other zones by the statistics of their row groups.
+    :param interval:
+    :param zone_ids: a list of zone ids, all zones if None
+    :param dates: a date string or a list of date strings (YYYY-MM-DD), all days if None
+    :param columns: list of columns to read, e.g. ["zone_id", "fcd_flow"], all columns if None
+    :param store_folder:
+    :return:
+    """
+    if not os.path.exists(os.path.join(store_folder, f"resolution={interval}")):
+        return pd.DataFrame(columns=FCD_SCHEMA.names if columns is None else columns)
+
+    # The index folder is skipped by its "_" prefix
+    dataset = ds.dataset(store_folder, format="parquet", partitioning=PARTITIONING)
+    expression = ds.field("resolution") == interval
+    if dates is not None:
+        dates = [dates] if isinstance(dates, str) else list(dates)
+        expression = expression & ds.field("date").isin(dates)
+    if zone_ids is not None:
+        expression = expression & ds.field("zone_id").isin([int(zone_id) for zone_id in zone_ids])
+
+    columns = FCD_SCHEMA.names if columns is None else columns
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+# Function to read FCD from the per-zone CSV files
+def read_fcd_csv(folder, zone_ids=None, dates=None, columns=None) -> pd.DataFrame:
+    """
+    Read the per-zone 'fcd_<zone>_<date>.csv' files written with "fcd_output": "csv". The folder is listed once.
+    :param folder: e.g. 'data/fcd'
+    :param zone_ids: a list of zone ids, all zones if None
+    :param dates: a list of date strings (YYYY-MM-DD), all days if None
+    :param columns: list of columns to read, all columns if None
+    :return:
+    """
+    zone_names = None if zone_ids is None else {str(zone_id) for zone_id in zone_ids}
+    fcd_list = []
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            parts = file[:-len(".csv")].split("_")
+            if not (file.startswith("fcd_") and file.endswith(".csv") and len(parts) == 3):
+                continue
+            if (zone_names is None or parts[1] in zone_names) and (dates is None or parts[2] in dates):
+                fcd_list.append(pd.read_csv(os.path.join(root, file), usecols=columns))
+
+    return pd.concat(fcd_list, ignore_index=True) if fcd_list else pd.DataFrame(columns=FCD_SCHEMA.names if columns is None else columns)
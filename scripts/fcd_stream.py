@@ -0,0 +1,131 @@
+"""
+Description:
+Streaming FCD calculation with watermarks.
+Points are consumed in batches, roughly in time order, and folded into the link statistics of
+their interval (speed sum, point count and distinct vehicles of every zone and link). Only the
+intervals that are still open are kept in memory. The watermark is the latest point time minus the
+allowed lateness: once it passes the end of an interval, the interval is closed and the FCD speed,
+flow and density of every zone are computed from its link statistics by the FCD engine, so the
+results match '05_fcd_calculation.py' for the same points. Points of an interval that is already
+closed are late: they are dropped and counted.
+"""
+
+# Import the necessary libraries and modules
+import pandas as pd
+from itertools import islice
+from cleaning import COLUMN_MAPPING, clean_chunk, parse_raw_block
+from fcd_engine import FCD_KEYS, fcd_all_zones, interval_hours, link_stats_from_points, merge_link_stats, rollup_link_stats
+
+# Columns of the emitted FCD
+FCD_COLUMNS = FCD_KEYS + ["fcd_speed", "fcd_flow", "fcd_density"]
+
+
+# Function to read a stream of raw lines in batches
+def read_stream_batches(stream, batch_size):
+    """
+    Read a raw CSV stream (a file or a socket opened in binary mode) in blocks of `batch_size` lines
+    :param stream:
+    :param batch_size:
+    :return: an iterator of (columns, block), the columns are read from the header line
+    """
+    columns = stream.readline().decode("utf-8-sig").strip().split(",")
+
+    while True:
+        block = b"".join(islice(stream, batch_size))
+        if not block:
+            break
+        yield columns, block
+
+
+# Function to parse a batch of raw lines into points
+def parse_stream_batch(block, columns, dt_format) -> tuple:
+    """
+    Parse and clean a block of raw lines, with the columns named as in the database
+    :param block:
+    :param columns:
+    :param dt_format:
+    :return: (points, number_of_malformed_rows)
+    """
+    chunk, malformed = clean_chunk(parse_raw_block(block, columns), dt_format)
+    return chunk.rename(columns={raw: column for column, raw in COLUMN_MAPPING.items()}), malformed
+
+
+# Function to create the state of a stream
+def new_stream_state() -> dict:
+    """
+    Create an empty stream state: the link statistics of the open intervals, the latest point time,
+    the start of the first open interval and the number of late points
+    :return:
+    """
+    return {"open": None, "max_time": None, "closed_until": None, "late_points": 0}
+
+
+# Function to add points to the stream state
+def add_points(state, df, interval, vehicle_id_column, velocity_column, precision=None) -> int:
+    """
+    Fold a batch of points into the link statistics of their intervals. Points of closed intervals are dropped.
+    :param state:
+    :param df: points with zone_id, dt, fid, vehicle id and velocity columns
+    :param interval:
+    :param vehicle_id_column:
+    :param velocity_column:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are kept if None
+    :return: the number of late points of the batch
+    """
+    late_points = 0
+    if state["closed_until"] is not None:
+        late = df["dt"] < state["closed_until"]
+        late_points = int(late.sum())
+        df = df[~late]
+
+    state["late_points"] += late_points
+    if df.empty:
+        return late_points
+
+    max_time = df["dt"].max()
+    state["max_time"] = max_time if state["max_time"] is None else max(state["max_time"], max_time)
+
+    # Merge the statistics of the batch into those of the open intervals
+    stats = link_stats_from_points(df, interval, vehicle_id_column, velocity_column, precision)
+    if state["open"] is not None:
+        stats = merge_link_stats(pd.concat([state["open"], stats], ignore_index=True), precision)
+    state["open"] = stats
+
+    return late_points
+
+
+# Function to close the intervals passed by the watermark
+def close_intervals(state, links, interval, allowed_lateness, precision=None, final=False) -> pd.DataFrame:
+    """
+    Close the intervals that end before the watermark and compute their FCD
+    :param state:
+    :param links: DataFrame with the ID and Length of every link
+    :param interval:
+    :param allowed_lateness: how long after the latest point an interval is kept open, e.g. "2min"
+    :param precision: precision of the vehicle sketches, the vehicles are exact ids if None
+    :param final: close all the open intervals, at the end of the stream
+    :return: DataFrame with zone_id, interval, fcd_speed, fcd_flow and fcd_density sorted by interval and zone
+    """
+    if state["max_time"] is None:
+        return pd.DataFrame(columns=FCD_COLUMNS)
+
+    # Every interval starting before the boundary has ended before the watermark
+    if final:
+        boundary = state["max_time"].floor(interval) + pd.Timedelta(interval)
+    else:
+        boundary = (state["max_time"] - pd.Timedelta(allowed_lateness)).floor(interval)
+
+    if state["closed_until"] is not None and boundary <= state["closed_until"]:
+        return pd.DataFrame(columns=FCD_COLUMNS)
+    state["closed_until"] = boundary
+
+    closing = state["open"]["interval"] < boundary
+    if not closing.any():
+        return pd.DataFrame(columns=FCD_COLUMNS)
+
+    stats = state["open"][closing]
+    state["open"] = state["open"][~closing].reset_index(drop=True)
+    link_bins = rollup_link_stats(stats, interval, precision)
+    results = fcd_all_zones(link_bins, links, interval_hours(interval))
+
+    return results.sort_values(["interval", "zone_id"], kind="stable", ignore_index=True)
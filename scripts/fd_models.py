@@ -0,0 +1,209 @@
+"""
+Description:
+Batch fitting of macroscopic fundamental diagram models.
+Every model is fitted for all the zones at once from grouped sums, with no loop over the zones:
+- Greenshields: v = vf * (1 - k / kj), a linear fit of the speed on the density
+- Greenberg: v = vm * ln(kj / k), a linear fit of the speed on ln(density)
+- Underwood: v = vf * exp(-k / kc), a linear fit of ln(speed) on the density
+- Triangular: q = min(vf * k, w * (kj - k)), with the capacity taken as a high quantile of the flow,
+  vf fitted through the origin on the free-flow points and w on the congested points
+Every model is scored on the flow it predicts (q = k * v(k)), so the R2 and RMSE of the models of a
+zone can be compared. The critical speed and density are those at which the capacity is reached.
+"""
+
+# Import the necessary libraries and modules
+import numpy as np
+import pandas as pd
+
+# Models and columns of the parameter table
+FD_MODELS = ["greenshields", "greenberg", "underwood", "triangular"]
+PARAMETER_COLUMNS = ["zone_id", "model", "points", "free_flow_speed", "critical_speed", "jam_density", "critical_density", "capacity", "wave_speed", "r2", "rmse"]
+
+# Smallest number of points to fit a model or a branch
+MIN_POINTS = 3
+
+
+# Function to fit a straight line for every zone
+def zone_linear_fits(zone_ids, x, y) -> pd.DataFrame:
+    """
+    Least-squares fit of y = intercept + slope * x for every zone, from grouped sums
+    :param zone_ids: zone of every point
+    :param x:
+    :param y:
+    :return: DataFrame indexed by zone_id with intercept, slope and points, NaN if a zone has too few points
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    sums = pd.DataFrame({"zone_id": np.asarray(zone_ids), "x": x, "y": y, "xx": x * x, "xy": x * y}).groupby("zone_id", sort=True).agg(
+        points=("x", "size"), x=("x", "sum"), y=("y", "sum"), xx=("xx", "sum"), xy=("xy", "sum")
+    )
+
+    denominator = sums["points"] * sums["xx"] - sums["x"] ** 2
+    fits = pd.DataFrame(index=sums.index)
+    fits["slope"] = (sums["points"] * sums["xy"] - sums["x"] * sums["y"]) / denominator.where(denominator > 0)
+    fits["intercept"] = (sums["y"] - fits["slope"] * sums["x"]) / sums["points"]
+    fits["points"] = sums["points"]
+    fits.loc[fits["points"] < MIN_POINTS, ["slope", "intercept"]] = np.nan
+
+    return fits
+
+
+# Function to fit the Greenshields model
+def fit_greenshields(df) -> pd.DataFrame:
+    """
+    Fit v = vf * (1 - k / kj) for every zone
+    :param df: FCD points with zone_id, fcd_density and fcd_speed
+    :return: DataFrame indexed by zone_id with the model parameters
+    """
+    fits = zone_linear_fits(df["zone_id"], df["fcd_density"], df["fcd_speed"])
+    params = pd.DataFrame(index=fits.index)
+    params["points"] = fits["points"]
+    params["free_flow_speed"] = fits["intercept"]
+    params["jam_density"] = (-fits["intercept"] / fits["slope"]).where(fits["slope"] < 0)
+    params["critical_speed"] = params["free_flow_speed"] / 2
+    params["critical_density"] = params["jam_density"] / 2
+    params["capacity"] = params["critical_speed"] * params["critical_density"]
+    return params
+
+
+# Function to fit the Greenberg model
+def fit_greenberg(df) -> pd.DataFrame:
+    """
+    Fit v = vm * ln(kj / k) for every zone, vm being the speed at capacity
+    :param df: FCD points with zone_id, fcd_density and fcd_speed
+    :return: DataFrame indexed by zone_id with the model parameters
+    """
+    df = df[df["fcd_density"] > 0]
+    fits = zone_linear_fits(df["zone_id"], np.log(df["fcd_density"]), df["fcd_speed"])
+    params = pd.DataFrame(index=fits.index)
+    params["points"] = fits["points"]
+    params["critical_speed"] = (-fits["slope"]).where(fits["slope"] < 0)
+    params["jam_density"] = np.exp(fits["intercept"] / params["critical_speed"])
+    params["critical_density"] = params["jam_density"] / np.e
+    params["capacity"] = params["critical_speed"] * params["critical_density"]
+    return params
+
+
+# Function to fit the Underwood model
+def fit_underwood(df) -> pd.DataFrame:
+    """
+    Fit v = vf * exp(-k / kc) for every zone
+    :param df: FCD points with zone_id, fcd_density and fcd_speed
+    :return: DataFrame indexed by zone_id with the model parameters
+    """
+    df = df[df["fcd_speed"] > 0]
+    fits = zone_linear_fits(df["zone_id"], df["fcd_density"], np.log(df["fcd_speed"]))
+    params = pd.DataFrame(index=fits.index)
+    params["points"] = fits["points"]
+    params["free_flow_speed"] = np.exp(fits["intercept"])
+    params["critical_speed"] = params["free_flow_speed"] / np.e
+    params["critical_density"] = (-1 / fits["slope"]).where(fits["slope"] < 0)
+    params["capacity"] = params["critical_speed"] * params["critical_density"]
+    return params
+
+
+# Function to fit the triangular model
+def fit_triangular(df, capacity_quantile) -> pd.DataFrame:
+    """
+    Fit q = min(vf * k, w * (kj - k)) for every zone. The capacity is the given quantile of the flow,
+    vf is fitted through the origin on the points below the density of the capacity points, and w and kj
+    on the points above the critical density, when there are enough of them.
+    :param df: FCD points with zone_id, fcd_density and fcd_flow
+    :param capacity_quantile: quantile of the flow taken as the capacity, e.g. 0.95
+    :return: DataFrame indexed by zone_id with the model parameters
+    """
+    grouped = df.groupby("zone_id", sort=True)
+    params = pd.DataFrame(index=grouped.size().index)
+    params["points"] = grouped.size()
+    params["capacity"] = grouped["fcd_flow"].quantile(capacity_quantile)
+
+    # Density around which the capacity is reached
+    capacity = df["zone_id"].map(params["capacity"])
+    capacity_density = df[df["fcd_flow"] >= capacity].groupby("zone_id")["fcd_density"].median()
+
+    # Free-flow speed through the origin
+    free_flow = df[df["fcd_density"] <= df["zone_id"].map(capacity_density)]
+    sums = pd.DataFrame({
+        "zone_id": free_flow["zone_id"],
+        "kq": free_flow["fcd_density"] * free_flow["fcd_flow"],
+        "kk": free_flow["fcd_density"] ** 2
+    }).groupby("zone_id").sum().reindex(params.index)
+    params["free_flow_speed"] = sums["kq"] / sums["kk"].where(sums["kk"] > 0)
+    params["critical_speed"] = params["free_flow_speed"]
+    params["critical_density"] = params["capacity"] / params["free_flow_speed"]
+
+    # Congested branch, q = w * kj - w * k
+    congested = df[df["fcd_density"] > df["zone_id"].map(params["critical_density"])]
+    fits = zone_linear_fits(congested["zone_id"], congested["fcd_density"], congested["fcd_flow"]).reindex(params.index)
+    params["wave_speed"] = (-fits["slope"]).where(fits["slope"] < 0)
+    params["jam_density"] = fits["intercept"] / params["wave_speed"]
+
+    return params
+
+
+# Function to predict the flow of a model
+def model_flow(model, params, density) -> np.ndarray:
+    """
+    Flow predicted by a model for every point
+    :param model: a name from FD_MODELS
+    :param params: DataFrame with the parameters of the zone of every point, aligned with density
+    :param density:
+    :return:
+    """
+    k = np.asarray(density, dtype=float)
+
+    if model == "greenshields":
+        return params["free_flow_speed"].to_numpy() * k * (1 - k / params["jam_density"].to_numpy())
+    if model == "greenberg":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return params["critical_speed"].to_numpy() * k * np.log(params["jam_density"].to_numpy() / k)
+    if model == "underwood":
+        return params["free_flow_speed"].to_numpy() * k * np.exp(-k / params["critical_density"].to_numpy())
+
+    # Triangular, capped at the capacity when the congested branch could not be fitted
+    free_flow = params["free_flow_speed"].to_numpy() * k
+    congested = params["wave_speed"].to_numpy() * (params["jam_density"].to_numpy() - k)
+    return np.minimum(free_flow, np.where(np.isnan(congested), params["capacity"].to_numpy(), congested))
+
+
+# Function to fit all the models
+def fit_all_models(df, capacity_quantile) -> pd.DataFrame:
+    """
+    Fit every model of FD_MODELS for every zone and score it on the observed flow
+    :param df: FCD points with zone_id, fcd_speed, fcd_flow and fcd_density
+    :param capacity_quantile: quantile of the flow taken as the capacity of the triangular model
+    :return: DataFrame with the PARAMETER_COLUMNS, one row per zone and model
+    """
+    df = df.dropna(subset=["fcd_speed", "fcd_flow", "fcd_density"])
+    df = df[df["fcd_density"] > 0].reset_index(drop=True)
+
+    fitters = {
+        "greenshields": fit_greenshields,
+        "greenberg": fit_greenberg,
+        "underwood": fit_underwood,
+        "triangular": lambda points: fit_triangular(points, capacity_quantile)
+    }
+
+    tables = []
+    for model in FD_MODELS:
+        params = fitters[model](df).reindex(columns=PARAMETER_COLUMNS[2:9])
+
+        # Score every zone on the flow predicted at its observed densities
+        point_params = params.reindex(df["zone_id"]).reset_index(drop=True)
+        residuals = df["fcd_flow"] - model_flow(model, point_params, df["fcd_density"])
+        scores = pd.DataFrame({
+            "zone_id": df["zone_id"],
+            "squared_error": residuals ** 2,
+            "squared_deviation": (df["fcd_flow"] - df.groupby("zone_id")["fcd_flow"].transform("mean")) ** 2,
+            "missing": residuals.isna()
+        }).groupby("zone_id", sort=True).agg(sse=("squared_error", "sum"), sst=("squared_deviation", "sum"), n=("squared_error", "size"), missing=("missing", "any"))
+
+        # Zones whose model could not be fitted are not scored
+        sse = scores["sse"].where(~scores["missing"])
+        params["r2"] = 1 - sse / scores["sst"].where(scores["sst"] > 0)
+        params["rmse"] = np.sqrt(sse / scores["n"])
+        params["model"] = model
+        tables.append(params.rename_axis("zone_id").reset_index())
+
+    parameters = pd.concat(tables, ignore_index=True)[PARAMETER_COLUMNS]
+    return parameters.sort_values(["zone_id", "model"], kind="stable", ignore_index=True)
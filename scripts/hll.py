@@ -0,0 +1,171 @@
+"""
+Description:
+HyperLogLog sketches for approximate distinct vehicle counts.
+A sketch is stored sparsely as a sorted list of packed integers `register << 6 | rank`, one per
+non-empty register, so the sketch of a bin with a few dozen vehicles stays a few dozen integers.
+Two sketches of the same precision are merged by keeping the largest rank of every register,
+which is also the largest packed value, so coarser bins and zone groups are computed by merging
+the sketches of their parts, in Python or in SQL.
+"""
+
+# Import the necessary libraries and modules
+import math
+import numpy as np
+
+# Bits of the packed value holding the rank
+RANK_BITS = 6
+RANK_MASK = (1 << RANK_BITS) - 1
+
+# Modulus of the unsigned 64-bit arithmetic of the SQL hash, done on numeric values
+UINT64 = 1 << 64
+
+# Smallest and largest supported precision (number of register bits)
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+# Function to choose the precision for an error bound
+def precision_for_error(error) -> int:
+    """
+    Smallest precision whose standard error 1.04 / sqrt(2 ** precision) is at most the given error
+    :param error: relative standard error, e.g. 0.01 for 1 %
+    :return:
+    """
+    precision = math.ceil(math.log2((1.04 / error) ** 2))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+# Function to hash vehicle ids
+def hash_ids(ids) -> np.ndarray:
+    """
+    Hash integer ids to 64 bits with the SplitMix64 finalizer
+    :param ids:
+    :return: an array of uint64 hashes
+    """
+    x = np.asarray(ids, dtype=np.int64).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# Function to compute the bit length of unsigned integers
+def bit_length(values) -> np.ndarray:
+    """
+    Number of bits needed to represent every value, 0 for 0
+    :param values: an array of uint64
+    :return:
+    """
+    values = values.copy()
+    length = np.zeros(values.shape, dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        larger = (values >> np.uint64(shift)) != 0
+        length += larger * shift
+        values = np.where(larger, values >> np.uint64(shift), values)
+    return length + (values != 0)
+
+
+# Function to compute the packed sketch entry of every id
+def packed_entries(ids, precision) -> np.ndarray:
+    """
+    Packed `register << 6 | rank` entry of every id. The register is given by the first
+    `precision` bits of the hash and the rank by the position of the first 1 bit after them.
+    :param ids:
+    :param precision:
+    :return: an array of int64
+    """
+    hashes = hash_ids(ids)
+    remaining_bits = 64 - precision
+    registers = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+    rest = hashes & np.uint64((1 << remaining_bits) - 1)
+    ranks = remaining_bits - bit_length(rest) + 1
+    return (registers << RANK_BITS) | ranks
+
+
+# Function to build the SQL query of the packed sketch entry of every id
+def sql_packed_entries(ids_query, precision) -> str:
+    """
+    SQL query computing the same packed entries as packed_entries in the database. The SplitMix64
+    multiplications are done modulo 2 ** 64 on numeric values and the shifts and xors on bit(64) values.
+    :param ids_query: SQL query returning the ids in an `id` column
+    :param precision:
+    :return: SQL query returning the id and its packed entry
+    """
+    def bits(value) -> str:
+        return f"(CASE WHEN {value} >= {UINT64 >> 1} THEN {value} - {UINT64} ELSE {value} END)::bigint::bit(64)"
+
+    def unsigned(value) -> str:
+        return f"(({value})::bigint::numeric + {UINT64}) % {UINT64}"
+
+    def mix(value, shift) -> str:
+        return f"{bits(value)} # ({bits(value)} >> {shift})"
+
+    remaining_bits = 64 - precision
+    return f"""
+        SELECT ids.id,
+               (((h.hash >> {remaining_bits})::bigint << {RANK_BITS})
+                | CASE position(B'1' IN substring(h.hash FROM {precision + 1})) WHEN 0 THEN {remaining_bits + 1}
+                  ELSE position(B'1' IN substring(h.hash FROM {precision + 1})) END)::integer AS entry
+        FROM ({ids_query}) ids,
+        LATERAL (SELECT (ids.id::numeric + {UINT64 + 0x9E3779B97F4A7C15}) % {UINT64} AS x) s0,
+        LATERAL (SELECT ({unsigned(mix("s0.x", 30))} * {0xBF58476D1CE4E5B9}) % {UINT64} AS x) s1,
+        LATERAL (SELECT ({unsigned(mix("s1.x", 27))} * {0x94D049BB133111EB}) % {UINT64} AS x) s2,
+        LATERAL (SELECT {mix("s2.x", 31)} AS hash) h
+    """
+
+
+# Function to build the sketch of a set of ids
+def sketch(ids, precision) -> list:
+    """
+    Build the sparse sketch of a set of ids
+    :param ids:
+    :param precision:
+    :return: a sorted list of packed entries
+    """
+    return merge([packed_entries(ids, precision)])
+
+
+# Function to merge sketches
+def merge(sketches) -> list:
+    """
+    Merge sketches of the same precision by keeping the largest rank of every register
+    :param sketches: an iterable of sketches (lists or arrays of packed entries)
+    :return: a sorted list of packed entries
+    """
+    entries = np.concatenate([np.asarray(entries, dtype=np.int64) for entries in sketches] or [np.empty(0, np.int64)])
+    entries = np.sort(entries)
+
+    # The largest entry of every register is the last one of its run
+    registers = entries >> RANK_BITS
+    last = np.append(registers[1:] != registers[:-1], True) if len(entries) else np.empty(0, bool)
+    return entries[last].tolist()
+
+
+# Function to estimate the number of distinct ids of many sketches
+def estimate_many(filled, inverse_sums, precision) -> np.ndarray:
+    """
+    Estimate the number of distinct ids of many sketches at once, with linear counting for small cardinalities
+    :param filled: number of non-empty registers of every sketch
+    :param inverse_sums: sum of 2 ** -rank over the non-empty registers of every sketch
+    :param precision:
+    :return: an array of estimates
+    """
+    registers = 1 << precision
+    empty = registers - np.asarray(filled, dtype=float)
+
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(registers, 0.7213 / (1 + 1.079 / registers))
+    raw_estimates = alpha * registers ** 2 / (empty + np.asarray(inverse_sums, dtype=float))
+    linear_counts = registers * np.log(registers / np.maximum(empty, 1))
+
+    return np.where((raw_estimates <= 2.5 * registers) & (empty > 0), linear_counts, raw_estimates)
+
+
+# Function to estimate the number of distinct ids of a sketch
+def estimate(entries, precision) -> float:
+    """
+    Estimate the number of distinct ids of a sketch, with linear counting for small cardinalities
+    :param entries:
+    :param precision:
+    :return:
+    """
+    ranks = np.asarray(entries, dtype=np.int64) & RANK_MASK
+    return float(estimate_many([len(ranks)], [np.sum(np.exp2(-ranks.astype(float)))], precision)[0])
@@ -0,0 +1,152 @@
+"""
+Description:
+Deferred index maintenance for bulk loads of the point table.
+Secondary indexes are dropped before a bulk import and rebuilt afterwards, one connection per
+index so that they are built in parallel. The composite indexes below match the access paths
+of the analysis scripts and of the map views (see the PointData model in Map/mmm/models.py).
+The definitions of the dropped indexes are kept in `data.pending_indexes` until they are rebuilt, so the
+indexes dropped by an import that fails are rebuilt by the next successful run.
+"""
+
+# Import the necessary libraries and modules
+import logging
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+
+# Name of the table of the dropped indexes still to be rebuilt
+PENDING_INDEX_TABLE = "data.pending_indexes"
+
+
+# Function to list the indexes matching the access paths of the scripts and views
+def analysis_indexes(schema, table) -> dict:
+    """
+    Index definitions for the point table, keyed by index name
+    :param schema:
+    :param table:
+    :return:
+    """
+    return {
+        # Zone time series of scripts 02, 05, 07 and 08
+        "data_zone_class_dt_idx":
+            f"CREATE INDEX IF NOT EXISTS data_zone_class_dt_idx ON {schema}.{table} (zone_id, vehicle_class, dt)",
+        # Vehicle and trip lookups of the map views
+        "data_vehicle_trip_dt_idx":
+            f"CREATE INDEX IF NOT EXISTS data_vehicle_trip_dt_idx ON {schema}.{table} (vehicle_id, trip_id, dt)",
+        # Date range scans
+        "data_dt_brin_idx":
+            f"CREATE INDEX IF NOT EXISTS data_dt_brin_idx ON {schema}.{table} USING brin (dt)"
+    }
+
+
+# Function to create the table of the pending indexes
+def create_pending_index_table(conn) -> None:
+    """
+    Create the table of the dropped indexes still to be rebuilt if it does not exist
+    :param conn:
+    :return:
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PENDING_INDEX_TABLE} (
+            table_name TEXT NOT NULL,
+            index_name TEXT NOT NULL,
+            definition TEXT NOT NULL,
+            dropped_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name, index_name)
+        )
+        """)
+    conn.commit()
+
+
+# Function to drop the secondary indexes of a table
+def drop_secondary_indexes(conn, schema, table) -> dict:
+    """
+    Drop every index of the table that does not back a constraint, recording the dropped indexes
+    as pending in the same transaction
+    :param conn:
+    :param schema:
+    :param table:
+    :return: the definitions of all the pending indexes of the table, including those dropped by
+             earlier runs that were not rebuilt, keyed by index name
+    """
+    create_pending_index_table(conn)
+    with conn.cursor() as cursor:
+        cursor.execute("""
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+        """, (f"{schema}.{table}",))
+        dropped = dict(cursor.fetchall())
+
+        for index_name, definition in dropped.items():
+            cursor.execute(f'DROP INDEX IF EXISTS {schema}."{index_name}"')
+            cursor.execute(f"""
+            INSERT INTO {PENDING_INDEX_TABLE} (table_name, index_name, definition) VALUES (%s, %s, %s)
+            ON CONFLICT (table_name, index_name) DO UPDATE SET definition = EXCLUDED.definition
+            """, (f"{schema}.{table}", index_name, definition))
+
+        cursor.execute(f"SELECT index_name, definition FROM {PENDING_INDEX_TABLE} WHERE table_name = %s", (f"{schema}.{table}",))
+        pending = dict(cursor.fetchall())
+    conn.commit()
+
+    return pending
+
+
+# Function to load the pending indexes of a table
+def load_pending_indexes(conn, schema, table) -> dict:
+    """
+    Load the indexes dropped by earlier runs that were not rebuilt
+    :param conn:
+    :param schema:
+    :param table:
+    :return: the definitions of the pending indexes of the table keyed by index name
+    """
+    create_pending_index_table(conn)
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT index_name, definition FROM {PENDING_INDEX_TABLE} WHERE table_name = %s", (f"{schema}.{table}",))
+        pending = dict(cursor.fetchall())
+    conn.commit()
+
+    return pending
+
+
+# Function to clear the pending indexes of a table
+def clear_pending_indexes(conn, schema, table, index_names) -> None:
+    """
+    Remove rebuilt indexes from the pending indexes
+    :param conn:
+    :param schema:
+    :param table:
+    :param index_names:
+    :return:
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {PENDING_INDEX_TABLE} WHERE table_name = %s AND index_name = ANY(%s)", (f"{schema}.{table}", list(index_names)))
+    conn.commit()
+
+
+# Function to build indexes in parallel
+def build_indexes(db_params, index_definitions, workers) -> None:
+    """
+    Build indexes in parallel, each on its own connection
+    :param db_params:
+    :param index_definitions: CREATE INDEX statements keyed by index name
+    :param workers:
+    :return:
+    """
+    def build(index_name, definition) -> None:
+        conn = psycopg2.connect(**db_params)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(definition)
+            conn.commit()
+            logging.info(f"Index {index_name} built.")
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(build, name, definition) for name, definition in index_definitions.items()]
+        for future in futures:
+            future.result()
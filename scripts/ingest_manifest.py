@@ -0,0 +1,114 @@
+"""
+Description:
+Chunk manifest for resumable ingestion.
+Every chunk loaded by '01_read_and_insert_data_into_database.py' is recorded in the
+`data.ingest_manifest` table in the same transaction as its rows, so a chunk is either
+fully loaded and recorded or not loaded at all. A re-run skips the recorded chunks.
+"""
+
+# Name of the manifest table
+MANIFEST_TABLE = "data.ingest_manifest"
+
+
+# Function to create the manifest table
+def create_manifest_table(conn) -> None:
+    """
+    Create the manifest table if it does not exist
+    :param conn:
+    :return:
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            file_name TEXT NOT NULL,
+            chunk_number INTEGER NOT NULL,
+            start_offset BIGINT NOT NULL,
+            end_offset BIGINT NOT NULL,
+            row_count BIGINT NOT NULL,
+            checksum TEXT NOT NULL,
+            inserted_rows BIGINT NOT NULL,
+            malformed_rows BIGINT NOT NULL,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (file_name, chunk_number)
+        )
+        """)
+    conn.commit()
+
+
+# Function to load the manifest of a file
+def load_manifest(conn, file_name) -> dict:
+    """
+    Load the recorded chunks of a file
+    :param conn:
+    :param file_name:
+    :return: a dict of chunk_number -> chunk_info
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        SELECT chunk_number, start_offset, end_offset, row_count, checksum
+        FROM {MANIFEST_TABLE}
+        WHERE file_name = %s
+        """, (file_name,))
+        rows = cursor.fetchall()
+
+    return {
+        chunk_number: {
+            "file_name": file_name,
+            "chunk_number": chunk_number,
+            "start_offset": start_offset,
+            "end_offset": end_offset,
+            "row_count": row_count,
+            "checksum": checksum
+        }
+        for chunk_number, start_offset, end_offset, row_count, checksum in rows
+    }
+
+
+# Function to check whether a chunk was already loaded
+def is_loaded(manifest, chunk_info) -> bool:
+    """
+    Check whether a chunk was already loaded. A recorded chunk with different offsets or
+    checksum means the file or the chunk size changed since the last run, which cannot be
+    resumed safely.
+    :param manifest:
+    :param chunk_info:
+    :return:
+    """
+    recorded = manifest.get(chunk_info["chunk_number"])
+    if recorded is None:
+        return False
+
+    for key in ["start_offset", "end_offset", "checksum"]:
+        if recorded[key] != chunk_info[key]:
+            raise ValueError(
+                f"Chunk {chunk_info['chunk_number']} of '{chunk_info['file_name']}' does not match the manifest "
+                f"({key} changed). Truncate the table and the manifest before reloading the file."
+            )
+
+    return True
+
+
+# Function to record a loaded chunk
+def record_chunk(cursor, chunk_info, inserted_rows, malformed_rows) -> None:
+    """
+    Record a chunk in the manifest. Must run in the transaction that loads the chunk.
+    :param cursor:
+    :param chunk_info:
+    :param inserted_rows:
+    :param malformed_rows:
+    :return:
+    """
+    cursor.execute(f"""
+    INSERT INTO {MANIFEST_TABLE}
+        (file_name, chunk_number, start_offset, end_offset, row_count, checksum, inserted_rows, malformed_rows)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, (
+        chunk_info["file_name"],
+        chunk_info["chunk_number"],
+        chunk_info["start_offset"],
+        chunk_info["end_offset"],
+        chunk_info["row_count"],
+        chunk_info["checksum"],
+        inserted_rows,
+        malformed_rows
+    ))
@@ -0,0 +1,85 @@
+"""
+Description:
+Incremental writers of the origin-destination outputs.
+The trips ('origin_destination.csv') and the points with their trip ('final_all_df.csv') are appended
+one day at a time, so the points of the whole period are never held in memory. With
+"od_compression": "gzip" the files are written as '.csv.gz': every append adds a gzip member, and the
+file is still read back as one CSV by pandas. The day-local trip numbers are turned into global trip
+ids with a running offset.
+"""
+
+# Import the necessary libraries and modules
+import os
+import numpy as np
+import pandas as pd
+from trip_segmentation import vehicle_trip_counts
+
+# Names and columns of the outputs
+OD_FILENAME = "origin_destination"
+POINTS_FILENAME = "final_all_df"
+OD_COLUMNS = [
+    'gid', 'direction', 'velocity', 'dt', 'status', 'vehicle_id', 'vehicle_class', 'zone_id', 'fid',
+    'x1', 'y1', 'x2', 'y2', 'origin_zone', 'destination_zone', 'trip_id'
+]
+POINT_COLUMNS = [
+    'gid', 'x', 'y', 'direction', 'velocity', 'dt', 'status', 'vehicle_id', 'vehicle_class', 'zone_id', 'trip_id', 'fid',
+    'ts_insert'
+]
+
+
+# Function to name an output file
+def output_path(name, compression=None) -> str:
+    """
+    Path of an output in the data folder
+    :param name: OD_FILENAME or POINTS_FILENAME
+    :param compression: "gzip" or None
+    :return:
+    """
+    return os.path.join("data", f"{name}.csv.gz" if compression == "gzip" else f"{name}.csv")
+
+
+# Function to number the trips of one day
+def number_trips(points, od, offset) -> int:
+    """
+    Set the 'trip_id' of the points and trips of one day from their day-local 'trips' numbers,
+    the trips being numbered after the trips of the previous days
+    :param points:
+    :param od: one row per trip of the day
+    :param offset: number of trips of the previous days
+    :return: the offset of the next day
+    """
+    trip_ids = pd.Series(offset + np.arange(1, len(od) + 1), index=od["trips"].to_numpy())
+    od["trip_id"] = trip_ids.to_numpy()
+    points["trip_id"] = points["trips"].map(trip_ids).to_numpy()
+    return offset + len(od)
+
+
+# Function to number the trips of one vehicle shard
+def number_vehicle_trips(points, od, offsets) -> None:
+    """
+    Set the 'trip_id' of the points and trips of one vehicle shard, the trips of every vehicle being
+    numbered after the offset of the vehicle
+    :param points:
+    :param od: one row per trip of the shard, sorted by vehicle and time
+    :param offsets: trip id offset of every vehicle of the shard, in vehicle order
+    :return:
+    """
+    _, counts = vehicle_trip_counts(od)
+
+    # Position of every trip among the trips of its vehicle, added to the offset of the vehicle
+    positions = np.arange(1, len(od) + 1) - np.repeat(np.cumsum(counts) - counts, counts)
+    trip_ids = pd.Series(np.repeat(np.asarray(offsets, dtype=np.int64), counts) + positions, index=od["trips"].to_numpy())
+    od["trip_id"] = trip_ids.to_numpy()
+    points["trip_id"] = points["trips"].map(trip_ids).to_numpy()
+
+
+# Function to append rows to an output
+def append_rows(df, path, first) -> None:
+    """
+    Write the rows of one day, replacing the file for the first day of a run
+    :param df:
+    :param path:
+    :param first:
+    :return:
+    """
+    df.to_csv(path, index=False, mode="w" if first else "a", header=first, date_format="%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,126 @@
+"""
+Description:
+Columnar Parquet landing store for the FCD points.
+The raw CSV is converted once into a Parquet dataset partitioned by day and zone
+(`date=2019-09-01/zone_id=123/...`), with the columns named as in the database.
+`read_points` reads it back with column projection and predicate pushdown, so reading three
+columns of one zone only touches those columns of that zone's files. `iter_points` streams the
+same selection batch by batch.
+"""
+
+# Import the necessary libraries and modules
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from cleaning import COLUMN_MAPPING, clean_chunk, read_raw_chunks
+
+# Partitioning of the dataset: one directory per day and zone
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string()), ("zone_id", pa.int64())]), flavor="hive")
+
+
+# Function to convert the raw CSV file into the Parquet dataset
+def convert_csv_to_parquet(data_path, dataset_path, chunk_size, dt_format) -> tuple:
+    """
+    Clean the raw CSV file chunk by chunk and write it into the partitioned Parquet dataset
+    :param data_path:
+    :param dataset_path:
+    :param chunk_size:
+    :param dt_format:
+    :return: (total_rows, total_malformed)
+    """
+    total_rows = 0
+    total_malformed = 0
+
+    for chunk_number, chunk in enumerate(read_raw_chunks(data_path, chunk_size), start=1):
+        chunk, malformed = clean_chunk(chunk, dt_format)
+
+        # Use the database column names and types
+        chunk = chunk[list(COLUMN_MAPPING.values())].rename(columns={raw: column for column, raw in COLUMN_MAPPING.items()})
+        chunk["status"] = chunk["status"].astype("int16")
+        chunk["date"] = chunk["dt"].dt.strftime("%Y-%m-%d")
+
+        # A chunk can span more days x zones than the 1024 directories pyarrow writes by default
+        partitions = max(chunk.groupby(["date", "zone_id"]).ngroups, 1024)
+
+        ds.write_dataset(
+            pa.Table.from_pandas(chunk, preserve_index=False),
+            dataset_path,
+            format="parquet",
+            partitioning=PARTITIONING,
+            basename_template=f"part-{chunk_number}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=partitions,
+            max_open_files=partitions
+        )
+
+        total_rows += len(chunk)
+        total_malformed += malformed
+
+    return total_rows, total_malformed
+
+
+# Function to build the filter of the points
+def point_filter(dates=None, zone_ids=None, vehicle_class=None, vehicle_shard=None):
+    """
+    Filter expression selecting the points of some days, zones, vehicle class and vehicle shard
+    :param dates: a date string or a list of date strings (YYYY-MM-DD)
+    :param zone_ids: a list of zone ids
+    :param vehicle_class:
+    :param vehicle_shard: (shard, shards) to select only the vehicles whose id modulo shards is shard, in absolute value
+    :return: a dataset expression, None to select every point
+    """
+    conditions = []
+    if dates is not None:
+        dates = [dates] if isinstance(dates, str) else list(dates)
+        conditions.append(ds.field("date").isin(dates))
+    if zone_ids is not None:
+        conditions.append(ds.field("zone_id").isin([int(zone_id) for zone_id in zone_ids]))
+    if vehicle_class is not None:
+        conditions.append(ds.field("vehicle_class") == vehicle_class)
+    if vehicle_shard is not None:
+        shard, shards = vehicle_shard
+        vehicle_id = ds.field("vehicle_id")
+        conditions.append(pc.abs(pc.subtract(vehicle_id, pc.multiply(pc.divide(vehicle_id, shards), shards))) == shard)
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+# Function to read points from the Parquet dataset
+def read_points(dataset_path, columns=None, dates=None, zone_ids=None, vehicle_class=None, vehicle_shard=None) -> pd.DataFrame:
+    """
+    Read points from the Parquet dataset. Only the requested columns are read, and the
+    filters are pushed down so that other days and zones are skipped at the directory level.
+    :param dataset_path:
+    :param columns: list of columns to read, all columns if None
+    :param dates: a date string or a list of date strings (YYYY-MM-DD)
+    :param zone_ids: a list of zone ids
+    :param vehicle_class:
+    :param vehicle_shard: (shard, shards) to read only the vehicles whose id modulo shards is shard, in absolute value
+    :return:
+    """
+    dataset = ds.dataset(dataset_path, format="parquet", partitioning=PARTITIONING)
+    expression = point_filter(dates, zone_ids, vehicle_class, vehicle_shard)
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+# Function to stream points from the Parquet dataset
+def iter_points(dataset_path, columns=None, dates=None, zone_ids=None, vehicle_class=None):
+    """
+    Read points from the Parquet dataset batch by batch, with the same projection and filters as
+    read_points, so that only one batch of points is held in memory at a time
+    :param dataset_path:
+    :param columns: list of columns to read, all columns if None
+    :param dates: a date string or a list of date strings (YYYY-MM-DD)
+    :param zone_ids: a list of zone ids
+    :param vehicle_class:
+    :return: an iterator of DataFrames
+    """
+    dataset = ds.dataset(dataset_path, format="parquet", partitioning=PARTITIONING)
+    expression = point_filter(dates, zone_ids, vehicle_class)
+    for batch in dataset.to_batches(columns=columns, filter=expression):
+        if batch.num_rows:
+            yield batch.to_pandas()
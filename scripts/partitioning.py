@@ -0,0 +1,200 @@
+"""
+Description:
+Daily range partitioning of the point table.
+The point table is partitioned by `dt` with one partition per day, named like the former
+per-day tables (e.g. `data.data_2019_09_01`). The loader attaches the partitions a chunk
+needs before writing it, and the analysis scripts select a day with a `dt` range so that
+PostgreSQL only scans the matching partition.
+The table is created by the loader, the Django PointData model only maps it. A table created
+unpartitioned (e.g. by an earlier version of the Django migrations) can be converted in place.
+"""
+
+# Import the necessary libraries and modules
+import threading
+import pandas as pd
+
+# Columns of the point table
+POINT_COLUMNS = """
+    gid BIGINT,
+    x DOUBLE PRECISION NOT NULL,
+    y DOUBLE PRECISION NOT NULL,
+    direction INTEGER NOT NULL,
+    velocity INTEGER NOT NULL,
+    dt TIMESTAMP NOT NULL,
+    status INTEGER NOT NULL,
+    vehicle_id BIGINT NOT NULL,
+    vehicle_class VARCHAR(2) NOT NULL,
+    zone_id BIGINT NOT NULL,
+    trip_id BIGINT,
+    fid BIGINT NOT NULL,
+    ts_insert TIMESTAMP
+"""
+POINT_COLUMN_NAMES = [
+    "gid", "x", "y", "direction", "velocity", "dt", "status", "vehicle_id", "vehicle_class", "zone_id", "trip_id", "fid", "ts_insert"
+]
+
+# Partitions already created by this process
+_known_partitions = set()
+_partitions_lock = threading.Lock()
+
+
+# Function to create the partitioned point table
+def create_partitioned_table(conn, schema, table, convert=False) -> None:
+    """
+    Create the point table partitioned by day on `dt` if it does not exist.
+    An existing table that is not partitioned is converted with convert=True, otherwise it is refused.
+    :param conn:
+    :param schema:
+    :param table:
+    :param convert:
+    :return:
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} ({POINT_COLUMNS}) PARTITION BY RANGE (dt)")
+        cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table
+            WHERE partrelid = %s::regclass
+        )
+        """, (f"{schema}.{table}",))
+        partitioned = cursor.fetchone()[0]
+    conn.commit()
+
+    if partitioned:
+        return
+    if not convert:
+        raise ValueError(
+            f"Table {schema}.{table} exists but is not partitioned. "
+            f"Set \"convert_table\": true to convert it to daily partitions."
+        )
+    convert_to_partitioned(conn, schema, table)
+
+
+# Function to convert an unpartitioned point table
+def convert_to_partitioned(conn, schema, table) -> None:
+    """
+    Convert an unpartitioned point table, e.g. one created by the Django migrations, into the partitioned
+    table. The rows are copied into the daily partitions and the old table is dropped in one transaction,
+    so a failed conversion leaves the table unchanged. Its indexes are dropped with it.
+    :param conn:
+    :param schema:
+    :param table:
+    :return:
+    """
+    old_table = f"{table}_unpartitioned"
+    columns = ", ".join(POINT_COLUMN_NAMES)
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {schema}.{table} RENAME TO {old_table}")
+            cursor.execute(f"CREATE TABLE {schema}.{table} ({POINT_COLUMNS}) PARTITION BY RANGE (dt)")
+
+            # One partition for every day between the first and the last point
+            cursor.execute(f"SELECT min(dt)::date, max(dt)::date FROM {schema}.{old_table}")
+            first, last = cursor.fetchone()
+            days = [] if first is None else list(pd.date_range(first, last, freq="D"))
+            _create_day_partitions(cursor, schema, table, days)
+
+            cursor.execute(f"INSERT INTO {schema}.{table} ({columns}) SELECT {columns} FROM {schema}.{old_table}")
+            cursor.execute(f"DROP TABLE {schema}.{old_table}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    with _partitions_lock:
+        _known_partitions.update(days)
+
+
+# Function to name the partition of a day
+def partition_name(table, day) -> str:
+    """
+    Name of the partition holding one day, e.g. data_2019_09_01
+    :param table:
+    :param day:
+    :return:
+    """
+    return f"{table}_{pd.Timestamp(day):%Y_%m_%d}"
+
+
+# Function to create missing daily partitions
+def ensure_day_partitions(conn, schema, table, days) -> None:
+    """
+    Create and attach the daily partitions for the given days if they do not exist, raising a ValueError
+    when another table already has the name of a partition.
+    Partitions are created under an advisory lock so that parallel writers do not race.
+    :param conn:
+    :param schema:
+    :param table:
+    :param days: dates or timestamps, only their day is used
+    :return:
+    """
+    with _partitions_lock:
+        missing = sorted({pd.Timestamp(day).normalize() for day in days} - _known_partitions)
+    if not missing:
+        return
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{schema}.{table}",))
+            _create_day_partitions(cursor, schema, table, missing)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    with _partitions_lock:
+        _known_partitions.update(missing)
+
+
+# Function to create daily partitions in the current transaction
+def _create_day_partitions(cursor, schema, table, days) -> None:
+    """
+    Create and attach the partitions of the given days, without committing. A table already named like
+    the partition of a day, e.g. a day table split by hand from the point table, is not attached: its rows
+    would be loaded twice, so it must be renamed or attached by hand first.
+    :param cursor:
+    :param schema:
+    :param table:
+    :param days: normalized timestamps
+    :return:
+    """
+    for day in days:
+        name = partition_name(table, day)
+        cursor.execute("""
+        SELECT c.relispartition AND EXISTS (
+            SELECT 1 FROM pg_inherits i
+            WHERE i.inhrelid = c.oid AND i.inhparent = %s::regclass
+        )
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+        """, (f"{schema}.{table}", schema, name))
+        existing = cursor.fetchone()
+
+        if existing is None:
+            cursor.execute(f"""
+            CREATE TABLE {schema}.{name}
+            PARTITION OF {schema}.{table}
+            FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + pd.Timedelta(days=1):%Y-%m-%d}')
+            """)
+        elif not existing[0]:
+            raise ValueError(
+                f"{schema}.{name} exists but is not a partition of {schema}.{table}. Rename it, or attach it with "
+                f"ALTER TABLE {schema}.{table} ATTACH PARTITION {schema}.{name} FOR VALUES FROM ('{day:%Y-%m-%d}') "
+                f"TO ('{day + pd.Timedelta(days=1):%Y-%m-%d}') if its rows are not loaded again."
+            )
+
+
+# Function to build the condition selecting one day
+def day_condition(selected_date, dt_column="dt") -> str:
+    """
+    SQL condition selecting the rows of one day with a half-open `dt` range, which lets
+    PostgreSQL prune every partition except the one of that day
+    :param selected_date:
+    :param dt_column:
+    :return:
+    """
+    day = pd.Timestamp(selected_date).normalize()
+    return f"{dt_column} >= '{day:%Y-%m-%d %H:%M:%S}' AND {dt_column} < '{day + pd.Timedelta(days=1):%Y-%m-%d %H:%M:%S}'"
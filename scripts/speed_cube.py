@@ -0,0 +1,175 @@
+"""
+Description:
+Memory-mapped link speed cube.
+The link-level statistics computed by '05_fcd_calculation.py' are kept on disk as one float32
+array per day and interval, shaped links x intervals x metrics, under
+`data/speed_cube/<interval>/<date>.npy`. The link rows follow a dense fid index built from
+'links.csv' (`data/speed_cube/fids.npy`). The arrays are opened memory-mapped, so slicing a set
+of links over a time range only reads those rows, and congestion, travel time or visualization
+work can use the link speeds without querying the point table again.
+"""
+
+# Import the necessary libraries and modules
+import os
+import numpy as np
+import pandas as pd
+
+# Folder of the cube and metrics stored for every link and interval
+SPEED_CUBE_FOLDER = os.path.join("data", "speed_cube")
+SPEED_CUBE_METRICS = ["avg_speed", "unique_vehicle_count", "point_count"]
+
+
+# Function to build the link index
+def ensure_link_index(links, cube_folder=SPEED_CUBE_FOLDER) -> np.ndarray:
+    """
+    Build the dense fid index from the links (the sorted link IDs, a link's row is its position) and
+    save it, or check that it matches the saved one
+    :param links: DataFrame with the ID of every link
+    :param cube_folder:
+    :return: the sorted link IDs
+    """
+    fids = np.unique(links["ID"].to_numpy(dtype=np.int64))
+    index_path = os.path.join(cube_folder, "fids.npy")
+
+    if os.path.exists(index_path):
+        if not np.array_equal(np.load(index_path), fids):
+            raise ValueError(f"The links do not match the index '{index_path}'. Delete '{cube_folder}' to rebuild the cube.")
+    else:
+        os.makedirs(cube_folder, exist_ok=True)
+        np.save(index_path, fids)
+
+    return fids
+
+
+# Function to load the link index
+def load_link_index(cube_folder=SPEED_CUBE_FOLDER) -> np.ndarray:
+    """
+    Load the sorted link IDs of the cube
+    :param cube_folder:
+    :return:
+    """
+    return np.load(os.path.join(cube_folder, "fids.npy"))
+
+
+# Function to find the rows of links
+def link_rows(fids, index) -> np.ndarray:
+    """
+    Rows of the given links in the cube
+    :param fids:
+    :param index: the sorted link IDs of the cube
+    :return:
+    """
+    fids = np.asarray(fids, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(index, fids), len(index) - 1)
+    missing = index[rows] != fids
+    if missing.any():
+        raise KeyError(f"Links not in the cube index: {fids[missing][:10].tolist()}")
+    return rows
+
+
+# Function to get the intervals of a day
+def day_intervals(selected_date, interval) -> pd.DatetimeIndex:
+    """
+    Start of every interval of a day
+    :param selected_date:
+    :param interval:
+    :return:
+    """
+    return pd.date_range(start=selected_date, periods=pd.Timedelta(days=1) // pd.Timedelta(interval), freq=interval)
+
+
+# Function to name the cube file of a day
+def speed_cube_path(selected_date, interval, cube_folder=SPEED_CUBE_FOLDER) -> str:
+    """
+    Path of the cube of one day and interval
+    :param selected_date:
+    :param interval:
+    :param cube_folder:
+    :return:
+    """
+    return os.path.join(cube_folder, interval, f"{selected_date}.npy")
+
+
+# Function to write the cube of a day
+def write_speed_cube(link_bins, selected_date, interval, cube_folder=SPEED_CUBE_FOLDER) -> str:
+    """
+    Write the link bins of one day into its cube. Links missing from the index are skipped,
+    empty cells are NaN for the speed and 0 for the counts.
+    :param link_bins: DataFrame with interval, fid and the SPEED_CUBE_METRICS columns, one row per link and interval
+    :param selected_date:
+    :param interval:
+    :param cube_folder:
+    :return: the path of the cube
+    """
+    index = load_link_index(cube_folder)
+    times = day_intervals(selected_date, interval)
+    path = speed_cube_path(selected_date, interval, cube_folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    cube = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(len(index), len(times), len(SPEED_CUBE_METRICS)))
+    cube[:, :, 0] = np.nan
+    cube[:, :, 1:] = 0
+
+    fids = link_bins["fid"].to_numpy(dtype=np.int64)
+    rows = np.minimum(np.searchsorted(index, fids), len(index) - 1)
+    known = index[rows] == fids
+    columns = times.get_indexer(pd.to_datetime(link_bins["interval"]))
+    known &= columns >= 0
+
+    cube[rows[known], columns[known], :] = link_bins.loc[known, SPEED_CUBE_METRICS].to_numpy(dtype=np.float32)
+    cube.flush()
+    del cube
+
+    return path
+
+
+# Function to open the cube of a day
+def open_speed_cube(selected_date, interval, cube_folder=SPEED_CUBE_FOLDER) -> np.memmap:
+    """
+    Open the cube of one day memory-mapped, read-only
+    :param selected_date:
+    :param interval:
+    :param cube_folder:
+    :return: an array shaped links x intervals x metrics
+    """
+    return np.load(speed_cube_path(selected_date, interval, cube_folder), mmap_mode="r")
+
+
+# Function to read a slice of the cube
+def read_speed_cube(start, end, interval, fids=None, metrics=None, cube_folder=SPEED_CUBE_FOLDER) -> tuple:
+    """
+    Read the given links and metrics over the half-open time range [start, end), which may span several days.
+    Only the requested slices of the memory-mapped files are read.
+    :param start:
+    :param end:
+    :param interval:
+    :param fids: link IDs, all links if None
+    :param metrics: names from SPEED_CUBE_METRICS, all metrics if None
+    :param cube_folder:
+    :return: (values shaped links x intervals x metrics, fids, intervals)
+    """
+    index = load_link_index(cube_folder)
+    rows = np.arange(len(index)) if fids is None else link_rows(fids, index)
+    metrics = SPEED_CUBE_METRICS if metrics is None else metrics
+    layers = [SPEED_CUBE_METRICS.index(metric) for metric in metrics]
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+
+    parts = []
+    part_times = []
+    for day in pd.date_range(start.normalize(), end - pd.Timedelta(1), freq="D"):
+        times = day_intervals(f"{day:%Y-%m-%d}", interval)
+        selected = (times >= start) & (times < end)
+        columns = np.flatnonzero(selected)
+        if not len(columns):
+            continue
+
+        # Slice the time range first so that only those intervals of the selected links are read
+        cube = open_speed_cube(f"{day:%Y-%m-%d}", interval, cube_folder)
+        parts.append(cube[:, columns[0]:columns[-1] + 1][rows][:, :, layers])
+        part_times.append(times[selected])
+
+    values = np.concatenate(parts, axis=1) if parts else np.empty((len(rows), 0, len(layers)), dtype=np.float32)
+    times = part_times[0].append(part_times[1:]) if part_times else pd.DatetimeIndex([])
+
+    return values, index[rows], times
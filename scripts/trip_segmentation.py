@@ -0,0 +1,260 @@
+"""
+Description:
+Vectorized trip segmentation.
+The points are sorted by vehicle and time, and a trip starts at the first point of a vehicle or after
+a gap longer than "trip_gap" (e.g. "10min") since the previous point of the vehicle. The trip
+boundaries, the single-point trips and the first and last points of every trip are found with array
+operations on the sorted frame, with no Python call per vehicle or per trip.
+Since the trips of a vehicle do not depend on the other vehicles, the vehicles can also be split into
+shards segmented independently, numbered from the trip counts of every vehicle and merged in vehicle
+order, with the trip ids and the order of a serial run.
+"""
+
+# Import the necessary libraries and modules
+import numpy as np
+import pandas as pd
+
+
+# Columns of the state of an open trip, next to the columns of its first point
+STATE_COLUMNS = ["trip_points", "last_dt", "x2", "y2", "destination_zone"]
+
+
+# Function to find the trip starts
+def trip_starts(vehicle_ids, times, gap) -> np.ndarray:
+    """
+    Flag the points starting a trip, the points being sorted by vehicle and time
+    :param vehicle_ids:
+    :param times:
+    :param gap: longest time between two points of the same trip, e.g. '10min'
+    :return: boolean array
+    """
+    vehicle_ids = np.asarray(vehicle_ids)
+    times = np.asarray(times, dtype="datetime64[ns]")
+
+    starts = np.ones(len(vehicle_ids), dtype=bool)
+    starts[1:] = (vehicle_ids[1:] != vehicle_ids[:-1]) | (np.diff(times) > np.timedelta64(pd.Timedelta(gap)))
+    return starts
+
+
+# Function to split points into trips
+def segment_trips(df, gap) -> pd.DataFrame:
+    """
+    Number the trips of the points and drop the trips of a single point
+    :param df: points with vehicle_id and dt
+    :param gap: longest time between two points of the same trip, e.g. '10min'
+    :return: the points of the trips of several points sorted by vehicle and time, with their trip
+             number in 'trips' (numbered before the single-point trips are dropped)
+    """
+    df = df.sort_values(["vehicle_id", "dt"], kind="stable", ignore_index=True)
+    starts = trip_starts(df["vehicle_id"], df["dt"], gap)
+
+    # A point is the last one of its trip when the next point starts a trip
+    ends = np.ones(len(df), dtype=bool)
+    ends[:-1] = starts[1:]
+
+    df["trips"] = np.cumsum(starts)
+    return df[~(starts & ends)].reset_index(drop=True)
+
+
+# Function to build origin-destination rows
+def od_rows(origins, x2, y2, destination_zone) -> pd.DataFrame:
+    """
+    One row per trip, the first point of the trip with the coordinates and zone of its last point
+    :param origins: first point of every trip
+    :param x2: x of the last point of every trip
+    :param y2: y of the last point of every trip
+    :param destination_zone: zone of the last point of every trip
+    :return: DataFrame with the columns of the points, x1, y1, x2, y2, origin_zone and destination_zone
+    """
+    od = origins.reset_index(drop=True)
+    od["x1"] = od["x"]
+    od["y1"] = od["y"]
+    od["x2"] = np.asarray(x2)
+    od["y2"] = np.asarray(y2)
+    od["origin_zone"] = od["zone_id"]
+    od["destination_zone"] = np.asarray(destination_zone)
+    return od
+
+
+# Function to extract the origin and destination of the trips
+def trip_ends(df) -> pd.DataFrame:
+    """
+    One row per trip, the first point of the trip with the coordinates and zone of its last point
+    :param df: points returned by segment_trips
+    :return: DataFrame with the columns of the points, x1, y1, x2, y2, origin_zone and destination_zone
+    """
+    trips = df["trips"].to_numpy()
+    firsts = np.flatnonzero(np.r_[True, trips[1:] != trips[:-1]])[:len(df)]
+    lasts = np.r_[firsts[1:] - 1, len(df) - 1][:len(firsts)]
+
+    last_rows = df.iloc[lasts]
+    return od_rows(df.iloc[firsts], last_rows["x"], last_rows["y"], last_rows["zone_id"])
+
+
+# Function to count the trips of every vehicle
+def vehicle_trip_counts(od) -> tuple:
+    """
+    Number of trips of every vehicle, the trips being sorted by vehicle and time
+    :param od: trips returned by trip_ends
+    :return: (sorted vehicle ids, number of trips of every vehicle)
+    """
+    vehicle_ids = od["vehicle_id"].to_numpy()
+    firsts = np.flatnonzero(np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]])[:len(od)]
+    return vehicle_ids[firsts], np.diff(np.r_[firsts, len(od)])
+
+
+# Function to compute the trip id offsets of the vehicles of all the shards
+def vehicle_offsets(shard_counts, offset) -> list:
+    """
+    Trip id offset of every vehicle, the trips of all the shards being numbered in vehicle order as by a serial run
+    :param shard_counts: (vehicle ids, trip counts) returned by vehicle_trip_counts for every shard
+    :param offset: number of trips of the previous days
+    :return: the offsets of the vehicles of every shard, in the order of shard_counts
+    """
+    vehicle_ids = np.concatenate([ids for ids, _ in shard_counts])
+    counts = np.concatenate([trip_counts for _, trip_counts in shard_counts]).astype(np.int64)
+
+    order = np.argsort(vehicle_ids, kind="stable")
+    offsets = np.empty(len(counts), dtype=np.int64)
+    offsets[order] = offset + np.cumsum(counts[order]) - counts[order]
+    return np.split(offsets, np.cumsum([len(ids) for ids, _ in shard_counts])[:-1])
+
+
+# Function to order concatenated shards by vehicle
+def vehicle_order(df) -> np.ndarray:
+    """
+    Positions sorting concatenated shards by vehicle and time, each shard being sorted by vehicle and time
+    and the shards having no vehicle in common, so only the vehicle blocks need to be sorted
+    :param df: concatenated shards with vehicle_id
+    :return:
+    """
+    vehicle_ids = df["vehicle_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]])[:len(df)]
+    lengths = np.diff(np.r_[starts, len(df)])
+
+    # Move every block from its position to its position in vehicle order
+    order = df["vehicle_id"].iloc[starts].reset_index(drop=True).argsort(kind="stable").to_numpy()
+    block_starts, block_lengths = starts[order], lengths[order]
+    return np.repeat(block_starts - np.r_[0, np.cumsum(block_lengths)[:-1]], block_lengths) + np.arange(len(df))
+
+
+# Function to merge the numbered shards
+def merge_shards(results) -> tuple:
+    """
+    Merge the points and trips of the shards in vehicle and time order
+    :param results: (points, trips) of every shard
+    :return: (points, trips)
+    """
+    points = pd.concat([shard_points for shard_points, _ in results], ignore_index=True)
+    od = pd.concat([shard_od for _, shard_od in results], ignore_index=True)
+    return points.iloc[vehicle_order(points)].reset_index(drop=True), od.iloc[vehicle_order(od)].reset_index(drop=True)
+
+
+# Function to create the state of a trip stitching run
+def new_trip_state() -> dict:
+    """
+    State carried from one day to the next: the open trip of every vehicle and the next trip number
+    :return:
+    """
+    return {"open": None, "next_trip": 1}
+
+
+# Function to segment one day, continuing the trips open at the end of the previous day
+def stitch_day(state, df, selected_date, gap) -> tuple:
+    """
+    Segment the points of one day, the days being given in order. The last trip of every vehicle is kept
+    open in the state with its first point, trip number, number of points and last point, and is continued
+    by the first point of the vehicle on the next day if it comes within the gap. A trip holding a single
+    point at the end of a day keeps that point in the state until the trip gets a second point. The trips
+    are numbered from 1 without gaps when they get their second point, so the numbers are final trip ids.
+    :param state: dict returned by new_trip_state, updated in place
+    :param df: points of the day with vehicle_id, dt, x, y and zone_id
+    :param selected_date:
+    :param gap: longest time between two points of the same trip, e.g. '10min'
+    :return: (points of the trips of several points with their trip id in 'trips',
+              origin-destination rows of the trips closed by this day)
+    """
+    gap = pd.Timedelta(gap)
+    df = df.sort_values(["vehicle_id", "dt"], kind="stable", ignore_index=True)
+    point_columns = list(df.columns) + ["trips"]
+    vehicle_ids = df["vehicle_id"].to_numpy()
+    times = np.asarray(df["dt"], dtype="datetime64[ns]")
+
+    carried = state["open"]
+    if carried is None:
+        carried = df.iloc[:0].assign(trips=np.int64(0), trip_points=np.int64(0), last_dt=pd.NaT, x2=np.nan, y2=np.nan, destination_zone=df["zone_id"].iloc[:0])
+    carried = carried.set_index(carried["vehicle_id"].to_numpy())
+
+    # Local trips of the day, with their first and last rows
+    starts = trip_starts(vehicle_ids, times, gap)
+    firsts = np.flatnonzero(starts)
+    lasts = np.r_[firsts[1:] - 1, len(df) - 1][:len(firsts)]
+    trip_vehicles = vehicle_ids[firsts]
+    first_of_vehicle = np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]][firsts]
+    last_of_vehicle = np.r_[vehicle_ids[1:] != vehicle_ids[:-1], True][lasts]
+
+    # The first trip of a vehicle continues its open trip when it starts within the gap
+    carried_last = np.asarray(carried["last_dt"].reindex(trip_vehicles), dtype="datetime64[ns]")
+    continued = first_of_vehicle & (times[firsts] - carried_last <= np.timedelta64(gap))
+    continued_vehicles = trip_vehicles[continued]
+    carried_points = np.where(continued, carried["trip_points"].reindex(trip_vehicles).fillna(0).to_numpy(dtype=np.int64), 0)
+    totals = lasts - firsts + 1 + carried_points
+
+    # A trip is numbered once it has two points, in the order of the sorted points, so the numbers have no gaps
+    numbers = np.zeros(len(firsts), dtype=np.int64)
+    numbers[continued] = carried["trips"].reindex(continued_vehicles).to_numpy(dtype=np.int64)
+    numbering = (numbers == 0) & (totals >= 2)
+    numbers[numbering] = state["next_trip"] + np.arange(numbering.sum())
+    state["next_trip"] += int(numbering.sum())
+    df["trips"] = numbers[np.cumsum(starts) - 1]
+
+    # First point of every trip, carried from the previous day for the continued trips
+    continued_rows = carried.loc[continued_vehicles, point_columns]
+    origins = pd.concat([df.iloc[firsts[~continued]].assign(local=np.flatnonzero(~continued)), continued_rows.assign(local=np.flatnonzero(continued))])
+    origins = origins.sort_values("local", kind="stable").drop(columns="local").reset_index(drop=True)
+    origins["trips"] = numbers
+    last_rows = df.iloc[lasts].reset_index(drop=True)
+
+    # Open trips of the previous day that are not continued are closed, unless their vehicle may still come back
+    day_end = np.datetime64(pd.Timestamp(selected_date).normalize() + pd.Timedelta(days=1))
+    not_continued = ~carried.index.isin(continued_vehicles)
+    expired = carried.index.isin(trip_vehicles) | (day_end - np.asarray(carried["last_dt"], dtype="datetime64[ns]") > np.timedelta64(gap))
+    closed = carried[not_continued & expired]
+    closed = closed[closed["trip_points"] >= 2]
+
+    # Trips closed by this day, and the last trip of every vehicle left open
+    day_closed = ~last_of_vehicle & (totals >= 2)
+    od = pd.concat([
+        od_rows(closed[point_columns], closed["x2"], closed["y2"], closed["destination_zone"]),
+        od_rows(origins[day_closed], last_rows.loc[day_closed, "x"], last_rows.loc[day_closed, "y"], last_rows.loc[day_closed, "zone_id"])
+    ], ignore_index=True)
+
+    opened = origins[last_of_vehicle].reset_index(drop=True)
+    opened["trip_points"] = totals[last_of_vehicle]
+    opened["last_dt"] = times[lasts][last_of_vehicle]
+    opened["x2"] = last_rows.loc[last_of_vehicle, "x"].to_numpy()
+    opened["y2"] = last_rows.loc[last_of_vehicle, "y"].to_numpy()
+    opened["destination_zone"] = last_rows.loc[last_of_vehicle, "zone_id"].to_numpy()
+    state["open"] = pd.concat([carried[not_continued & ~expired], opened], ignore_index=True)
+
+    # Points of the trips of several points, with the point held for a continued single-point trip
+    held = origins[continued & (carried_points == 1)]
+    points = pd.concat([held, df[(totals >= 2)[np.cumsum(starts) - 1]]], ignore_index=True)
+    points = points.sort_values(["vehicle_id", "dt"], kind="stable", ignore_index=True)
+
+    return points, od
+
+
+# Function to close the trips left open at the end of a stitching run
+def close_trips(state) -> pd.DataFrame:
+    """
+    Origin-destination rows of the open trips of several points, the single points held are dropped
+    :param state: dict returned by new_trip_state, emptied
+    :return:
+    """
+    carried, state["open"] = state["open"], None
+    if carried is None:
+        return pd.DataFrame()
+
+    closed = carried[carried["trip_points"] >= 2]
+    return od_rows(closed.drop(columns=STATE_COLUMNS), closed["x2"], closed["y2"], closed["destination_zone"])
@@ -0,0 +1,354 @@
+"""
+Description:
+Incrementally maintained zone and link cubes.
+The cubes hold the sufficient statistics of every (zone_id, vehicle_class, bin_start) bin, and
+of every link (fid) inside it: the distinct vehicles, the speed sum and the point count.
+The distinct vehicles are kept as the sorted set of vehicle ids with `"distinct_count": "exact"`,
+or as a HyperLogLog sketch (see hll.py) with `"distinct_count": "hll"`, whose error is bounded by
+`"hll_error"`. '01_read_and_insert_data_into_database.py' merges every chunk into the cubes in the
+same transaction as its rows, so the cubes always match the loaded points. Scripts 02, 05 and 08
+read them with `"source": "cube"` instead of rescanning the points, and bins can be rolled up to
+coarser intervals and zone groups by merging the sets or sketches of their parts.
+"""
+
+# Import the necessary libraries and modules
+import hll
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+from partitioning import day_condition
+
+# Names of the cube tables
+ZONE_CUBE_TABLE = "data.zone_cube"
+LINK_CUBE_TABLE = "data.link_cube"
+
+# Keys of the cube tables
+ZONE_KEYS = ["zone_id", "vehicle_class", "bin_start"]
+LINK_KEYS = ["zone_id", "vehicle_class", "bin_start", "fid"]
+
+# Merge of the distinct vehicles of an existing bin (cube) with the ones of a new chunk (EXCLUDED).
+# The result is NULL when either side was loaded with the other distinct count mode.
+MERGE_VEHICLE_IDS = """
+    CASE WHEN cube.vehicle_ids IS NULL OR EXCLUDED.vehicle_ids IS NULL THEN NULL
+    ELSE ARRAY(SELECT DISTINCT v FROM unnest(cube.vehicle_ids || EXCLUDED.vehicle_ids) AS v ORDER BY v) END
+"""
+MERGE_VEHICLE_SKETCH = f"""
+    CASE WHEN cube.vehicle_sketch IS NULL OR EXCLUDED.vehicle_sketch IS NULL THEN NULL
+    ELSE ARRAY(SELECT max(v) FROM unnest(cube.vehicle_sketch || EXCLUDED.vehicle_sketch) AS v GROUP BY v >> {hll.RANK_BITS} ORDER BY 1) END
+"""
+
+
+# Function to create the cube tables
+def create_cube_tables(conn) -> None:
+    """
+    Create the zone and link cube tables if they do not exist
+    :param conn:
+    :return:
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ZONE_CUBE_TABLE} (
+            zone_id BIGINT NOT NULL,
+            vehicle_class VARCHAR(2) NOT NULL,
+            bin_start TIMESTAMP NOT NULL,
+            vehicle_ids BIGINT[],
+            vehicle_sketch INTEGER[],
+            speed_sum BIGINT NOT NULL,
+            point_count BIGINT NOT NULL,
+            PRIMARY KEY (zone_id, vehicle_class, bin_start)
+        )
+        """)
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LINK_CUBE_TABLE} (
+            zone_id BIGINT NOT NULL,
+            vehicle_class VARCHAR(2) NOT NULL,
+            bin_start TIMESTAMP NOT NULL,
+            fid BIGINT NOT NULL,
+            vehicle_ids BIGINT[],
+            vehicle_sketch INTEGER[],
+            speed_sum BIGINT NOT NULL,
+            point_count BIGINT NOT NULL,
+            PRIMARY KEY (zone_id, vehicle_class, bin_start, fid)
+        )
+        """)
+
+        # Cubes created before the sketches were added
+        for table in [ZONE_CUBE_TABLE, LINK_CUBE_TABLE]:
+            cursor.execute(f"""
+            ALTER TABLE {table}
+                ADD COLUMN IF NOT EXISTS vehicle_sketch INTEGER[],
+                ALTER COLUMN vehicle_ids DROP NOT NULL
+            """)
+    conn.commit()
+
+
+# Function to get the sketch precision of the cubes
+def cube_precision(config):
+    """
+    Precision of the HyperLogLog sketches of the cubes
+    :param config:
+    :return: the precision for "hll_error", or None when the exact vehicle ids are kept
+    """
+    if config["input_data"]["distinct_count"] == "hll":
+        return hll.precision_for_error(config["input_data"]["hll_error"])
+    return None
+
+
+# Function to check that the analysis interval can be read from the cubes
+def check_cube_interval(config) -> None:
+    """
+    The cubes are binned with "cube_interval" at ingest, so they can only answer queries with the same interval
+    :param config:
+    :return:
+    """
+    cube_interval = pd.Timedelta(config["input_data"]["cube_interval"])
+    time_interval = pd.Timedelta(config["operation"]["time_interval"])
+    if time_interval != cube_interval:
+        raise ValueError(
+            f"The time interval {config['operation']['time_interval']} does not match the cube interval "
+            f"{config['input_data']['cube_interval']}. Use another source or rebuild the cubes with this interval."
+        )
+
+
+# Function to aggregate a cleaned chunk into cube rows
+def chunk_cube_rows(chunk, cube_interval, precision=None) -> tuple:
+    """
+    Aggregate a cleaned chunk (raw column names) into zone and link cube rows
+    :param chunk:
+    :param cube_interval:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are kept if None
+    :return: (zone_rows, link_rows), lists of tuples sorted by key
+    """
+    points = pd.DataFrame({
+        "zone_id": chunk["mm_id_zona"].astype("int64"),
+        "vehicle_class": chunk["classe_veicolo"].astype(str),
+        "bin_start": chunk["dt"].dt.floor(cube_interval),
+        "fid": chunk["mm_fid"].astype("int64"),
+        "vehicle_id": chunk["id_veicolo"].astype("int64"),
+        "velocity": chunk["vel"].astype("int64")
+    })
+
+    if precision is not None:
+        entries = hll.packed_entries(points["vehicle_id"].to_numpy(), precision)
+        points["entry"] = entries
+        points["register"] = entries >> hll.RANK_BITS
+
+    def aggregate(keys) -> list:
+        grouped = points.groupby(keys, sort=True)
+        stats = grouped["velocity"].agg(speed_sum="sum", point_count="size").reset_index()
+        columns = [stats[key].tolist() for key in keys]
+
+        if precision is None:
+            vehicle_ids = [np.sort(ids).tolist() for ids in grouped["vehicle_id"].unique()]
+            vehicle_sketches = [None] * len(stats)
+        else:
+            # Keep the largest entry of every register of every bin
+            entries = points.groupby(keys + ["register"], sort=True)["entry"].max()
+            vehicle_sketches = [group.tolist() for _, group in entries.groupby(level=list(range(len(keys))), sort=True)]
+            vehicle_ids = [None] * len(stats)
+
+        return list(zip(*columns, vehicle_ids, vehicle_sketches, stats["speed_sum"].tolist(), stats["point_count"].tolist()))
+
+    return aggregate(ZONE_KEYS), aggregate(LINK_KEYS)
+
+
+# Function to merge cube rows into the cube tables
+def upsert_cube_rows(cursor, zone_rows, link_rows) -> None:
+    """
+    Merge cube rows into the cube tables: the vehicle id sets or sketches are merged and the sums added.
+    Must run in the transaction that loads the chunk, so a chunk is merged exactly once.
+    Rows are written in key order so that parallel writers lock shared bins in the same order.
+    :param cursor:
+    :param zone_rows:
+    :param link_rows:
+    :return:
+    """
+    for table, keys, rows in [(ZONE_CUBE_TABLE, ZONE_KEYS, zone_rows), (LINK_CUBE_TABLE, LINK_KEYS, link_rows)]:
+        if not rows:
+            continue
+        execute_values(cursor, f"""
+        INSERT INTO {table} AS cube ({", ".join(keys)}, vehicle_ids, vehicle_sketch, speed_sum, point_count)
+        VALUES %s
+        ON CONFLICT ({", ".join(keys)}) DO UPDATE SET
+            vehicle_ids = {MERGE_VEHICLE_IDS},
+            vehicle_sketch = {MERGE_VEHICLE_SKETCH},
+            speed_sum = cube.speed_sum + EXCLUDED.speed_sum,
+            point_count = cube.point_count + EXCLUDED.point_count
+        """, rows, template=f"({', '.join(['%s'] * len(keys))}, %s::bigint[], %s::integer[], %s, %s)", page_size=1000)
+
+
+# Function to rebuild the cubes of one day from the point table
+def rebuild_cube_day(conn, schema, point_table, selected_date, cube_interval, precision=None) -> None:
+    """
+    Replace the cube rows of one day with aggregates computed from the point table,
+    e.g. for points loaded before the cubes existed
+    :param conn:
+    :param schema:
+    :param point_table:
+    :param selected_date:
+    :param cube_interval:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are kept if None
+    :return:
+    """
+    bin_seconds = int(pd.Timedelta(cube_interval).total_seconds())
+    try:
+        with conn.cursor() as cursor:
+            for table, keys in [(ZONE_CUBE_TABLE, ZONE_KEYS), (LINK_CUBE_TABLE, LINK_KEYS)]:
+                group_columns = [key for key in keys if key != "bin_start"]
+                aggregate_query = f"""
+                SELECT {", ".join(group_columns)},
+                       date_bin(INTERVAL '{bin_seconds} seconds', dt, TIMESTAMP '1970-01-01 00:00:00') AS bin_start,
+                       ARRAY_AGG(DISTINCT vehicle_id ORDER BY vehicle_id) AS vehicle_ids,
+                       NULL::integer[] AS vehicle_sketch,
+                       SUM(velocity) AS speed_sum,
+                       COUNT(*) AS point_count
+                FROM {schema}.{point_table}
+                WHERE {day_condition(selected_date)}
+                GROUP BY {", ".join(str(position) for position in range(1, len(keys) + 1))}
+                """
+                columns = f"{', '.join(group_columns)}, bin_start, vehicle_ids, vehicle_sketch, speed_sum, point_count"
+
+                cursor.execute(f"DELETE FROM {table} WHERE {day_condition(selected_date, 'bin_start')}")
+                if precision is None:
+                    cursor.execute(f"INSERT INTO {table} ({columns}) {aggregate_query}")
+                    continue
+
+                # The sketches are built from the distinct vehicle ids of every bin
+                cursor.execute(aggregate_query)
+                rows = [
+                    (*row[:len(keys)], None, hll.sketch(row[len(keys)], precision), *row[len(keys) + 2:])
+                    for row in cursor.fetchall()
+                ]
+                execute_values(cursor, f"INSERT INTO {table} ({columns}) VALUES %s", rows, page_size=1000)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# Function to build the distinct vehicle column of a cube query
+def vehicle_count_column(precision) -> str:
+    """
+    Column selecting the exact number of vehicles, or the sketch to estimate it from
+    :param precision:
+    :return:
+    """
+    return "cardinality(vehicle_ids)" if precision is None else "vehicle_sketch"
+
+
+# Function to estimate the distinct vehicles from the sketches of a cube query
+def estimate_column(values, precision) -> pd.Series:
+    """
+    Estimate the distinct vehicles of every sketch, rounded to whole vehicles
+    :param values:
+    :param precision:
+    :return:
+    """
+    return values.map(lambda entries: round(hll.estimate(entries, precision))).astype("int64")
+
+
+# Function to read the zone cube of one day
+def read_zone_cube(engine, selected_date, vehicle_class, zone_ids, precision=None) -> pd.DataFrame:
+    """
+    Read the zone bins of one day
+    :param engine:
+    :param selected_date:
+    :param vehicle_class:
+    :param zone_ids:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are counted if None
+    :return: DataFrame with zone_id, dt, vehicle_numbers, speed_sum and point_count
+    """
+    query = f"""
+        SELECT zone_id, bin_start AS dt, {vehicle_count_column(precision)} AS vehicle_numbers, speed_sum, point_count
+        FROM {ZONE_CUBE_TABLE}
+        WHERE {day_condition(selected_date, "bin_start")} AND vehicle_class = '{vehicle_class}'
+          AND zone_id IN ({", ".join(str(zone_id) for zone_id in zone_ids)})
+        ORDER BY zone_id, bin_start;
+    """
+    bins = pd.read_sql(query, engine)
+    bins["dt"] = pd.to_datetime(bins["dt"])
+    if precision is not None:
+        bins["vehicle_numbers"] = estimate_column(bins["vehicle_numbers"], precision)
+    return bins
+
+
+# Function to read the link statistics of one day from the link cube
+def read_link_cube_stats(engine, selected_date, vehicle_class, zone_ids, precision=None) -> pd.DataFrame:
+    """
+    Read the link bins of one day with their vehicle id sets or sketches, to be rolled up to coarser intervals
+    :param engine:
+    :param selected_date:
+    :param vehicle_class:
+    :param zone_ids:
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are read if None
+    :return: DataFrame with zone_id, interval, fid, speed_sum, point_count and vehicles
+    """
+    query = f"""
+        SELECT zone_id, bin_start AS interval, fid, speed_sum, point_count,
+               {"vehicle_ids" if precision is None else "vehicle_sketch"} AS vehicles
+        FROM {LINK_CUBE_TABLE}
+        WHERE {day_condition(selected_date, "bin_start")} AND vehicle_class = '{vehicle_class}'
+          AND zone_id IN ({", ".join(str(zone_id) for zone_id in zone_ids)})
+        ORDER BY zone_id, bin_start, fid;
+    """
+    stats = pd.read_sql(query, engine)
+    stats["interval"] = pd.to_datetime(stats["interval"])
+    return stats
+
+
+# Function to roll up the distinct vehicles of one day to coarser bins
+def read_vehicle_rollup(engine, selected_date, vehicle_class, zone_ids, interval, precision=None, by_zone=True, origin=None, step=None) -> pd.DataFrame:
+    """
+    Count the distinct vehicles of coarser bins, per zone or over all the given zones, by merging the
+    vehicle id sets or sketches of the zone cube in the database
+    :param engine:
+    :param selected_date:
+    :param vehicle_class:
+    :param zone_ids:
+    :param interval: the coarser bin size, a multiple of the cube interval
+    :param precision: precision of the vehicle sketches, the exact vehicle ids are merged if None
+    :param by_zone: one series per zone if True, a single series over all the zones otherwise
+    :param origin: start of a bin, e.g. '2019-09-01 07:00:00', midnight of the day if None
+    :param step: distance between the starts of overlapping bins, a divisor of the interval and a multiple of the
+                 cube interval, e.g. 1h bins every 15min; the bins do not overlap if None
+    :return: DataFrame with (zone_id,) dt and vehicle_numbers
+    """
+    bin_seconds = int(pd.Timedelta(interval).total_seconds())
+    step_seconds = int(pd.Timedelta(step or interval).total_seconds())
+    origin = origin or f"{selected_date} 00:00:00"
+    keys = "zone_id, dt" if by_zone else "dt"
+
+    # Every cube bin is merged into the bins starting in the steps before it that still cover it
+    bins = f"""
+        SELECT zone_id, date_bin(INTERVAL '{step_seconds} seconds', bin_start, TIMESTAMP '{origin}') - shift * INTERVAL '{step_seconds} seconds' AS dt,
+               vehicle_ids, vehicle_sketch
+        FROM {ZONE_CUBE_TABLE}, generate_series(0, {bin_seconds // step_seconds - 1}) AS shift
+        WHERE {day_condition(selected_date, "bin_start")} AND vehicle_class = '{vehicle_class}'
+          AND zone_id IN ({", ".join(str(zone_id) for zone_id in zone_ids)})
+    """
+
+    if precision is None:
+        query = f"""
+            SELECT {keys}, COUNT(DISTINCT vehicle_id) AS vehicle_numbers
+            FROM ({bins}) bins, unnest(vehicle_ids) AS vehicle_id
+            GROUP BY {keys}
+            ORDER BY {keys};
+        """
+    else:
+        # Keep the largest entry of every register, then gather the merged sketch of every bin
+        query = f"""
+            SELECT {keys}, ARRAY_AGG(entry ORDER BY entry) AS vehicle_numbers
+            FROM (
+                SELECT {keys}, MAX(entry) AS entry
+                FROM ({bins}) bins, unnest(vehicle_sketch) AS entry
+                GROUP BY {keys}, entry >> {hll.RANK_BITS}
+            ) registers
+            GROUP BY {keys}
+            ORDER BY {keys};
+        """
+
+    rollup = pd.read_sql(query, engine)
+    rollup["dt"] = pd.to_datetime(rollup["dt"])
+    if precision is not None:
+        rollup["vehicle_numbers"] = estimate_column(rollup["vehicle_numbers"], precision)
+    return rollup
@@ -0,0 +1,158 @@
+"""
+Description:
+Ranking of the zones by congestion over time windows.
+Every day is cut into windows of the "ranking_windows" sizes (e.g. every 15 minutes and every hour),
+starting every "ranking_step" (e.g. 1h windows every 15 minutes), and into the "peak_periods" of
+'config.json' (e.g. 07:00-09:00). The distinct vehicles and the points of every window and zone are
+counted with one grouped query per window size (COUNT DISTINCT on the point table, or the vehicle
+sets/sketches and point counts of the zone cube), or from the dt, zone and vehicle columns of the
+Parquet points, and the zones are ranked within every window and measure. An overlapping window is
+counted from its steps: the vehicles of every step are merged into every window covering it, as
+distinct ids, by union of the id sets or by keeping the largest register of the sketches.
+"""
+
+# Import the necessary libraries and modules
+import pandas as pd
+from partitioning import day_condition
+from zone_cube import ZONE_CUBE_TABLE, cube_precision, read_vehicle_rollup
+
+# Measures the zones are ranked by and columns of the ranking table
+RANKING_MEASURES = ["vehicles", "points"]
+RANKING_COLUMNS = ["window_size", "window", "measure", "rank", "zone_id", "count"]
+
+
+# Function to list the ranking windows
+def ranking_windows(config) -> list:
+    """
+    Windows of a day from "ranking_windows", starting every "ranking_step", and "peak_periods", a peak period being a single window
+    :param config:
+    :return: list of (window_size, length, start, end, step) with the start and end of the period as offsets from midnight
+    """
+    operation = config["operation"]
+    step = pd.Timedelta(operation["ranking_step"])
+    windows = []
+
+    for size in operation["ranking_windows"]:
+        length = pd.Timedelta(size)
+        if length < step or length % step:
+            raise ValueError(f"The ranking window '{size}' must be a multiple of the ranking step '{operation['ranking_step']}'.")
+        windows.append((size, length, pd.Timedelta(0), pd.Timedelta(days=1), step))
+
+    for name, (start, end) in operation["peak_periods"].items():
+        start, end = pd.Timedelta(f"{start}:00"), pd.Timedelta(f"{end}:00")
+        if end <= start:
+            raise ValueError(f"The peak period '{name}' must end after it starts.")
+        windows.append((name, end - start, start, end, end - start))
+
+    return windows
+
+
+# Function to keep the windows of a period
+def period_windows(counts, day, window) -> pd.DataFrame:
+    """
+    Keep the windows starting in the period whose last step is still in the period
+    :param counts: DataFrame with a window column
+    :param day: midnight of the day
+    :param window: a tuple returned by ranking_windows
+    :return:
+    """
+    _, length, start, end, step = window
+    return counts[(counts["window"] >= day + start) & (counts["window"] + length - step < day + end)]
+
+
+# Function to count the vehicles and points of every window in the database
+def query_window_counts(engine, config, selected_date, zone_ids, window) -> pd.DataFrame:
+    """
+    Count the distinct vehicles and the points of every zone and window of one day, on the point table
+    or on the zone cube with "source": "cube" (the windows and steps must then start on cube bins).
+    The rows of every step are joined to the windows covering it, a single one for windows that do not overlap.
+    :param engine:
+    :param config:
+    :param selected_date:
+    :param zone_ids:
+    :param window: a tuple returned by ranking_windows
+    :return: DataFrame with window, zone_id, vehicles and points
+    """
+    operation = config["operation"]
+    _, length, start, end, step = window
+    day = pd.Timestamp(selected_date).normalize()
+    step_seconds = int(step.total_seconds())
+    shifts = length // step
+    step_bin = f"date_bin(INTERVAL '{step_seconds} seconds', {{}}, TIMESTAMP '{day + start}')"
+    shift = f"shift * INTERVAL '{step_seconds} seconds'"
+    zone_list = ", ".join(str(zone_id) for zone_id in zone_ids)
+
+    if operation["source"] == "cube":
+        query = f"""
+            SELECT {step_bin.format("bin_start")} - {shift} AS window_start, zone_id, SUM(point_count) AS points
+            FROM {ZONE_CUBE_TABLE}, generate_series(0, {shifts - 1}) AS shift
+            WHERE {day_condition(selected_date, "bin_start")} AND vehicle_class = '{operation["vehicle_type"]}' AND zone_id IN ({zone_list})
+            GROUP BY 1, 2;
+        """
+        counts = pd.read_sql(query, engine).rename(columns={"window_start": "window"})
+        vehicles = read_vehicle_rollup(engine, selected_date, operation["vehicle_type"], zone_ids, length, cube_precision(config), origin=f"{day + start}", step=step)
+        counts["window"] = pd.to_datetime(counts["window"])
+        counts = counts.merge(vehicles.rename(columns={"dt": "window", "vehicle_numbers": "vehicles"}), on=["window", "zone_id"], how="left")
+    else:
+        # The points are first reduced to one row per step, zone and vehicle
+        query = f"""
+            SELECT step_start - {shift} AS window_start, zone_id,
+                   COUNT(DISTINCT vehicle_id) AS vehicles, SUM(points) AS points
+            FROM (
+                SELECT {step_bin.format("dt")} AS step_start, {operation["zone_id_column"]} AS zone_id, {operation["vehicle_id_column"]} AS vehicle_id, COUNT(*) AS points
+                FROM {config["database"]["schema"]}.{config["database"]["point_table"]}
+                WHERE {day_condition(selected_date)} AND {operation["vehicle_class_column"]} = '{operation["vehicle_type"]}' AND {operation["zone_id_column"]} IN ({zone_list})
+                GROUP BY 1, 2, 3
+            ) steps, generate_series(0, {shifts - 1}) AS shift
+            GROUP BY 1, 2;
+        """
+        counts = pd.read_sql(query, engine).rename(columns={"window_start": "window"})
+        counts["window"] = pd.to_datetime(counts["window"])
+
+    # Only the windows inside the period of a peak window or of the day
+    counts = period_windows(counts, day, window)
+    return counts[["window", "zone_id", "vehicles", "points"]].fillna({"vehicles": 0}).astype({"vehicles": "int64", "points": "int64"})
+
+
+# Function to count the vehicles and points of every window from points
+def count_windows(df, selected_date, window) -> pd.DataFrame:
+    """
+    Count the distinct vehicles and the points of every zone and window of one day, from the
+    distinct vehicles of every step joined to the windows covering it
+    :param df: points of the day with dt, zone_id and vehicle_id
+    :param selected_date:
+    :param window: a tuple returned by ranking_windows
+    :return: DataFrame with window, zone_id, vehicles and points
+    """
+    _, length, start, end, step = window
+    day = pd.Timestamp(selected_date).normalize()
+
+    offsets = pd.to_datetime(df["dt"]) - day
+    in_period = (offsets >= start) & (offsets < end)
+    df, offsets = df[in_period], offsets[in_period]
+
+    # Points of every step, zone and vehicle
+    steps = df.assign(step=(offsets - start) // step).groupby(["step", "zone_id", "vehicle_id"], sort=False).size().rename("points").reset_index()
+
+    # Every step belongs to the windows starting in the steps before it that still cover it
+    covering = pd.concat([steps.assign(step=steps["step"] - shift) for shift in range(length // step)], ignore_index=True)
+    covering = covering.assign(window=day + start + covering["step"] * step)
+
+    counts = covering.groupby(["window", "zone_id"], sort=True).agg(vehicles=("vehicle_id", "nunique"), points=("points", "sum")).reset_index()
+    return period_windows(counts, day, window).reset_index(drop=True)
+
+
+# Function to rank the zones of every window
+def rank_zones(counts, window_size, k) -> pd.DataFrame:
+    """
+    The k zones with the most distinct vehicles and with the most points of every window, ties broken by zone id
+    :param counts: DataFrame with window, zone_id, vehicles and points
+    :param window_size: name of the window size, e.g. '15min' or 'am_peak'
+    :param k:
+    :return: DataFrame with the RANKING_COLUMNS
+    """
+    ranked = counts.melt(id_vars=["window", "zone_id"], value_vars=RANKING_MEASURES, var_name="measure", value_name="count")
+    ranked = ranked.sort_values(["window", "measure", "count", "zone_id"], ascending=[True, True, False, True], ignore_index=True)
+    ranked["rank"] = ranked.groupby(["window", "measure"], sort=False).cumcount() + 1
+    ranked = ranked[ranked["rank"] <= k].assign(window_size=window_size, window=lambda top: top["window"].dt.strftime("%Y-%m-%d %H:%M"))
+    return ranked[RANKING_COLUMNS].reset_index(drop=True)